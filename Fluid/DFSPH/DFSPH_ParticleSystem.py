@@ -0,0 +1,247 @@
+import taichi as ti
+
+from Fluid._basic import *
+from Fluid.SPH.ParticleSystem import ParticleSystem
+
+# the density, the sum of the gradients and the sum of the squared gradients of one neighborhood
+vec5 = ti.types.vector(5, ti.f32)
+
+# divergence-free sph, Bender and Koschier 2017
+# https://animation.rwth-aachen.de/media/papers/2016-TVCG-ViscousDFSPH.pdf
+@ti.data_oriented
+class DFSPH_ParticleSystem(ParticleSystem):
+    def __init__(self):
+        super().__init__()
+        # the sums of the stiffness of the last step are the initial guesses of this step,
+        # they are stored times dt^2 and dt, so they stay valid when dt changes
+        self.extra_attributes = {"kappa": ti.f32, "kappa_v": ti.f32}
+        # the iterations stop at the density and divergence errors the host checks
+        self.supports_fused_steps = False
+        # these are computed again every step, so they are not reordered
+        self.alpha = None
+        self.stiffness = None
+
+    def __del__(self):
+        ...
+
+    def malloc_memory(
+        self, particles_cnt: int, layout: str = "aos",
+        half_precision_attributes: list = [], particles_capacity: int = 0
+    ):
+        super().malloc_memory(particles_cnt, layout, half_precision_attributes, particles_capacity)
+        self.alpha = ti.field(ti.f32)
+        self.stiffness = ti.field(ti.f32)
+        ti.root.dense(ti.i, self.particles_capacity).place(self.alpha, self.stiffness)
+
+    @ti.func
+    def add_density_and_gradients(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> vec5: # type: ignore
+        mass = self.get_mass(other_index)
+        result = vec5(mass * self.pair_kernel_b(self_index, other_index, distance), 0.0, 0.0, 0.0, 0.0)
+        if 0.0 < distance:
+            gradient = mass * self.pair_kernel_a_gradient(self_index, other_index, r_to_center, distance)
+            result = vec5(
+                result[0], gradient.x, gradient.y, gradient.z, gradient.dot(gradient)
+            )
+        return result
+
+    # the boundary particles only add to the sum of the gradients, they do not move
+    @ti.func
+    def add_boundary_density_and_gradient(
+        self, self_index: int, boundary_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec4: # type: ignore
+        volume = self.rigid_boundary.volume[boundary_index]
+        gradient = ti.math.vec3(0.0)
+        if 0.0 < distance:
+            gradient = volume * self.boundary_kernel_a_gradient(self_index, r_to_center, distance)
+        return ti.math.vec4(
+            volume * self.boundary_kernel_b(self_index, distance), gradient.x, gradient.y, gradient.z
+        )
+
+    # alpha only depends on the locations, so it is computed once after the search index is updated
+    # the sleeping particles keep their density and have no stiffness in the solves
+    @ti.kernel
+    def compute_densities_and_alpha(self):
+        if ti.static(self.sleep_steps > 0):
+            for i in range(self.active_cnt[None]):
+                self.stiffness[i] = 0.0
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            result = self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.add_density_and_gradients, vec5(0.0)
+            )
+            if ti.static(self.has_rigid_bodies):
+                boundary = self.density * self.rigid_boundary.sum_over_boundary(
+                    i, self.particles[i].location, self.add_boundary_density_and_gradient,
+                    ti.math.vec4(0.0), self.search_radius
+                )
+                result += vec5(boundary.x, boundary.y, boundary.z, boundary.w, 0.0)
+            last_density = self.particles[i].density
+            self.particles[i].density = result[0]
+            self.update_calm_steps(i, last_density)
+            gradient_sum = ti.math.vec3(result[1], result[2], result[3])
+            denominator = gradient_sum.dot(gradient_sum) + result[4]
+            self.alpha[i] = 0.0
+            if denominator > eps:
+                self.alpha[i] = result[0] / denominator
+
+    @ti.func
+    def add_density_change(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> float:
+        result = 0.0
+        if 0.0 < distance:
+            result = self.get_mass(other_index) * (
+                self.particles[self_index].velocity - self.particles[other_index].velocity
+            ).dot(self.pair_kernel_a_gradient(self_index, other_index, r_to_center, distance))
+        return result
+
+    @ti.func
+    def add_boundary_density_change(
+        self, self_index: int, boundary_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> float:
+        result = 0.0
+        if 0.0 < distance:
+            result = self.rigid_boundary.volume[boundary_index] * self.particles[self_index].velocity.dot(
+                self.boundary_kernel_a_gradient(self_index, r_to_center, distance)
+            )
+        return result
+
+    @ti.func
+    def compute_density_change(self, index: int) -> float:
+        result = self.neighborhood_searcher.sum_over_neighborhoods(index, self.add_density_change, 0.0)
+        if ti.static(self.has_rigid_bodies):
+            result += self.density * self.rigid_boundary.sum_over_boundary(
+                index, self.particles[index].location, self.add_boundary_density_change,
+                0.0, self.search_radius
+            )
+        return result
+
+    # returns the average density error of the awake particles, only compression is corrected
+    @ti.kernel
+    def compute_density_stiffness(self) -> float:
+        density_error_sum = 0.0
+        dt = self.dt[None]
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            predicted_density = self.particles[i].density + dt * self.compute_density_change(i)
+            density_error = ti.max(predicted_density - self.density, 0.0)
+            self.stiffness[i] = density_error / (dt * dt) * self.alpha[i]
+            density_error_sum += density_error
+        return density_error_sum / (ti.max(self.get_awake_cnt(), 1) * self.density)
+
+    # returns the average density error caused by the divergence in this step
+    @ti.kernel
+    def compute_divergence_stiffness(self) -> float:
+        divergence_error_sum = 0.0
+        dt = self.dt[None]
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            density_change = ti.max(self.compute_density_change(i), 0.0)
+            self.stiffness[i] = density_change / dt * self.alpha[i]
+            divergence_error_sum += density_change * dt
+        return divergence_error_sum / (ti.max(self.get_awake_cnt(), 1) * self.density)
+
+    @ti.func
+    def add_stiffness_velocity(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        result = ti.math.vec3(0.0)
+        if 0.0 < distance:
+            result = -self.get_mass(other_index) * (
+                self.stiffness[self_index] / self.particles[self_index].density
+                + self.stiffness[other_index] / self.particles[other_index].density
+            ) * self.pair_kernel_a_gradient(self_index, other_index, r_to_center, distance)
+        return result
+
+    @ti.func
+    def add_boundary_stiffness_velocity(
+        self, self_index: int, boundary_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        result = ti.math.vec3(0.0)
+        if 0.0 < distance:
+            result = -self.rigid_boundary.volume[boundary_index] * self.boundary_kernel_a_gradient(
+                self_index, r_to_center, distance
+            )
+        return result
+
+    @ti.func
+    def apply_stiffness_to_velocity(self, index: int):
+        self.particles[index].velocity += self.dt[None] * (
+            self.neighborhood_searcher.sum_over_neighborhoods(
+                index, self.add_stiffness_velocity, ti.math.vec3(0.0)
+            )
+        )
+        if ti.static(self.has_rigid_bodies):
+            self.particles[index].velocity += self.dt[None] * (
+                self.density * self.stiffness[index] / self.particles[index].density
+                * self.rigid_boundary.sum_over_boundary(
+                    index, self.particles[index].location, self.add_boundary_stiffness_velocity,
+                    ti.math.vec3(0.0), self.search_radius
+                )
+            )
+
+    @ti.kernel
+    def apply_stiffness(self):
+        for k in range(self.get_awake_cnt()):
+            self.apply_stiffness_to_velocity(self.get_awake_index(k))
+
+    # the applied stiffness is summed up as the initial guess of the next step
+    @ti.kernel
+    def apply_density_stiffness(self):
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.apply_stiffness_to_velocity(i)
+            self.particles[i].kappa += self.stiffness[i] * self.dt[None] * self.dt[None]
+
+    @ti.kernel
+    def apply_divergence_stiffness(self):
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.apply_stiffness_to_velocity(i)
+            self.particles[i].kappa_v += self.stiffness[i] * self.dt[None]
+
+    # the stiffness of the iterations of the last step is applied once to the particles
+    # that would be compressed, and the sum starts again from the iterations of this step,
+    # as SPlisHSPlasH does, so the guesses do not grow over the steps
+    @ti.kernel
+    def warm_start_density_stiffness(self):
+        dt = self.dt[None]
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            predicted_density = self.particles[i].density + dt * self.compute_density_change(i)
+            self.stiffness[i] = 0.0
+            if predicted_density > self.density:
+                self.stiffness[i] = self.particles[i].kappa / (dt * dt)
+            self.particles[i].kappa = 0.0
+
+    # only half of the guess is applied to the divergence, as SPlisHSPlasH does
+    @ti.kernel
+    def warm_start_divergence_stiffness(self):
+        dt = self.dt[None]
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            density_change = self.compute_density_change(i)
+            self.stiffness[i] = 0.0
+            if density_change > 0.0:
+                self.stiffness[i] = 0.5 * self.particles[i].kappa_v / dt
+            self.particles[i].kappa_v = 0.0
+
+    @ti.kernel
+    def predict_velocity(self):
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.particles[i].velocity += self.get_forces(i) * self.dt[None] / self.get_mass(i)
+
+    @ti.kernel
+    def update_location(self):
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.particles[i].location += self.particles[i].velocity * self.dt[None]
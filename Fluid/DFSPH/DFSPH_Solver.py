@@ -0,0 +1,93 @@
+from Fluid._basic import *
+from Fluid.SPH.SPH_Solver import SPH_Solver
+from Fluid.DFSPH.DFSPH_ParticleSystem import DFSPH_ParticleSystem
+
+class DFSPH_Solver(SPH_Solver):
+    def __init__(self):
+        super().__init__()
+        self.particle_system = DFSPH_ParticleSystem()
+        # the density solve iterates until the average density error is below max_density_error,
+        # the divergence solve until the density error of the divergence in one step
+        # is below max_divergence_error, both at least min_iterations and at most max_iterations times
+        self.max_density_error = 0.01
+        self.max_divergence_error = 0.01
+        self.min_iterations = 2
+        self.max_iterations = 100
+        # the stiffness of the last step is the initial guess of the solves,
+        # the guess of the divergence solve is off by default, the collisions with the walls
+        # change the divergence too much between the steps and it blows up the impacts
+        self.warm_start_density = True
+        self.warm_start_divergence = False
+
+    def __del__(self):
+        ...
+
+    def build_scene(self) -> bool:
+        if not super().build_scene():
+            return False
+
+        parameters = self.scene_cfg["parameters"]
+        self.max_density_error = parameters.get("dfsph_max_density_error", 0.01)
+        self.max_divergence_error = parameters.get("dfsph_max_divergence_error", 0.01)
+        self.min_iterations = parameters.get("dfsph_min_iterations", 2)
+        self.max_iterations = max(parameters.get("dfsph_max_iterations", 100), self.min_iterations)
+        self.warm_start_density = parameters.get("dfsph_warm_start_density", True)
+        self.warm_start_divergence = parameters.get("dfsph_warm_start_divergence", False)
+        log(f"dfsph iterates until the density error is below {self.max_density_error} "
+            f"and the divergence error is below {self.max_divergence_error}, "
+            f"{self.min_iterations} to {self.max_iterations} iterations"
+        )
+        return True
+
+    # returns the iterations and the last error
+    def iterate(
+        self, compute_stiffness, apply_stiffness, max_error: float, warm_start=None
+    ) -> tuple:
+        if warm_start is not None:
+            warm_start()
+            self.particle_system.apply_stiffness()
+        iterations = 0
+        error = 0.0
+        while iterations < self.max_iterations:
+            error = compute_stiffness()
+            iterations += 1
+            if iterations >= self.min_iterations and error < max_error:
+                break
+            apply_stiffness()
+        return iterations, error
+
+    def solve_divergence(self):
+        particle_system = self.particle_system
+        if not self.warm_start_divergence:
+            particle_system.particles.kappa_v.fill(0.0)
+        iterations, divergence_error = self.iterate(
+            particle_system.compute_divergence_stiffness,
+            particle_system.apply_divergence_stiffness, self.max_divergence_error,
+            particle_system.warm_start_divergence_stiffness if self.warm_start_divergence else None
+        )
+        self.record_step_stats(
+            divergence_iterations=iterations, divergence_error=divergence_error
+        )
+
+    def solve_density(self):
+        particle_system = self.particle_system
+        if not self.warm_start_density:
+            particle_system.particles.kappa.fill(0.0)
+        iterations, density_error = self.iterate(
+            particle_system.compute_density_stiffness,
+            particle_system.apply_density_stiffness, self.max_density_error,
+            particle_system.warm_start_density_stiffness if self.warm_start_density else None
+        )
+        self.record_step_stats(iterations=iterations, density_error=density_error)
+
+    # the loop of the paper starts after the neighborhoods are updated, so the divergence
+    # solve of the end of the last step is the first one here
+    def step(self, step_idx: int = -1):
+        self.begin_step(step_idx)
+        self.run_stage("compute_densities_and_alpha", self.particle_system.compute_densities_and_alpha)
+        self.run_stage("solve_divergence", self.solve_divergence)
+        self.run_stage("accumulate_external_forces", self.particle_system.accumulate_external_forces)
+        self.run_stage("predict_velocity", self.particle_system.predict_velocity)
+        self.run_stage("solve_density", self.solve_density)
+        self.run_stage("update_location", self.particle_system.update_location)
+        self.run_stage("resolve_collision", self.particle_system.resolve_collision)
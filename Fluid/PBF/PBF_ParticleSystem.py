@@ -0,0 +1,258 @@
+import taichi as ti
+
+from Fluid._basic import *
+from Fluid.SPH.ParticleSystem import ParticleSystem
+
+# the density, the gradient of the constraint and its squared norm of one neighborhood
+vec5 = ti.types.vector(5, ti.f32)
+
+# position based fluids, Macklin and Muller 2013
+# https://mmacklin.com/pbf_sig_preprint.pdf
+@ti.data_oriented
+class PBF_ParticleSystem(ParticleSystem):
+    def __init__(self):
+        super().__init__()
+        # the constraints use one particle mass and one support
+        self.supports_adaptive_resolution = False
+        # the constraints only sum over the fluid particles
+        self.supports_rigid_bodies = False
+        # the positions are solved for all particles together
+        self.supports_sleeping = False
+        # these are only used inside one step, after the search index is updated,
+        # so they are not reordered
+        self.predicted_location = None
+        self.constraint_lambda = None
+        self.delta_location = None
+        # the average density error of the last iteration
+        self.density_error = None
+
+        self.iterations = 4
+        self.relaxation = 1.0
+        self.s_corr_k = 0.1
+        self.s_corr_n = 4
+        self.s_corr_dq = 0.2
+        self.xsph_viscosity = 0.01
+
+    def __del__(self):
+        ...
+
+    def malloc_memory(
+        self, particles_cnt: int, layout: str = "aos",
+        half_precision_attributes: list = [], particles_capacity: int = 0
+    ):
+        super().malloc_memory(particles_cnt, layout, half_precision_attributes, particles_capacity)
+        self.predicted_location = ti.Vector.field(3, dtype=ti.f32)
+        self.constraint_lambda = ti.field(ti.f32)
+        self.delta_location = ti.Vector.field(3, dtype=ti.f32)
+        ti.root.dense(ti.i, self.particles_capacity).place(
+            self.predicted_location, self.constraint_lambda, self.delta_location
+        )
+        self.density_error = ti.field(ti.f32, shape=())
+
+    # relaxation and s_corr_k are relative to the squared gradient of the constraint
+    # of a particle with a full neighborhood, so they do not depend on the resolution
+    def init_constraints(
+        self, iterations: int, relaxation: float, s_corr_k: float, s_corr_n: int, s_corr_dq: float,
+        xsph_viscosity: float
+    ):
+        self.iterations = iterations
+        sum_gradient_dot, sum_gradient_sqr = self.compute_prototype_gradients()
+        volume = self.particle_mass / self.density
+        gradient_sqr_sum = volume * volume * (sum_gradient_dot + sum_gradient_sqr)
+        self.relaxation = relaxation * gradient_sqr_sum
+        self.s_corr_k = s_corr_k / gradient_sqr_sum
+        self.s_corr_n = s_corr_n
+        self.s_corr_dq = s_corr_dq
+        self.xsph_viscosity = xsph_viscosity
+
+    # the particles clamped onto a wall are moved into the domain by a small random distance,
+    # otherwise the particles of one column land on the same location, where the gradient
+    # of the constraint is 0 and they can never be separated again
+    @ti.func
+    def confine_to_domain(self, index: int, location: ti.math.vec3) -> ti.math.vec3: # type: ignore
+        domain_start, domain_end = self.get_domain(index)
+        result = location
+        if ti.static(self.has_rigid_sdf):
+            # the velocity follows the location, so only the location is pushed out
+            result, _ = self.push_out_of_rigid_bodies(result)
+        for k in ti.static(range(3)):
+            if result[k] <= domain_start[k]:
+                result[k] = domain_start[k] + self.particle_radius * 1e-3 * ti.random()
+            elif result[k] >= domain_end[k]:
+                result[k] = domain_end[k] - self.particle_radius * 1e-3 * ti.random()
+        return result
+
+    # the velocity is changed with the confinement, so the location before the step
+    # is always location - velocity * dt, even after the particles are reordered
+    @ti.kernel
+    def predict_location(self):
+        self.fused_prediction()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_prediction(self):
+        for i in range(self.active_cnt[None]):
+            location = self.particles[i].location
+            velocity = self.particles[i].velocity + self.get_gravitation(i) * self.dt[None]
+            predicted_location = self.confine_to_domain(i, location + velocity * self.dt[None])
+            self.particles[i].velocity = (predicted_location - location) / self.dt[None]
+            self.particles[i].location = predicted_location
+
+    @ti.kernel
+    def store_predicted_location(self):
+        self.fused_store_predicted_location()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_store_predicted_location(self):
+        for i in range(self.active_cnt[None]):
+            self.predicted_location[i] = self.particles[i].location
+
+    # the locations move inside the iterations, so the offsets of the searcher are not used
+    @ti.func
+    def add_density_and_constraint_gradient(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> vec5: # type: ignore
+        r = self.particles[self_index].location - self.particles[other_index].location
+        r_norm = r.norm()
+        result = vec5(kernel_func_b(r_norm), 0.0, 0.0, 0.0, 0.0)
+        if 0.0 < r_norm:
+            gradient = kernel_func_a_gradient_with_distance(r, r_norm)
+            result = vec5(
+                result[0], gradient.x, gradient.y, gradient.z, gradient.dot(gradient)
+            )
+        return result
+
+    # returns the average density error of the compressed particles, the constraint
+    # also pulls the particles of the surface together, which s_corr balances
+    @ti.kernel
+    def compute_lambda(self) -> float:
+        self.fused_lambda()
+        return self.density_error[None]
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_lambda(self):
+        density_error_sum = 0.0
+        volume = self.particle_mass / self.density
+        for i in range(self.active_cnt[None]):
+            result = self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.add_density_and_constraint_gradient, vec5(0.0)
+            )
+            self.particles[i].density = self.particle_mass * result[0]
+            constraint = self.particles[i].density / self.density - 1.0
+            gradient_self = volume * ti.math.vec3(result[1], result[2], result[3])
+            gradient_sqr_sum = gradient_self.dot(gradient_self) + volume * volume * result[4]
+            self.constraint_lambda[i] = -constraint / (gradient_sqr_sum + self.relaxation)
+            density_error_sum += ti.max(constraint, 0.0)
+        self.density_error[None] = density_error_sum / ti.max(self.active_cnt[None], 1)
+
+    # the artificial pressure s_corr keeps the particles from clustering at the surface
+    @ti.func
+    def add_delta_location(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        r = self.particles[self_index].location - self.particles[other_index].location
+        r_norm = r.norm()
+        result = ti.math.vec3(0.0)
+        if 0.0 < r_norm:
+            s_corr = -self.s_corr_k * ti.math.pow(
+                kernel_func_b(r_norm) / kernel_func_b(self.s_corr_dq * self.kernel_func_h),
+                self.s_corr_n
+            )
+            result = (
+                (self.constraint_lambda[self_index] + self.constraint_lambda[other_index] + s_corr)
+                * kernel_func_a_gradient_with_distance(r, r_norm)
+            )
+        return result
+
+    @ti.kernel
+    def compute_delta_location(self):
+        self.fused_delta_location()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_delta_location(self):
+        volume = self.particle_mass / self.density
+        for i in range(self.active_cnt[None]):
+            self.delta_location[i] = volume * self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.add_delta_location, ti.math.vec3(0.0)
+            )
+
+    # the jacobi iterations overshoot in the impacts with large time steps,
+    # where the particles are clamped onto the walls, so one move is at most the radius
+    @ti.kernel
+    def apply_delta_location(self):
+        self.fused_apply_delta_location()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_apply_delta_location(self):
+        for i in range(self.active_cnt[None]):
+            delta_location = self.delta_location[i]
+            delta_norm = delta_location.norm()
+            if delta_norm > self.particle_radius:
+                delta_location *= self.particle_radius / delta_norm
+            self.particles[i].location = self.confine_to_domain(
+                i, self.particles[i].location + delta_location
+            )
+
+    # the velocity of the prediction is corrected by the moves of the constraints
+    @ti.kernel
+    def update_velocity(self):
+        self.fused_update_velocity()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_update_velocity(self):
+        for i in range(self.active_cnt[None]):
+            self.particles[i].velocity += (
+                self.particles[i].location - self.predicted_location[i]
+            ) / self.dt[None]
+
+    @ti.func
+    def add_xsph_velocity(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        r = self.particles[self_index].location - self.particles[other_index].location
+        return (
+            (self.particles[other_index].velocity - self.particles[self_index].velocity)
+            * kernel_func_b(r.norm()) * self.particle_mass / self.particles[other_index].density
+        )
+
+    # the scratch of the location deltas is reused for the velocity deltas
+    @ti.kernel
+    def apply_xsph_viscosity(self):
+        self.fused_xsph_viscosity()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_xsph_viscosity(self):
+        for i in range(self.active_cnt[None]):
+            self.delta_location[i] = self.xsph_viscosity * (
+                self.neighborhood_searcher.sum_over_neighborhoods(
+                    i, self.add_xsph_velocity, ti.math.vec3(0.0)
+                )
+            )
+        for i in range(self.active_cnt[None]):
+            self.particles[i].velocity += self.delta_location[i]
+
+    # the stages of PBF_Solver.step after the search index is updated,
+    # the iterations are unrolled
+    @ti.func
+    def fused_solve(self):
+        self.fused_store_predicted_location()
+        for _ in ti.static(range(self.iterations)):
+            self.fused_lambda()
+            self.fused_delta_location()
+            self.fused_apply_delta_location()
+        self.fused_update_velocity()
+        self.fused_xsph_viscosity()
+
+    # the only force is the gravitation, the constraints are not forces
+    @ti.func
+    def get_acceleration(self, index: int) -> ti.math.vec3: # type: ignore
+        return self.get_gravitation(index)
@@ -0,0 +1,67 @@
+import math
+from Fluid._basic import *
+from Fluid.SPH.SPH_Solver import SPH_Solver
+from Fluid.PBF.PBF_ParticleSystem import PBF_ParticleSystem
+
+class PBF_Solver(SPH_Solver):
+    def __init__(self):
+        super().__init__()
+        self.particle_system = PBF_ParticleSystem()
+        self.iterations = 4
+
+    def __del__(self):
+        ...
+
+    def build_scene(self) -> bool:
+        if not super().build_scene():
+            return False
+
+        parameters = self.scene_cfg["parameters"]
+        self.iterations = max(parameters.get("pbf_iterations", 4), 1)
+        self.particle_system.init_constraints(
+            self.iterations,
+            parameters.get("pbf_relaxation", 1.0),
+            parameters.get("pbf_s_corr_k", 0.1),
+            parameters.get("pbf_s_corr_n", 4),
+            parameters.get("pbf_s_corr_dq", 0.2),
+            parameters.get("pbf_xsph_viscosity", 0.01)
+        )
+        log(f"pbf solves the density constraints with {self.iterations} iterations")
+
+        # pbf is stable with much larger time steps than the scene is made for,
+        # rounded down so that it divides the frame time
+        time_step = parameters.get("pbf_time_step", 0.0)
+        if time_step > 0.0 and not parameters.get("adaptive_time_step", False):
+            frame_time = 1 / parameters["frame_rate"]
+            time_step = frame_time / math.ceil(frame_time / time_step)
+            parameters["time_step"] = time_step
+            self.particle_system.time_step = time_step
+            self.particle_system.dt[None] = time_step
+            log(f"pbf time step is {time_step:.6g}")
+        return True
+
+    def solve_density_constraints(self):
+        particle_system = self.particle_system
+        density_error = 0.0
+        for _ in range(self.iterations):
+            density_error = particle_system.compute_lambda()
+            particle_system.compute_delta_location()
+            particle_system.apply_delta_location()
+        self.record_step_stats(iterations=self.iterations, density_error=density_error)
+
+    # the steps of a launch are recorded once, with the error of the last step
+    def advance_steps(self, steps_cnt: int):
+        super().advance_steps(steps_cnt)
+        self.record_step_stats(
+            iterations=self.iterations, density_error=self.particle_system.density_error[None]
+        )
+
+    # the locations are predicted before the search index is updated,
+    # so the neighborhoods are searched around the predicted locations
+    def step(self, step_idx: int = -1):
+        self.run_stage("predict_location", self.particle_system.predict_location)
+        self.begin_step(step_idx)
+        self.run_stage("store_predicted_location", self.particle_system.store_predicted_location)
+        self.run_stage("solve_density_constraints", self.solve_density_constraints)
+        self.run_stage("update_velocity", self.particle_system.update_velocity)
+        self.run_stage("apply_xsph_viscosity", self.particle_system.apply_xsph_viscosity)
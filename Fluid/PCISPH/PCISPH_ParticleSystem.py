@@ -0,0 +1,141 @@
+import taichi as ti
+
+from Fluid._basic import *
+from Fluid.SPH.ParticleSystem import ParticleSystem
+
+# predictive-corrective incompressible sph, Solenthaler and Pajarola 2009
+# https://people.inf.ethz.ch/~sobarbar/papers/Sol09/Sol09.pdf
+@ti.data_oriented
+class PCISPH_ParticleSystem(ParticleSystem):
+    def __init__(self):
+        super().__init__()
+        # the pressure delta is computed for one particle mass and one support
+        self.supports_adaptive_resolution = False
+        # the prediction loop updates every particle
+        self.supports_sleeping = False
+        # the iterations stop at a density error the host checks
+        self.supports_fused_steps = False
+        # the predicted state is only used inside one step, so it is not reordered
+        self.predicted_location = None
+        self.predicted_velocity = None
+        self.predicted_density = None
+        self.pressure_delta = 0.0
+
+    def __del__(self):
+        ...
+
+    def malloc_memory(
+        self, particles_cnt: int, layout: str = "aos",
+        half_precision_attributes: list = [], particles_capacity: int = 0
+    ):
+        super().malloc_memory(particles_cnt, layout, half_precision_attributes, particles_capacity)
+        self.predicted_location = ti.Vector.field(3, dtype=ti.f32)
+        self.predicted_velocity = ti.Vector.field(3, dtype=ti.f32)
+        self.predicted_density = ti.field(ti.f32)
+        ti.root.dense(ti.i, self.particles_capacity).place(
+            self.predicted_location, self.predicted_velocity, self.predicted_density
+        )
+
+    # the pressure change per density error, computed once for the time step of the scene
+    # and scaled by the squared ratio of the time steps with adaptive time step
+    def init_pressure_delta(self):
+        sum_gradient_dot, sum_gradient_sqr = self.compute_prototype_gradients()
+        beta = 2.0 * (self.time_step * self.particle_mass / self.density) ** 2
+        self.pressure_delta = 1.0 / (beta * (sum_gradient_dot + sum_gradient_sqr))
+        log(f"pcisph delta is {self.pressure_delta:.6g}")
+
+    # the pressure is stored in f16 per the pressure of a full compression
+    def get_pressure_scale(self) -> float:
+        return self.pressure_delta * self.density
+
+    @ti.kernel
+    def clear_pressure(self):
+        for i in range(self.active_cnt[None]):
+            self.set_pressure(i, 0.0)
+            self.set_pressure_forces(i, ti.math.vec3(0.0))
+
+    @ti.kernel
+    def predict_location(self):
+        for i in range(self.active_cnt[None]):
+            forces = self.get_forces(i) + self.get_pressure_forces(i)
+            self.predicted_velocity[i] = (
+                self.particles[i].velocity + forces * self.dt[None] / self.particle_mass
+            )
+            domain_start, domain_end = self.get_domain(i)
+            self.predicted_location[i] = ti.math.clamp(
+                self.particles[i].location + self.predicted_velocity[i] * self.dt[None],
+                domain_start, domain_end
+            )
+
+    # the neighborhoods of the current location are used for the predicted location
+    @ti.func
+    def add_predicted_density(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> float:
+        return kernel_func_b(
+            (self.predicted_location[self_index] - self.predicted_location[other_index]).norm()
+        )
+
+    # returns the average density error, only compression is corrected
+    # the boundary particles do not move, so they are summed at the predicted location
+    @ti.kernel
+    def predict_density_and_update_pressure(self) -> float:
+        density_error_sum = 0.0
+        time_step_ratio = self.time_step / self.dt[None]
+        pressure_delta = self.pressure_delta * time_step_ratio * time_step_ratio
+        for i in range(self.active_cnt[None]):
+            self.predicted_density[i] = self.particle_mass * (
+                self.neighborhood_searcher.sum_over_neighborhoods(
+                    i, self.add_predicted_density, 0.0
+                )
+            )
+            if ti.static(self.has_rigid_bodies):
+                self.predicted_density[i] += self.density * self.rigid_boundary.sum_over_boundary(
+                    i, self.predicted_location[i], self.add_boundary_density, 0.0, self.search_radius
+                )
+            density_error = ti.max(self.predicted_density[i] - self.density, 0.0)
+            self.set_pressure(i, self.get_pressure(i) + pressure_delta * density_error)
+            density_error_sum += density_error
+        return density_error_sum / (ti.max(self.active_cnt[None], 1) * self.density)
+
+    # the rest density is used instead of the density, as in the derivation of delta
+    @ti.func
+    def add_predicted_pressure_force(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        result = ti.math.vec3(0.0)
+        if 0.0 < distance:
+            result = -(
+                self.particle_mass * self.particle_mass
+                * (self.get_pressure(self_index) + self.get_pressure(other_index))
+                / (self.density * self.density)
+                * kernel_func_a_gradient_with_distance(r_to_center, distance)
+            )
+        return result
+
+    # the boundary particles mirror the pressure of the fluid particle, as in the basic sph,
+    # at the predicted location and density, the same state the pressure corrects
+    @ti.kernel
+    def compute_predicted_pressure_force(self):
+        for i in range(self.active_cnt[None]):
+            pressure_forces = self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.add_predicted_pressure_force, ti.math.vec3(0.0)
+            )
+            if ti.static(self.has_rigid_bodies):
+                pressure_forces += self.get_boundary_pressure_force_at(
+                    i, self.predicted_location[i], self.predicted_density[i]
+                )
+            self.set_pressure_forces(i, pressure_forces)
+
+    @ti.func
+    def get_acceleration(self, index: int) -> ti.math.vec3: # type: ignore
+        return (self.get_forces(index) + self.get_pressure_forces(index)) / self.particle_mass
+
+    @ti.kernel
+    def time_integration_with_pressure_forces(self):
+        for i in range(self.active_cnt[None]):
+            forces = self.get_forces(i) + self.get_pressure_forces(i)
+            self.particles[i].velocity += forces * self.dt[None] / self.particle_mass
+            self.particles[i].location += self.particles[i].velocity * self.dt[None]
@@ -1,8 +1,54 @@
+from Fluid._basic import *
 from Fluid.SPH.SPH_Solver import SPH_Solver
+from Fluid.PCISPH.PCISPH_ParticleSystem import PCISPH_ParticleSystem
 
 class PCISPH_Solver(SPH_Solver):
     def __init__(self):
         super().__init__()
+        self.particle_system = PCISPH_ParticleSystem()
+        # iterate until the average density error is below max_density_error,
+        # at least min_iterations and at most max_iterations times
+        self.max_density_error = 0.01
+        self.min_iterations = 3
+        self.max_iterations = 50
 
     def __del__(self):
-        ...
\ No newline at end of file
+        ...
+
+    def build_scene(self) -> bool:
+        if not super().build_scene():
+            return False
+
+        parameters = self.scene_cfg["parameters"]
+        self.max_density_error = parameters.get("pcisph_max_density_error", 0.01)
+        self.min_iterations = parameters.get("pcisph_min_iterations", 3)
+        self.max_iterations = max(parameters.get("pcisph_max_iterations", 50), self.min_iterations)
+        log(f"pcisph iterates until the density error is below {self.max_density_error}, "
+            f"{self.min_iterations} to {self.max_iterations} iterations"
+        )
+        self.particle_system.init_pressure_delta()
+        return True
+
+    def solve_pressure(self):
+        particle_system = self.particle_system
+        particle_system.clear_pressure()
+        iterations = 0
+        density_error = 0.0
+        while iterations < self.max_iterations:
+            particle_system.predict_location()
+            density_error = particle_system.predict_density_and_update_pressure()
+            particle_system.compute_predicted_pressure_force()
+            iterations += 1
+            if iterations >= self.min_iterations and density_error < self.max_density_error:
+                break
+        self.record_step_stats(iterations=iterations, density_error=density_error)
+
+    def step(self, step_idx: int = -1):
+        self.begin_step(step_idx)
+        self.run_stage("compute_densities", self.particle_system.compute_densities)
+        self.run_stage("accumulate_external_forces", self.particle_system.accumulate_external_forces)
+        self.run_stage("solve_pressure", self.solve_pressure)
+        self.run_stage(
+            "time_integration", self.particle_system.time_integration_with_pressure_forces
+        )
+        self.run_stage("resolve_collision", self.particle_system.resolve_collision)
@@ -1,4 +1,5 @@
-import os, json
+import os, re, json
+import numpy as np
 from tqdm import tqdm
 import mitsuba as mi
 
@@ -148,7 +149,38 @@ class Renderer:
                 "to_world": mi.Transform4f().translate(offset)
             }
 
-    def build_frame(self, input_json_file: str):
+    # the frames of the solver are res_NNNN.npy or res_NNNN.json, other files are skipped,
+    # a frame saved in both formats is rendered once, from the file written last,
+    # e.g. after the simulation was run again into the same path with another output format
+    def list_frame_files(self, input_dir: str) -> list:
+        frame_files = dict()
+        for data_file in os.listdir(input_dir):
+            match = re.fullmatch(r"res_(\d+)\.(npy|json)", data_file)
+            if match is None:
+                continue
+            frame_idx = int(match.group(1))
+            last_file = frame_files.get(frame_idx)
+            if last_file is None or (
+                os.path.getmtime(os.path.join(input_dir, data_file))
+                > os.path.getmtime(os.path.join(input_dir, last_file))
+            ):
+                frame_files[frame_idx] = data_file
+        return [frame_files[frame_idx] for frame_idx in sorted(frame_files)]
+
+    # the frames of the solver, a float32 array of shape (n, 3) in "npy",
+    # or {"particles": [[x, y, z], ...]} in the legacy "json"
+    def load_particles(self, input_file: str) -> np.ndarray:
+        if input_file.endswith(".npy"):
+            return np.load(input_file)
+        with open(input_file, "r") as file:
+            frame = json.load(file)
+        if not isinstance(frame, dict) or not "particles" in frame:
+            log(f"{input_file} is not a frame of the solver, it has no particles")
+            return None
+        return np.array(frame["particles"], dtype=np.float32).reshape(-1, 3)
+
+    # returns False if the frame can not be loaded
+    def build_frame(self, input_file: str) -> bool:
         self.build_common_frame()
 
         parameters = self.scene_cfg["parameters"]
@@ -164,22 +196,23 @@ class Renderer:
                 }
             }
         })
-        frame_data = None
         if self.cmd_args.format == "particles":
-            with open(input_json_file, "r") as file:
-                frame_data = json.load(file) # particles part
-                particles = frame_data["particles"]
-                particle_idx = 0
-                for particle in particles:
-                    particle_idx += 1
-                    self.frame_data_mitsuba_dict[f"particles_instance_{particle_idx}"] = {
-                        "type": "instance",
-                        "shapegroup": single_particle_group,
-                        "to_world": mi.Transform4f().translate(particle)
-                    }
+            particles = self.load_particles(input_file)
+            if particles is None:
+                return False
+            particles = particles.tolist()
+            particle_idx = 0
+            for particle in particles:
+                particle_idx += 1
+                self.frame_data_mitsuba_dict[f"particles_instance_{particle_idx}"] = {
+                    "type": "instance",
+                    "shapegroup": single_particle_group,
+                    "to_world": mi.Transform4f().translate(particle)
+                }
 
         elif self.cmd_args.format == "surface":
             log("render part for surface mesh is under construction...")
+        return True
 
     def render_frame(self, output_image_file: str):
         result = mi.render(mi.load_dict(self.frame_data_mitsuba_dict), spp=self.cmd_args.spp)
@@ -221,24 +254,28 @@ class Renderer:
 
         os.makedirs(output_dir, exist_ok=True)
 
-        data_files = os.listdir(input_dir)
-        data_files = [i for i in data_files if i.endswith(".json")]
-        data_files = sorted(data_files)
+        data_files = self.list_frame_files(input_dir)
         
         log(f"total render frames count is {len(data_files)}")
 
-        remove_json_extension = slice(None, -5)
         self.rendered_images_path.clear()
+        # the log is muted while the bar is shown
+        skipped_files = list()
 
         enter_bar()
         for data_file in tqdm(data_files, desc="rendering frames"):
-            input_json_file = os.path.join(input_dir, data_file)
-            output_image_file = os.path.join(output_dir, f"{data_file[remove_json_extension]}.png")
-            self.build_frame(input_json_file)
+            input_file = os.path.join(input_dir, data_file)
+            output_image_file = os.path.join(output_dir, f"{os.path.splitext(data_file)[0]}.png")
+            if not self.build_frame(input_file):
+                skipped_files.append(data_file)
+                continue
             self.render_frame(output_image_file)
             self.rendered_images_path.append(output_image_file)
         exit_bar()
 
+        for data_file in skipped_files:
+            log(f"{data_file} is skipped, it is not a frame of the solver and has no particles")
+
         log("render task complated")
         if self.cmd_args.encode_video is True:
             log("starting encode to video")
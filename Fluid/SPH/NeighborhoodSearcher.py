@@ -1,6 +1,7 @@
 import taichi as ti
 import math
 from Fluid._basic import *
+from Fluid.SPH.PrefixSum import PrefixSum
 
 @ti.data_oriented
 class NeighborhoodSearcher:
@@ -11,52 +12,225 @@ class NeighborhoodSearcher:
         self.grid_width = 0.1
         self.grid_cnt_per_axis = ti.math.ivec3(1)
         self.grid_cnt_sum = 1
+        self.grid_type = "dense"
+        self.use_spatial_hash = False
         self.particles_cnt_in_every_grid = None
+        # the grid every sorted particle was put in, the grids of the spatial hash share slots
+        self.sorted_grid_3d = None
+        self.retired_cursor = None
+        self.reorder_interval = 0
+        # the counters and the decisions of every update are kept on the device,
+        # so the host does not wait for them, see update_search_index_on_device
+        self.rebuild_cnt = None
+        self.update_cnt = None
+        self.rebuild_flag = None
+        self.reorder_flag = None
+        # verlet neighbor list
+        self.neighbor_skin = 0.0
+        self.use_neighbor_list = False
+        self.max_neighbors = 0
+        self.neighbor_list = None
+        self.neighbor_cnt = None
+        self.location_at_build = None
+        self.neighbor_list_overflow = None
+        self.neighbor_list_overflow_cnt = None
+        self.max_displacement_sqr = None
+        # csr pair cache, filled every update
+        self.use_pair_cache = False
+        self.pair_capacity = 0
+        self.pair_end = None
+        self.pair_cursor = None
+        self.pair_index = None
+        self.pair_offset = None
+        self.pair_distance = None
+        self.pair_cache_overflow_cnt = None
+        # incremental rebuild, the particles which left their grid since the last full rebuild
+        # are skipped in the grids and kept in a small index of their own
+        self.use_incremental_rebuild = False
+        self.moved_capacity = 0
+        self.moved_bucket_cnt = 1
+        self.moved = None
+        self.moved_cnt = None
+        self.moved_index = None
+        self.moved_index_sorted = None
+        self.moved_grid_3d = None
+        self.moved_cnt_in_every_bucket = None
+        self.incremental_flag = None
+        self.incremental_rebuild_cnt = None
+
+        # (0, 0, 0) and the 13 offsets which are lexicographically greater
+        self.half_stencil = [
+            (i, j, k)
+            for i in range(-1, 2)
+            for j in range(-1, 2)
+            for k in range(-1, 2)
+            if (i, j, k) >= (0, 0, 0)
+        ]
 
     def __del__(self):
         ...
 
     def init_grids(
             self, domain_start: list, domain_end: list,
-            grid_width: float
+            grid_width: float, reorder_interval: int = 0,
+            grid_type: str = "dense", particles_cnt: int = 0,
+            neighbor_skin: float = 0.0, max_neighbors: int = 80,
+            pair_cache: bool = False, incremental_rebuild_threshold: float = 0.0
         ):
         self.domain_start = ti.math.vec3(domain_start)
         self.domain_end = ti.math.vec3(domain_end)
         self.grid_width = grid_width
+        self.reorder_interval = reorder_interval
         self.grid_cnt_per_axis = ti.math.ivec3([
             math.ceil((domain_end[i] - domain_start[i]) / grid_width)
             for i in range(3)
         ])
+        dense_grid_cnt_sum = 1
         for i in range(3):
-            self.grid_cnt_sum *= self.grid_cnt_per_axis[i]
-        
+            dense_grid_cnt_sum *= int(self.grid_cnt_per_axis[i])
+
+        if not grid_type in ("dense", "hash"):
+            log(f"{grid_type} is not a available grid type, use dense grid")
+            grid_type = "dense"
+        self.grid_type = grid_type
+        self.use_spatial_hash = grid_type == "hash"
+
         log(f"grid width is {self.grid_width}")
-        log(f"space splited, grid count is {self.grid_cnt_sum}"
+        log(f"space splited, grid count is {dense_grid_cnt_sum}"
             f"({self.grid_cnt_per_axis.x}, {self.grid_cnt_per_axis.y}, {self.grid_cnt_per_axis.z})"
         )
 
+        if self.use_spatial_hash:
+            # most grids are empty, so store the grids in a hash table sized by particle count
+            # the size is a power of 2, so the hash can be masked instead of mod
+            self.grid_cnt_sum = 1
+            while self.grid_cnt_sum < max(particles_cnt, 1):
+                self.grid_cnt_sum *= 2
+            log(f"grids are stored in a spatial hash table, table size is {self.grid_cnt_sum}")
+        else:
+            self.grid_cnt_sum = dense_grid_cnt_sum
+
         self.particles_cnt_in_every_grid = ti.field(ti.int32)
         ti.root.dense(ti.i, self.grid_cnt_sum).place(
             self.particles_cnt_in_every_grid
         )
 
-        self.prefix_sum_executor = ti.algorithms.PrefixSumExecutor(self.grid_cnt_sum)
+        self.prefix_sum = PrefixSum(self.grid_cnt_sum)
+        if self.use_spatial_hash:
+            self.sorted_grid_3d = ti.Vector.field(3, dtype=ti.i32)
+            ti.root.dense(ti.i, max(particles_cnt, 1)).place(self.sorted_grid_3d)
+        self.retired_cursor = ti.field(ti.int32, shape=())
+        self.rebuild_cnt = ti.field(ti.int32, shape=())
+        self.update_cnt = ti.field(ti.int32, shape=())
+        self.rebuild_flag = ti.field(ti.int32, shape=())
+        self.reorder_flag = ti.field(ti.int32, shape=())
+
+        if self.reorder_interval > 0:
+            log(f"particles will be reordered by grid every {self.reorder_interval} rebuilds")
+
+        # the grid width must cover the search radius + neighbor_skin
+        self.neighbor_skin = neighbor_skin
+        self.use_neighbor_list = neighbor_skin > 0.0
+        self.max_neighbors = max_neighbors
+        if self.use_neighbor_list:
+            # the lattice of the fluid blocks already fills search_radius + skin, a list shorter than
+            # that with some room for compression would overflow on the first build
+            lattice_cnt = self.count_lattice_neighbors(self.parent.search_radius + neighbor_skin)
+            if max_neighbors < math.ceil(lattice_cnt * 1.25):
+                self.max_neighbors = math.ceil(lattice_cnt * 1.25)
+                log(f"max_neighbors is raised to {self.max_neighbors}, "
+                    f"{lattice_cnt} neighbors of the lattice are in the search radius + skin"
+                )
+            self.neighbor_list = ti.field(ti.int32)
+            ti.root.dense(ti.ij, (particles_cnt, self.max_neighbors)).place(self.neighbor_list)
+            self.neighbor_cnt = ti.field(ti.int32)
+            self.location_at_build = ti.Vector.field(3, dtype=ti.f32)
+            ti.root.dense(ti.i, particles_cnt).place(self.neighbor_cnt, self.location_at_build)
+            self.neighbor_list_overflow = ti.field(ti.int32, shape=())
+            self.neighbor_list_overflow_cnt = ti.field(ti.int32, shape=())
+            self.max_displacement_sqr = ti.field(ti.f32, shape=())
+            log(f"neighbor list enabled, skin is {neighbor_skin}, "
+                f"at most {self.max_neighbors} neighbors per particle"
+            )
+
+        # all pairs in their support with their offset and distance, in csr form
+        # pairs of particle i are in [pair_end[i - 1], pair_end[i])
+        # the pairs are allocated by the first build, see alloc_pairs
+        self.use_pair_cache = pair_cache
+        if self.use_pair_cache:
+            self.pair_end = ti.field(ti.int32)
+            self.pair_cursor = ti.field(ti.int32)
+            ti.root.dense(ti.i, particles_cnt).place(self.pair_end, self.pair_cursor)
+            self.pair_prefix_sum = PrefixSum(particles_cnt)
+            self.pair_cache_overflow_cnt = ti.field(ti.int32, shape=())
+            log("pair cache enabled")
+
+        # a full rebuild is only done when more than threshold * particles_cnt particles moved
+        self.use_incremental_rebuild = incremental_rebuild_threshold > 0.0
+        if self.use_incremental_rebuild and self.use_neighbor_list:
+            log("incremental rebuild is ignored with neighbor list")
+            self.use_incremental_rebuild = False
+        if self.use_incremental_rebuild:
+            self.moved_capacity = max(int(particles_cnt * incremental_rebuild_threshold), 1)
+            self.moved_bucket_cnt = 1
+            while self.moved_bucket_cnt < self.moved_capacity * 2:
+                self.moved_bucket_cnt *= 2
+            self.moved = ti.field(ti.int32)
+            ti.root.dense(ti.i, particles_cnt).place(self.moved)
+            self.moved_cnt = ti.field(ti.int32, shape=())
+            self.moved_index = ti.field(ti.int32)
+            self.moved_index_sorted = ti.field(ti.int32)
+            self.moved_grid_3d = ti.Vector.field(3, dtype=ti.i32)
+            ti.root.dense(ti.i, self.moved_capacity).place(
+                self.moved_index, self.moved_index_sorted, self.moved_grid_3d
+            )
+            self.moved_cnt_in_every_bucket = ti.field(ti.int32)
+            ti.root.dense(ti.i, self.moved_bucket_cnt).place(self.moved_cnt_in_every_bucket)
+            self.moved_prefix_sum = PrefixSum(self.moved_bucket_cnt)
+            self.incremental_flag = ti.field(ti.int32, shape=())
+            self.incremental_rebuild_cnt = ti.field(ti.int32, shape=())
+            log(f"incremental rebuild enabled, at most {self.moved_capacity:,} moved particles")
+
+    # the points of the lattice of the fluid blocks closer than radius to one of them, self included
+    def count_lattice_neighbors(self, radius: float) -> int:
+        spacing = self.parent.particle_radius * 2
+        cnt = math.ceil(radius / spacing)
+        return sum(
+            1
+            for i in range(-cnt, cnt + 1)
+            for j in range(-cnt, cnt + 1)
+            for k in range(-cnt, cnt + 1)
+            if (i * i + j * j + k * k) * spacing * spacing < radius * radius
+        )
 
     @ti.func
     def location_to_grid_3d(
         self, location: ti.math.vec3 # type: ignore
     ) -> ti.math.ivec3: # type: ignore
         location = ti.math.clamp(location, self.domain_start, self.domain_end)
-        return ti.cast((location - self.domain_start) / self.grid_width, ti.int32)
+        grid_3d = ti.cast((location - self.domain_start) / self.grid_width, ti.int32)
+        # the location on domain_end is in the last grid
+        return ti.math.clamp(grid_3d, 0, self.grid_cnt_per_axis - 1)
 
+    # with spatial hash, this is the slot in the hash table
     @ti.func
     def grid_3d_to_grid_1d(self, grid_3d: ti.math.ivec3) -> int: # type: ignore
-        return (
-            grid_3d.x * self.grid_cnt_per_axis.y * self.grid_cnt_per_axis.z +
-            grid_3d.y * self.grid_cnt_per_axis.z +
-            grid_3d.z
-        )
-    
+        grid_1d = 0
+        if ti.static(self.use_spatial_hash):
+            grid_1d = (
+                (grid_3d.x * 73856093) ^
+                (grid_3d.y * 19349663) ^
+                (grid_3d.z * 83492791)
+            ) & (self.grid_cnt_sum - 1)
+        else:
+            grid_1d = (
+                grid_3d.x * self.grid_cnt_per_axis.y * self.grid_cnt_per_axis.z +
+                grid_3d.y * self.grid_cnt_per_axis.z +
+                grid_3d.z
+            )
+        return grid_1d
+
+    # the function can not be used with spatial hash
     @ti.func
     def grid_1d_to_grid_3d(self, grid_1d: int) -> tuple:
         x = int(grid_1d / (self.grid_cnt_per_axis.y * self.grid_cnt_per_axis.z))
@@ -66,51 +240,492 @@ class NeighborhoodSearcher:
         z = grid_1d
         return x,y,z
 
-    @ti.kernel
-    def clear_particles_cnt_in_every_grid(self):
-        for i in range(self.grid_cnt_sum):
+    # the loops of the passes of an update are empty unless enabled is 1,
+    # a branch around them would run them in serial
+    @ti.func
+    def clear_particles_cnt_in_every_grid(self, enabled: int):
+        for i in range(self.grid_cnt_sum * enabled):
             self.particles_cnt_in_every_grid[i] = 0
 
+    @ti.func
+    def count_particles_cnt_in_every_grid(self, enabled: int):
+        for i in range(self.parent.active_cnt[None] * enabled):
+            if self.is_alive(i):
+                grid_id = self.grid_3d_to_grid_1d(
+                    self.location_to_grid_3d(self.parent.particles[i].location)
+                )
+                ti.atomic_add(self.particles_cnt_in_every_grid[grid_id], 1)
+
+    # the retired particles are not in any grid, they are sorted after all alive particles
+    # and removed by reorder_particles
+    @ti.func
+    def is_alive(self, index: int) -> bool:
+        alive = True
+        if ti.static(self.parent.retires_particles):
+            alive = self.parent.particles[index].alive != 0
+        return alive
+
+    @ti.func
+    def resort_particles(self, enabled: int):
+        self.retired_cursor[None] = self.parent.active_cnt[None] - self.parent.free_cnt[None]
+        for i in range(self.parent.active_cnt[None] * enabled):
+            grid_id = -1
+            id = 0
+            if self.is_alive(i):
+                grid_3d = self.location_to_grid_3d(self.parent.particles[i].location)
+                grid_id = self.grid_3d_to_grid_1d(grid_3d)
+                id = ti.atomic_sub(self.particles_cnt_in_every_grid[grid_id], 1) - 1
+                if ti.static(self.use_spatial_hash):
+                    self.sorted_grid_3d[id] = grid_3d
+            else:
+                id = ti.atomic_add(self.retired_cursor[None], 1)
+            self.parent.particles[i].id = id
+            self.parent.particles[i].grid_id = grid_id
+            self.parent.id_to_index[id] = i
+            if ti.static(self.use_incremental_rebuild):
+                self.moved[i] = 0
+
+    @ti.func
+    def restore_particles_cnt_in_every_grid(self, enabled: int):
+        for i in range(self.parent.active_cnt[None] * enabled):
+            grid_id = self.parent.particles[i].grid_id
+            if grid_id >= 0:
+                ti.atomic_add(self.particles_cnt_in_every_grid[grid_id], 1)
+
+    # the ids of the particles in one grid are contiguous, after the ids of the grids before it
+    # only call at the top level of a kernel
+    @ti.func
+    def sort_particles_into_grids(self, enabled: int):
+        self.clear_particles_cnt_in_every_grid(enabled)
+        self.count_particles_cnt_in_every_grid(enabled)
+        self.prefix_sum.scan_if(self.particles_cnt_in_every_grid, enabled)
+        self.resort_particles(enabled)
+        self.restore_particles_cnt_in_every_grid(enabled)
+
     @ti.kernel
-    def count_particles_cnt_in_every_grid(self, particles_cnt: int):
-        for i in range(particles_cnt):
+    def sort_particles_into_grids_kernel(self):
+        self.sort_particles_into_grids(1)
+
+    # move every particle to the slot given by its sorted id
+    # so the particles of one grid are contiguous in memory
+    @ti.func
+    def reorder_particles(self, enabled: int):
+        for i in range(self.parent.active_cnt[None] * enabled):
+            self.parent.particles_buffer[self.parent.particles[i].id] = self.parent.particles[i]
+        for i in range(self.parent.active_cnt[None] * enabled):
+            self.parent.particles[i] = self.parent.particles_buffer[i]
+            self.parent.id_to_index[i] = i
+
+    @ti.func
+    def grid_1d_to_moved_bucket(self, grid_1d: int) -> int:
+        return (grid_1d * 40503) & (self.moved_bucket_cnt - 1)
+
+    # compare every particle with the grid of the last full rebuild
+    @ti.func
+    def find_moved_particles(self, enabled: int):
+        self.moved_cnt[None] = 0
+        for i in range(self.parent.active_cnt[None] * enabled):
             grid_id = self.grid_3d_to_grid_1d(
                 self.location_to_grid_3d(self.parent.particles[i].location)
             )
-            ti.atomic_add(self.particles_cnt_in_every_grid[grid_id], 1)
+            self.moved[i] = 0
+            if grid_id != self.parent.particles[i].grid_id:
+                self.moved[i] = 1
+                k = ti.atomic_add(self.moved_cnt[None], 1)
+                if k < self.moved_capacity:
+                    self.moved_index[k] = i
+
+    # same as the grids, but only for the moved particles
+    @ti.func
+    def clear_moved_cnt_in_every_bucket(self, enabled: int):
+        for i in range(self.moved_bucket_cnt * enabled):
+            self.moved_cnt_in_every_bucket[i] = 0
+
+    @ti.func
+    def count_moved_cnt_in_every_bucket(self, enabled: int):
+        for k in range(self.moved_cnt[None] * enabled):
+            bucket = self.grid_1d_to_moved_bucket(self.grid_3d_to_grid_1d(
+                self.location_to_grid_3d(self.parent.particles[self.moved_index[k]].location)
+            ))
+            ti.atomic_add(self.moved_cnt_in_every_bucket[bucket], 1)
+
+    @ti.func
+    def resort_moved_particles(self, enabled: int):
+        for k in range(self.moved_cnt[None] * enabled):
+            i = self.moved_index[k]
+            grid_3d = self.location_to_grid_3d(self.parent.particles[i].location)
+            bucket = self.grid_1d_to_moved_bucket(self.grid_3d_to_grid_1d(grid_3d))
+            id = ti.atomic_sub(self.moved_cnt_in_every_bucket[bucket], 1) - 1
+            self.moved_index_sorted[id] = i
+            self.moved_grid_3d[id] = grid_3d
+        for k in range(self.moved_cnt[None] * enabled):
+            bucket = self.grid_1d_to_moved_bucket(self.grid_3d_to_grid_1d(
+                self.location_to_grid_3d(self.parent.particles[self.moved_index[k]].location)
+            ))
+            ti.atomic_add(self.moved_cnt_in_every_bucket[bucket], 1)
+
+    @ti.func
+    def incremental_rebuild_search_index(self, enabled: int):
+        self.clear_moved_cnt_in_every_bucket(enabled)
+        self.count_moved_cnt_in_every_bucket(enabled)
+        self.moved_prefix_sum.scan_if(self.moved_cnt_in_every_bucket, enabled)
+        self.resort_moved_particles(enabled)
+
+    @ti.func
+    def add_to_neighbor_list(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        # with adaptive resolution, the pairs out of their support + skin are not kept
+        if self.parent.in_pair_support(self_index, other_index, distance - self.neighbor_skin):
+            k = self.neighbor_cnt[self_index]
+            if k < self.max_neighbors:
+                self.neighbor_list[self_index, k] = other_index
+            else:
+                self.neighbor_list_overflow[None] = 1
+            self.neighbor_cnt[self_index] = k + 1
+        return 0
+
+    # the neighbors are still counted after the list is full, the particles with more neighbors
+    # than max_neighbors search the grids instead of the list, see list_overflowed
+    # the overflows are counted on the device, so the host does not wait for every rebuild
+    @ti.func
+    def build_neighbor_list(self, enabled: int):
+        self.neighbor_list_overflow[None] = 0
+        for i in range(self.parent.active_cnt[None] * enabled):
+            self.neighbor_cnt[i] = 0
+            self.location_at_build[i] = self.parent.particles[i].location
+            self.sum_over_grids(
+                i, self.add_to_neighbor_list, 0,
+                self.parent.search_radius + self.neighbor_skin, False
+            )
+        if self.neighbor_list_overflow[None] != 0:
+            self.neighbor_list_overflow_cnt[None] += 1
 
     @ti.kernel
-    def resort_particles(self, particles_cnt: int):
-        for i in range(particles_cnt):
-            grid_id = self.grid_3d_to_grid_1d(
-                self.location_to_grid_3d(self.parent.particles[i].location)
+    def build_neighbor_list_kernel(self):
+        self.build_neighbor_list(1)
+
+    # squared, to avoid sqrt for every particle
+    @ti.func
+    def compute_max_displacement_sqr(self, enabled: int):
+        self.max_displacement_sqr[None] = 0.0
+        for i in range(self.parent.active_cnt[None] * enabled):
+            offset = self.parent.particles[i].location - self.location_at_build[i]
+            ti.atomic_max(self.max_displacement_sqr[None], offset.dot(offset))
+
+    @ti.func
+    def count_pair(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        return 1 if self.parent.in_pair_support(self_index, other_index, distance) else 0
+
+    @ti.func
+    def count_pairs(self):
+        for i in range(self.parent.active_cnt[None]):
+            self.pair_end[i] = self.sum_over_candidates(
+                i, self.count_pair, 0, self.parent.search_radius
             )
-            id = ti.atomic_sub(self.particles_cnt_in_every_grid[grid_id], 1) - 1
-            self.parent.particles[i].id = id
-            self.parent.particles[i].grid_id = grid_id
-            self.parent.id_to_index[id] = i
 
     @ti.kernel
-    def restore_particles_cnt_in_every_grid(self, particles_cnt: int):
-        for i in range(particles_cnt):
-            grid_id = self.parent.particles[i].grid_id
-            ti.atomic_add(self.particles_cnt_in_every_grid[grid_id], 1)
+    def count_pairs_kernel(self):
+        self.count_pairs()
+
+    @ti.func
+    def add_to_pair_cache(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        if self.parent.in_pair_support(self_index, other_index, distance):
+            k = self.pair_cursor[self_index]
+            if k < self.pair_capacity:
+                self.pair_index[k] = other_index
+                self.pair_offset[k] = r_to_center
+                self.pair_distance[k] = distance
+            self.pair_cursor[self_index] = k + 1
+        return 0
+
+    # the particles whose pairs do not fit search the grids instead, see pairs_overflowed,
+    # the overflows are counted on the device, so the host does not wait for every update
+    @ti.func
+    def fill_pairs(self):
+        for i in range(self.parent.active_cnt[None]):
+            self.pair_cursor[i] = self.pair_start(i)
+            self.sum_over_candidates(
+                i, self.add_to_pair_cache, 0, self.parent.search_radius
+            )
+        active_cnt = self.parent.active_cnt[None]
+        if active_cnt > 0 and self.pair_end[active_cnt - 1] > self.pair_capacity:
+            self.pair_cache_overflow_cnt[None] += 1
+
+    @ti.func
+    def pair_start(self, index: int) -> int:
+        start = 0
+        if index > 0:
+            start = self.pair_end[index - 1]
+        return start
+
+    @ti.func
+    def pairs_overflowed(self, index: int) -> bool:
+        return self.pair_end[index] > self.pair_capacity
+
+    # the compiled kernels keep the fields they were compiled with, so the pairs can not grow later,
+    # they are sized by the pairs of the first build, with room for compression and emitted particles,
+    # call before the first update, which compiles the kernels that fill them
+    def alloc_pairs(self):
+        if not self.use_pair_cache or self.pair_index is not None:
+            return
+        # the first update builds the index again and counts the overflows of the list
+        self.sort_particles_into_grids_kernel()
+        if self.use_neighbor_list:
+            self.build_neighbor_list_kernel()
+            self.neighbor_list_overflow_cnt[None] = 0
+        self.count_pairs_kernel()
+        self.pair_prefix_sum.run(self.pair_end)
+        active_cnt = max(self.parent.active_cnt[None], 1)
+        pairs_cnt = self.pair_end[active_cnt - 1]
+        self.pair_capacity = max(
+            math.ceil(pairs_cnt / active_cnt * 1.5) * self.parent.particles_capacity, 1
+        )
+        self.pair_index = ti.field(ti.int32)
+        self.pair_offset = ti.Vector.field(3, dtype=ti.f32)
+        self.pair_distance = ti.field(ti.f32)
+        ti.root.dense(ti.i, self.pair_capacity).place(self.pair_index)
+        ti.root.dense(ti.i, self.pair_capacity).place(self.pair_offset)
+        ti.root.dense(ti.i, self.pair_capacity).place(self.pair_distance)
+
+    @ti.func
+    def build_pair_cache(self):
+        self.count_pairs()
+        self.pair_prefix_sum.scan(self.pair_end)
+        self.fill_pairs()
+
+    # with neighbor list the index is only rebuilt after some particle moved more than half
+    # of the skin, with incremental rebuild only after too many particles left their grid,
+    # force_rebuild is 1 after particles were added or retired
+    # the decisions are made on the device and the passes that are not needed run empty loops,
+    # so the host never waits for an update and the steps can be launched together
+    # only call at the top level of a kernel
+    @ti.func
+    def update_search_index_on_device(self, force_rebuild: int):
+        self.update_cnt[None] += 1
+        self.rebuild_flag[None] = 1 if force_rebuild != 0 or self.rebuild_cnt[None] == 0 else 0
+        if ti.static(self.use_neighbor_list):
+            self.compute_max_displacement_sqr(1 - self.rebuild_flag[None])
+            if self.max_displacement_sqr[None] > ti.static((self.neighbor_skin * 0.5) ** 2):
+                self.rebuild_flag[None] = 1
+        elif ti.static(self.use_incremental_rebuild):
+            self.find_moved_particles(1 - self.rebuild_flag[None])
+            if self.moved_cnt[None] > self.moved_capacity:
+                self.rebuild_flag[None] = 1
+            self.incremental_flag[None] = 1 - self.rebuild_flag[None]
+        else:
+            self.rebuild_flag[None] = 1
+
+        self.sort_particles_into_grids(self.rebuild_flag[None])
+        if ti.static(self.use_incremental_rebuild):
+            # no particle moved since now
+            self.clear_moved_cnt_in_every_bucket(self.rebuild_flag[None])
+        # the retired particles are compacted by reordering
+        if ti.static(self.reorder_interval > 0 or self.parent.retires_particles):
+            self.reorder_flag[None] = 0
+            if ti.static(self.parent.retires_particles):
+                if self.rebuild_flag[None] != 0 and self.parent.free_cnt[None] > 0:
+                    self.reorder_flag[None] = 1
+            if ti.static(self.reorder_interval > 0):
+                if self.rebuild_flag[None] != 0 and self.rebuild_cnt[None] % self.reorder_interval == 0:
+                    self.reorder_flag[None] = 1
+            self.reorder_particles(self.reorder_flag[None])
+            if ti.static(self.parent.retires_particles):
+                if self.rebuild_flag[None] != 0 and self.parent.free_cnt[None] > 0:
+                    self.parent.finish_compaction()
+        self.rebuild_cnt[None] += self.rebuild_flag[None]
+
+        if ti.static(self.use_incremental_rebuild):
+            self.incremental_rebuild_search_index(self.incremental_flag[None])
+            self.incremental_rebuild_cnt[None] += self.incremental_flag[None]
+
+        if ti.static(self.use_neighbor_list):
+            self.build_neighbor_list(self.rebuild_flag[None])
+
+        if ti.static(self.use_pair_cache):
+            # the pairs changed even if the index did not
+            self.build_pair_cache()
+
+    @ti.kernel
+    def update_search_index_kernel(self, force_rebuild: int):
+        self.update_search_index_on_device(force_rebuild)
+
+    # call every steps, force_rebuild after particles were added or retired
+    def update_search_index(self, force_rebuild: bool = False):
+        self.alloc_pairs()
+        self.update_search_index_kernel(1 if force_rebuild else 0)
+
+    def log_statistics(self):
+        log(f"search index rebuilt {self.rebuild_cnt[None]} times in {self.update_cnt[None]} updates")
+        if self.use_incremental_rebuild:
+            log(f"search index incrementally rebuilt {self.incremental_rebuild_cnt[None]} times")
+        if self.use_neighbor_list and self.neighbor_list_overflow_cnt[None] > 0:
+            log(f"neighbor list overflowed in {self.neighbor_list_overflow_cnt[None]} rebuilds, "
+                f"the particles over max_neighbors searched the grids instead, "
+                f"please increase max_neighbors (now {self.max_neighbors})"
+            )
+        if self.parent.emit_overflow_cnt[None] > 0:
+            log(f"{self.parent.emit_overflow_cnt[None]:,} particles were not emitted, "
+                f"please increase particles_capacity (now {self.parent.particles_capacity:,})"
+            )
+        if self.parent.adaptive_resolution and self.parent.split_overflow_cnt[None] > 0:
+            log(f"{self.parent.split_overflow_cnt[None]:,} particles were not split, "
+                f"please increase particles_capacity (now {self.parent.particles_capacity:,})"
+            )
+        if self.parent.half_precision_clamp_cnt[None] > 0:
+            log(f"{self.parent.half_precision_clamp_cnt[None]:,} values of "
+                f"{', '.join(self.parent.half_precision_attributes)} were clamped to the range of f16"
+            )
+        if self.use_pair_cache:
+            log(f"pair cache capacity is {self.pair_capacity:,} pairs")
+        if self.use_pair_cache and self.pair_cache_overflow_cnt[None] > 0:
+            log(f"pair cache overflowed in {self.pair_cache_overflow_cnt[None]} updates, "
+                f"the particles over the capacity searched the grids instead "
+                f"(capacity is {self.pair_capacity:,} pairs)"
+            )
 
-    # rebuild every steps
     def rebuild_search_index(self):
-        self.clear_particles_cnt_in_every_grid()
-        self.count_particles_cnt_in_every_grid(self.parent.particles_cnt)
-        # cant run on arm64
-        with suppress_print():
-            self.prefix_sum_executor.run(self.particles_cnt_in_every_grid) # BUG of Taichi
-        self.resort_particles(self.parent.particles_cnt)
-        self.restore_particles_cnt_in_every_grid(self.parent.particles_cnt)
-
-    # call_func(self_index, other_index)
-    @ti.func
-    def for_all_neighborhoods(self, index: int, call_func: ti.template()): # type: ignore
-        grid_id = self.parent.particles[index].grid_id
-        sx,sy,sz = self.grid_1d_to_grid_3d(grid_id)
+        self.update_search_index(True)
+
+    # call_func(self_index, other_index, r_to_center, distance) returns the part of the pair,
+    # r_to_center is the location of self minus the location of other,
+    # the parts of all neighborhoods in the search radius (self included) are summed up from init,
+    # which is kernel_func_h without adaptive resolution
+    @ti.func
+    def sum_over_neighborhoods(
+        self, index: int, call_func: ti.template(), init: ti.template() # type: ignore
+    ):
+        result = init
+        if ti.static(self.use_pair_cache):
+            if self.pairs_overflowed(index):
+                result = self.sum_over_candidates(
+                    index, call_func, init, self.parent.search_radius
+                )
+            else:
+                for k in range(self.pair_start(index), self.pair_end[index]):
+                    result += call_func(
+                        index, self.pair_index[k],
+                        self.pair_offset[k], self.pair_distance[k]
+                    )
+        else:
+            result = self.sum_over_candidates(
+                index, call_func, init, self.parent.search_radius
+            )
+        return result
+
+    # same as sum_over_neighborhoods but every pair is only visited by one of the two particles,
+    # so call_func has to apply the part of other_index by itself
+    @ti.func
+    def sum_over_half_neighborhoods(
+        self, index: int, call_func: ti.template(), init: ti.template() # type: ignore
+    ):
+        result = init
+        if ti.static(self.use_pair_cache):
+            if self.pairs_overflowed(index):
+                result = self.sum_over_greater_candidates(index, call_func, init)
+            else:
+                for k in range(self.pair_start(index), self.pair_end[index]):
+                    other_index = self.pair_index[k]
+                    if other_index > index:
+                        result += call_func(
+                            index, other_index,
+                            self.pair_offset[k], self.pair_distance[k]
+                        )
+        elif ti.static(self.use_neighbor_list):
+            result = self.sum_over_greater_candidates(index, call_func, init)
+        else:
+            result = self.sum_over_half_grids(index, call_func, init, self.parent.search_radius)
+        return result
+
+    # the pairs with other_index > index in the search radius, as the pair cache and the list visit them
+    @ti.func
+    def sum_over_greater_candidates(
+        self, index: int, call_func: ti.template(), init: ti.template() # type: ignore
+    ):
+        result = init
+        if ti.static(self.use_neighbor_list):
+            if self.list_overflowed(index):
+                result = self.sum_over_grids(index, call_func, init, self.parent.search_radius, True)
+            else:
+                location = self.parent.particles[index].location
+                for k in range(self.neighbor_cnt[index]):
+                    other_index = self.neighbor_list[index, k]
+                    if other_index > index:
+                        r_to_center = location - self.parent.particles[other_index].location
+                        distance = r_to_center.norm()
+                        if distance < self.parent.search_radius:
+                            result += call_func(index, other_index, r_to_center, distance)
+        else:
+            result = self.sum_over_grids(index, call_func, init, self.parent.search_radius, True)
+        return result
+
+    # the home grid and the 13 grids after it, the other 13 grids visit this one
+    @ti.func
+    def sum_over_half_grids(
+        self, index: int, call_func: ti.template(), init: ti.template(), # type: ignore
+        cutoff: float
+    ):
+        result = init
+        location = self.parent.particles[index].location
+        center = self.location_to_grid_3d(location)
+        for offset in ti.static(self.half_stencil):
+            neighbor = ti.math.ivec3(offset) + center
+            x,y,z = neighbor.x, neighbor.y, neighbor.z
+            if (
+                0 <= x < self.grid_cnt_per_axis.x and
+                0 <= y < self.grid_cnt_per_axis.y and
+                0 <= z < self.grid_cnt_per_axis.z
+            ):
+                # in the home grid, the particle with smaller index visits the pair
+                result = self.sum_over_grid(
+                    index, location, neighbor, call_func, result, cutoff,
+                    ti.static(offset == (0, 0, 0))
+                )
+        return result
+
+    # same as sum_over_neighborhoods but without the pair cache and with any cutoff
+    @ti.func
+    def sum_over_candidates(
+        self, index: int, call_func: ti.template(), init: ti.template(), # type: ignore
+        cutoff: float
+    ):
+        result = init
+        if ti.static(self.use_neighbor_list):
+            if self.list_overflowed(index):
+                result = self.sum_over_grids(index, call_func, init, cutoff, False)
+            else:
+                location = self.parent.particles[index].location
+                for k in range(self.neighbor_cnt[index]):
+                    other_index = self.neighbor_list[index, k]
+                    r_to_center = location - self.parent.particles[other_index].location
+                    distance = r_to_center.norm()
+                    if distance < cutoff:
+                        result += call_func(index, other_index, r_to_center, distance)
+        else:
+            result = self.sum_over_grids(index, call_func, init, cutoff, False)
+        return result
+
+    # the list of the particle was truncated, the grids of the last rebuild still cover
+    # the search radius, no particle moved more than half of the skin since then
+    @ti.func
+    def list_overflowed(self, index: int) -> bool:
+        return self.neighbor_cnt[index] > self.max_neighbors
+
+    @ti.func
+    def sum_over_grids(
+        self, index: int, call_func: ti.template(), init: ti.template(), # type: ignore
+        cutoff: float, only_greater: ti.template() # type: ignore
+    ):
+        result = init
+        location = self.parent.particles[index].location
+        center = self.location_to_grid_3d(location)
         # neighbors = [
         #     [x+i, y+j, z+k] 
         #     for i in range(-1,2)
@@ -132,16 +747,81 @@ class NeighborhoodSearcher:
         #             call_func(index, self.parent.id_to_index[i])
 
         for offset in ti.grouped(ti.ndrange(*((-1, 2),) * 3)):
-            neighbor = ti.math.ivec3(offset) + ti.math.ivec3(sx,sy,sz)
+            neighbor = ti.math.ivec3(offset) + center
             x,y,z = neighbor.x, neighbor.y, neighbor.z
             if (
                 0 <= x < self.grid_cnt_per_axis.x and
                 0 <= y < self.grid_cnt_per_axis.y and
                 0 <= z < self.grid_cnt_per_axis.z
             ):
-                neighbor_id = self.grid_3d_to_grid_1d(ti.math.ivec3(x,y,z))
-                l, r  = 0, self.particles_cnt_in_every_grid[neighbor_id]
-                if neighbor_id > 0:
-                    l = self.particles_cnt_in_every_grid[neighbor_id - 1]
-                for i in range(l,r):
-                    call_func(index, self.parent.id_to_index[i])
\ No newline at end of file
+                result = self.sum_over_grid(
+                    index, location, neighbor, call_func, result, cutoff, only_greater
+                )
+        return result
+
+    # add the parts of the particles in one grid to result
+    @ti.func
+    def sum_over_grid(
+        self, index: int, location: ti.math.vec3, grid_3d: ti.math.ivec3, # type: ignore
+        call_func: ti.template(), result: ti.template(), cutoff: float, # type: ignore
+        only_greater: ti.template() # type: ignore
+    ):
+        grid_1d = self.grid_3d_to_grid_1d(grid_3d)
+        l, r  = 0, self.particles_cnt_in_every_grid[grid_1d]
+        if grid_1d > 0:
+            l = self.particles_cnt_in_every_grid[grid_1d - 1]
+        for i in range(l,r):
+            other_index = self.parent.id_to_index[i]
+            other_grid_3d = grid_3d
+            if ti.static(self.use_spatial_hash):
+                other_grid_3d = self.sorted_grid_3d[i]
+            if ti.static(self.use_incremental_rebuild):
+                # moved particles are visited in the moved grids below
+                if self.moved[other_index] == 0:
+                    result = self.visit_pair(
+                        index, other_index, location, grid_3d, other_grid_3d, call_func, result,
+                        cutoff, only_greater, ti.static(self.use_spatial_hash)
+                    )
+            else:
+                result = self.visit_pair(
+                    index, other_index, location, grid_3d, other_grid_3d, call_func, result,
+                    cutoff, only_greater, ti.static(self.use_spatial_hash)
+                )
+
+        if ti.static(self.use_incremental_rebuild):
+            bucket = self.grid_1d_to_moved_bucket(grid_1d)
+            l, r = 0, self.moved_cnt_in_every_bucket[bucket]
+            if bucket > 0:
+                l = self.moved_cnt_in_every_bucket[bucket - 1]
+            for i in range(l, r):
+                # other grids may share the same bucket
+                result = self.visit_pair(
+                    index, self.moved_index_sorted[i], location, grid_3d, self.moved_grid_3d[i],
+                    call_func, result, cutoff, only_greater, True
+                )
+        return result
+
+    # other_grid_3d is the grid other was put in when the index was built, the particles may
+    # have moved since then, e.g. in the iterations of pbf, so it is not computed from the location
+    @ti.func
+    def visit_pair(
+        self, index: int, other_index: int, location: ti.math.vec3, grid_3d: ti.math.ivec3, # type: ignore
+        other_grid_3d: ti.math.ivec3, # type: ignore
+        call_func: ti.template(), result: ti.template(), cutoff: float, # type: ignore
+        only_greater: ti.template(), check_grid: ti.template() # type: ignore
+    ):
+        visit = True
+        if ti.static(only_greater):
+            visit = other_index > index
+        if visit:
+            other_location = self.parent.particles[other_index].location
+            r_to_center = location - other_location
+            distance = r_to_center.norm()
+            if distance < cutoff:
+                if ti.static(check_grid):
+                    # other grids may share the same slot
+                    if (other_grid_3d == grid_3d).all():
+                        result += call_func(index, other_index, r_to_center, distance)
+                else:
+                    result += call_func(index, other_index, r_to_center, distance)
+        return result
@@ -1,13 +1,29 @@
 import taichi as ti
 
+# these attributes are recomputed every step,
+# so they can be stored as f16 and only computed as f32
+cold_attributes = ("pressure", "forces", "pressure_forces")
+
+# extra_attributes are added by the solvers for the values kept across steps,
+# they are reordered with the other attributes, e.g. {"kappa": ti.f32}
+def make_particle(half_precision_attributes: tuple = (), extra_attributes: dict = {}):
+    def precision(attribute: str):
+        return ti.f16 if attribute in half_precision_attributes else ti.f32
+
+    return ti.types.struct(
+        id = ti.int32,
+        origin_id = ti.int32, # index in the scene order, kept across reorders
+        grid_id = ti.int32,
+        scene_id = ti.int32, # the scene of the ensemble
+        alive = ti.int32, # 0 after retired by a sink, until the slot is reused or compacted
+        location = ti.math.vec3,
+        density = ti.f32,
+        pressure = precision("pressure"),
+        forces = ti.types.vector(3, precision("forces")),
+        pressure_forces = ti.types.vector(3, precision("pressure_forces")),
+        velocity = ti.math.vec3,
+        **extra_attributes
+    )
+
 # @ti.dataclass
-Particle = ti.types.struct(
-    id = ti.int32,
-    grid_id = ti.int32,
-    location = ti.math.vec3,
-    density = ti.f32,
-    pressure = ti.f32,
-    forces = ti.math.vec3,
-    pressure_forces = ti.math.vec3,
-    velocity = ti.math.vec3
-)
\ No newline at end of file
+Particle = make_particle()
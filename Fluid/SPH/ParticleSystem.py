@@ -1,42 +1,192 @@
 import taichi as ti
+import numpy as np
+import math
 
 from Fluid._basic import *
-from Fluid.SPH.Particle import Particle
+from Fluid.SPH.Particle import Particle, make_particle, cold_attributes
 from Fluid.SPH.NeighborhoodSearcher import NeighborhoodSearcher
+from Fluid.SPH.PrefixSum import PrefixSum
+from Fluid.SPH.RigidBoundary import RigidBoundary
+from Fluid.SPH.RigidSDF import RigidSDF
+
+# the candidate axes of a split, the 3 axes, the 6 diagonals of the faces and the 4 diagonals of the cube
+split_axes = tuple(
+    tuple(x / math.hypot(*axis) for x in axis)
+    for axis in (
+        (1, 0, 0), (0, 1, 0), (0, 0, 1),
+        (1, 1, 0), (1, -1, 0), (1, 0, 1), (1, 0, -1), (0, 1, 1), (0, 1, -1),
+        (1, 1, 1), (1, 1, -1), (1, -1, 1), (1, -1, -1)
+    )
+)
+SplitDensity = ti.types.vector(len(split_axes), ti.f32)
 
 @ti.data_oriented
 class ParticleSystem:
     def __init__(self):
-        self.particles_cnt = 0
+        # the particles in [0, active_cnt) are simulated, the slots after them are free
+        self.particles_capacity = 0
+        self.active_cnt = None
         self.particles = None
+        self.particle_type = Particle
+        self.half_precision_attributes = tuple()
+        # how many stores of the f16 attributes were clamped to the range of f16
+        self.half_precision_clamp_cnt = None
+        # the scalar attributes of the solvers, set before malloc_memory
+        self.extra_attributes = dict()
+        self.particles_buffer = None # only used when reordering
         self.id_to_index = None # TODO
+        # slots retired by sinks, reused by emitters and compacted by the next rebuild
+        self.free_slots = None
+        self.free_cnt = None
+        self.next_origin_id = None
+        self.emit_overflow_cnt = None
+        self.emitters = list()
+        self.sinks = list()
+        self.has_sinks = False
+        # particles can be retired, by sinks or by merging, and are compacted by the rebuilds
+        self.retires_particles = False
+        self.particles_changed = False
+        # the steps can be launched steps_per_launch at a time, see advance_steps
+        self.supports_fused_steps = True
+        # adaptive resolution, a particle of level l has 2^l times the mass
+        # and 2^(l/3) times the support of a particle of the scene
+        self.supports_adaptive_resolution = True
+        self.adaptive_resolution = False
+        self.max_level = 0
+        self.adaptive_band = 0.0
+        self.surface_threshold = 0.0
+        # a particle is only merged after this many updates of the resolution at its level
+        self.min_level_age = 0
+        self.surface_distance_buffer = None
+        self.split_direction = None
+        self.merge_partner = None
+        self.merge_partner_distance = None
+        self.merge_accepted = None
+        self.split_overflow_cnt = None
+        # the particles calm for sleep_steps steps fall asleep, they keep their density and pressure,
+        # do not move and are only neighborhoods of the awake particles, until a neighborhood
+        # faster than wake_velocity wakes them, the kernels only loop over the awake particles
+        self.supports_sleeping = True
+        self.sleep_steps = 0
+        self.sleep_velocity = 0.0
+        self.wake_velocity = 0.0
+        self.sleep_density_change = 0.0
+        self.sleep_min_density = 0.0
+        self.awake_cnt = None
+        self.sleeping_cnt = None
+        # every step, one of sleep_steps of the sleeping particles checks its neighborhood
+        self.sleep_check_phase = None
+        # the awake particles in the order of their slots, rebuilt every step, so it is not reordered
+        self.awake_index = None
+        self.awake_offset = None
+        self.awake_prefix_sum = None
+        # the cutoff of the neighborhood searcher, the largest support of all particles
+        self.search_radius = 0.0
+        # the static rigid bodies are sampled with boundary particles in a grid of their own
+        self.supports_rigid_bodies = True
+        self.has_rigid_bodies = False
+        self.rigid_boundary = RigidBoundary(self)
+        # or the particles are pushed out of the signed distance grids of the rigid bodies
+        self.has_rigid_sdf = False
+        self.rigid_sdf = RigidSDF(self)
+        # the scenes of an ensemble are placed side by side, every scene has its own
+        # offset, domain, gravitation and viscosity coefficient
+        self.scenes_cnt = 1
+        self.scene_offsets = [[0.0, 0.0, 0.0]]
+        self.scene_domain_start = None
+        self.scene_domain_end = None
+        self.scene_gravitation = None
+        self.scene_viscosity_coefficient = None
         self.neighborhood_searcher = NeighborhoodSearcher(self)
 
     def __del__(self):
         ...
 
     @ti.kernel
-    def init_memory(self):
-        for idx in range(self.particles_cnt):
+    def init_memory(self, particles_cnt: int):
+        for idx in range(self.particles_capacity):
             self.particles[idx].id = ti.int32(idx)
+            self.particles[idx].origin_id = ti.int32(idx)
+            self.particles[idx].alive = 1
+            self.particles[idx].scene_id = 0
             self.id_to_index[idx] = ti.int32(idx)
+        self.active_cnt[None] = particles_cnt
+        self.free_cnt[None] = 0
+        self.next_origin_id[None] = particles_cnt
+        self.emit_overflow_cnt[None] = 0
+
+    # layout "aos" keeps all attributes of one particle together,
+    # "soa" keeps every attribute in its own field
+    # memory for particles_capacity particles is allocated, so emitters can add particles later
+    def malloc_memory(
+        self, particles_cnt: int, layout: str = "aos",
+        half_precision_attributes: list = [], particles_capacity: int = 0
+    ):
+        self.particles_capacity = max(particles_capacity, particles_cnt)
+        if self.particles_capacity > particles_cnt:
+            log(f"particle capacity is {self.particles_capacity:,}")
+        if not layout in ("aos", "soa"):
+            log(f"{layout} is not a available particle layout, use aos")
+            layout = "aos"
+        self.layout = layout
+        log(f"particle layout is {layout}")
+
+        # the atomics of scatter need full precision
+        half_precision_attributes = [
+            attribute for attribute in half_precision_attributes
+            if attribute in cold_attributes and not (
+                self.use_force_scatter and attribute in ("forces", "pressure_forces")
+            )
+        ]
+        self.half_precision_attributes = tuple(half_precision_attributes)
+        if len(self.half_precision_attributes) > 0:
+            log(f"{', '.join(self.half_precision_attributes)} are stored as f16")
+        self.particle_type = make_particle(self.half_precision_attributes, self.extra_attributes)
+        self.half_precision_clamp_cnt = ti.field(ti.int32, shape=())
 
-    def malloc_memory(self, particles_cnt: int):
-        self.particles_cnt = particles_cnt
-        # self.particles = Particle.field(shape=(particles_cnt,))
-        self.particles = Particle.field()
-        ti.root.dense(ti.i, particles_cnt).place(self.particles)
+        ti_layout = ti.Layout.SOA if layout == "soa" else ti.Layout.AOS
+        self.particles = self.particle_type.field(shape=(self.particles_capacity,), layout=ti_layout)
+        # the retired particles are compacted by reordering
+        if self.neighborhood_searcher.reorder_interval > 0 or self.retires_particles:
+            self.particles_buffer = self.particle_type.field(
+                shape=(self.particles_capacity,), layout=ti_layout
+            )
         self.id_to_index = ti.field(ti.int32)
-        ti.root.dense(ti.i, particles_cnt).place(self.id_to_index)
+        self.free_slots = ti.field(ti.int32)
+        ti.root.dense(ti.i, self.particles_capacity).place(self.id_to_index, self.free_slots)
+        self.active_cnt = ti.field(ti.int32, shape=())
+        self.free_cnt = ti.field(ti.int32, shape=())
+        self.next_origin_id = ti.field(ti.int32, shape=())
+        self.emit_overflow_cnt = ti.field(ti.int32, shape=())
+        if self.adaptive_resolution:
+            # computed in every update of the resolution, so they are not reordered
+            self.surface_distance_buffer = ti.field(ti.f32)
+            self.merge_partner = ti.field(ti.int32)
+            self.merge_partner_distance = ti.field(ti.f32)
+            self.merge_accepted = ti.field(ti.int32)
+            self.split_direction = ti.Vector.field(3, ti.f32)
+            ti.root.dense(ti.i, self.particles_capacity).place(
+                self.surface_distance_buffer, self.merge_partner,
+                self.merge_partner_distance, self.merge_accepted, self.split_direction
+            )
+            self.split_overflow_cnt = ti.field(ti.int32, shape=())
+        if self.sleep_steps > 0:
+            self.awake_index = ti.field(ti.int32)
+            self.awake_offset = ti.field(ti.int32)
+            ti.root.dense(ti.i, self.particles_capacity).place(self.awake_index, self.awake_offset)
+            self.awake_cnt = ti.field(ti.int32, shape=())
+            self.sleeping_cnt = ti.field(ti.int32, shape=())
+            self.sleep_check_phase = ti.field(ti.int32, shape=())
+            self.awake_prefix_sum = PrefixSum(self.particles_capacity)
         # self.particles_location_field = ti.Vector.field(
         #     3, dtype=ti.f32, shape = particles_cnt
         # )
-        self.init_memory()
+        self.init_memory(particles_cnt)
 
     # too slow...
     # the function has been deprecated
     def set_particle_location(self, id: int, location: list):
-        if id < 0 or id >= self.particles_cnt:
+        if id < 0 or id >= self.particles_capacity:
             log("particle id out of range")
             return
         self.particles[id].location = ti.math.vec3(location)
@@ -47,10 +197,12 @@ class ParticleSystem:
         start_x: float, start_y: float, start_z: float,
         cnt_x: int, cnt_y: int, cnt_z: int,
         inited_cnt: int,
-        particle_radius: float
+        particle_radius: float,
+        scene_id: int
     ):
         for i,j,k in ti.ndrange(cnt_x, cnt_y, cnt_z):
             id = inited_cnt + i * cnt_y * cnt_z + j * cnt_z + k
+            self.particles[id].scene_id = scene_id
             self.particles[id].location = ti.math.vec3(
                 start_x + particle_radius * (i * 2 + 1),
                 start_y + particle_radius * (j * 2 + 1),
@@ -66,34 +218,414 @@ class ParticleSystem:
                 *fluid_block["start"],
                 *fluid_block["cnt"],
                 inited_cnt,
-                particle_radius
+                particle_radius,
+                fluid_block.get("scene_id", 0)
             )
             inited_cnt += fluid_block["sum"]
 
+    # emitters spawn a block of particles with the velocity every time the last block
+    # moved out of the emitter, sinks retire the particles in them every step
+    # call once for every scene of the ensemble
+    def init_emitters_and_sinks(
+        self, emitters: list, sinks: list, scene_id: int = 0, offset: list = [0.0, 0.0, 0.0]
+    ):
+        for emitter in emitters:
+            domain_start = [emitter["domain_start"][i] + offset[i] for i in range(3)]
+            domain_end = [emitter["domain_end"][i] + offset[i] for i in range(3)]
+            velocity = emitter["velocity"]
+            cnt_per_axis = [
+                max(math.ceil((domain_end[i] - domain_start[i]) / (self.particle_radius * 2)), 1)
+                for i in range(3)
+            ]
+            axis = max(range(3), key=lambda i: abs(velocity[i]))
+            if velocity[axis] == 0:
+                log("emitter without velocity is ignored")
+                continue
+            thickness = cnt_per_axis[axis] * self.particle_radius * 2
+            self.emitters.append({
+                "scene_id": scene_id,
+                "start": domain_start,
+                "cnt": cnt_per_axis,
+                "velocity": velocity,
+                "speed": abs(velocity[axis]),
+                "thickness": thickness,
+                "start_time": emitter.get("start_time", 0.0),
+                "end_time": emitter.get("end_time", math.inf),
+                "moved": thickness # the first block is emitted at start_time
+            })
+        self.sinks.extend([
+            (
+                ti.math.vec3(sink["domain_start"]) + ti.math.vec3(offset),
+                ti.math.vec3(sink["domain_end"]) + ti.math.vec3(offset)
+            )
+            for sink in sinks
+        ])
+        self.has_sinks = len(self.sinks) > 0
+        if self.has_sinks:
+            self.retires_particles = True
+        if len(emitters) > 0 or len(sinks) > 0:
+            log(f"{len(emitters)} emitters and {len(sinks)} sinks")
+
+    # slots retired in this step are reused first, then the slots after active_cnt
+    @ti.kernel
+    def emit_particles_of_one_block(
+        self,
+        start_x: float, start_y: float, start_z: float,
+        cnt_x: int, cnt_y: int, cnt_z: int,
+        velocity_x: float, velocity_y: float, velocity_z: float,
+        elapsed_time: float,
+        scene_id: int
+    ):
+        velocity = ti.math.vec3(velocity_x, velocity_y, velocity_z)
+        for i,j,k in ti.ndrange(cnt_x, cnt_y, cnt_z):
+            slot = -1
+            free_id = ti.atomic_sub(self.free_cnt[None], 1) - 1
+            if free_id >= 0:
+                slot = self.free_slots[free_id]
+            else:
+                tail = ti.atomic_add(self.active_cnt[None], 1)
+                if tail < self.particles_capacity:
+                    slot = tail
+
+            if slot >= 0:
+                self.particles[slot].location = ti.math.vec3(
+                    start_x + self.particle_radius * (i * 2 + 1),
+                    start_y + self.particle_radius * (j * 2 + 1),
+                    start_z + self.particle_radius * (k * 2 + 1)
+                ) + velocity * elapsed_time
+                self.particles[slot].velocity = velocity
+                self.particles[slot].density = self.density
+                self.particles[slot].alive = 1
+                self.particles[slot].scene_id = scene_id
+                self.particles[slot].origin_id = ti.atomic_add(self.next_origin_id[None], 1)
+                for name in ti.static(tuple(self.extra_attributes)):
+                    ti.static(getattr(self.particles, name))[slot] = 0.0
+            else:
+                ti.atomic_add(self.emit_overflow_cnt[None], 1)
+        # undo the overshoot of the counters
+        self.free_cnt[None] = ti.max(self.free_cnt[None], 0)
+        self.active_cnt[None] = ti.min(self.active_cnt[None], self.particles_capacity)
+
+    @ti.kernel
+    def retire_particles_in_sinks(self) -> int:
+        retired_cnt = 0
+        for i in range(self.active_cnt[None]):
+            location = self.particles[i].location
+            in_sink = False
+            for sink in ti.static(self.sinks):
+                if (sink[0] <= location).all() and (location <= sink[1]).all():
+                    in_sink = True
+            if in_sink and self.particles[i].alive != 0:
+                self.particles[i].alive = 0
+                self.free_slots[ti.atomic_add(self.free_cnt[None], 1)] = i
+                retired_cnt += 1
+        return retired_cnt
+
+    # call before updating the search index, the index is rebuilt if any particle was added or retired
+    def emit_and_retire_particles(self, time: float, time_step: float):
+        if self.has_sinks and self.retire_particles_in_sinks() > 0:
+            self.particles_changed = True
+        for emitter in self.emitters:
+            if not emitter["start_time"] <= time < emitter["end_time"]:
+                continue
+            while emitter["moved"] >= emitter["thickness"]:
+                emitter["moved"] -= emitter["thickness"]
+                self.emit_particles_of_one_block(
+                    *emitter["start"],
+                    *emitter["cnt"],
+                    *emitter["velocity"],
+                    emitter["moved"] / emitter["speed"],
+                    emitter["scene_id"]
+                )
+                self.particles_changed = True
+            emitter["moved"] += emitter["speed"] * time_step
+
+    # the walls of the domain are the only obstacles
+    @ti.func
+    def get_obstacle_distance(self, index: int) -> float:
+        location = self.particles[index].location
+        domain_start, domain_end = self.get_domain(index)
+        return ti.min((location - domain_start).min(), (domain_end - location).min())
+
+    # returns the weighted mass and the weighted offset of the mass of the pair,
+    # weighted with the largest support for every pair, the pair supports sample the coarse
+    # particles around a fine particle too sparsely and find a surface deep in the fluid
+    @ti.func
+    def relax_surface_distance(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec4: # type: ignore
+        weight = self.get_mass(other_index) * kernel_func_b(
+            distance * ti.static(self.kernel_func_h / self.search_radius)
+        )
+        if other_index != self_index:
+            self.surface_distance_buffer[self_index] = ti.min(
+                self.surface_distance_buffer[self_index],
+                self.particles[other_index].surface_distance + distance
+            )
+        offset = -weight * r_to_center
+        return ti.math.vec4(offset.x, offset.y, offset.z, weight)
+
+    @ti.func
+    def relax_boundary_distance(
+        self, self_index: int, boundary_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        self.surface_distance_buffer[self_index] = ti.min(
+            self.surface_distance_buffer[self_index], distance
+        )
+        return 0
+
+    # the particles on the surface are 0 away from it, the others take the shortest path
+    # over their neighborhoods, so the distance follows the surface by one neighborhood per update
+    # the center of the mass of a neighborhood is off the particle by about 0.12 of the weighting support
+    # on the surface and by less than 0.04 inside of the fluid, merging two particles
+    # in the middle of both keeps the center of their mass
+    @ti.kernel
+    def update_surface_distance(self):
+        for i in range(self.active_cnt[None]):
+            self.surface_distance_buffer[i] = self.get_obstacle_distance(i)
+            if ti.static(self.has_rigid_bodies):
+                self.rigid_boundary.sum_over_boundary(
+                    i, self.particles[i].location, self.relax_boundary_distance, 0, self.search_radius
+                )
+            if ti.static(self.has_rigid_sdf):
+                for body in ti.static(range(self.rigid_sdf.bodies_cnt)):
+                    distance, _ = self.rigid_sdf.sample(body, self.particles[i].location)
+                    self.surface_distance_buffer[i] = ti.min(
+                        self.surface_distance_buffer[i], ti.max(distance, 0.0)
+                    )
+            moments = self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.relax_surface_distance, ti.math.vec4(0.0)
+            )
+            center_offset = moments.xyz.norm() / ti.max(moments.w, eps)
+            if center_offset > self.surface_threshold * self.search_radius:
+                self.surface_distance_buffer[i] = 0.0
+        for i in range(self.active_cnt[None]):
+            self.particles[i].surface_distance = self.surface_distance_buffer[i]
+
+    # the particles are merged one band deeper than they are split again, so the noise
+    # of the distance does not merge and split the same particles over and over
+    @ti.func
+    def can_merge(self, index: int) -> bool:
+        level = self.particles[index].level
+        return (
+            level < self.max_level
+            and self.particles[index].level_age >= self.min_level_age
+            and self.particles[index].surface_distance >= (level + 2) * self.adaptive_band
+        )
+
+    @ti.func
+    def can_split(self, index: int) -> bool:
+        level = self.particles[index].level
+        return (
+            self.particles[index].alive != 0 and level > 0
+            and self.particles[index].surface_distance < level * self.adaptive_band
+        )
+
+    @ti.func
+    def find_merge_partner(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        if (
+            other_index != self_index
+            and self.particles[other_index].level == self.particles[self_index].level
+            and distance < self.merge_partner_distance[self_index]
+            and self.can_merge(other_index)
+        ):
+            self.merge_partner[self_index] = other_index
+            self.merge_partner_distance[self_index] = distance
+        return 0
+
+    # the smaller index of two particles which are the nearest of each other
+    @ti.func
+    def is_merge_leader(self, index: int) -> bool:
+        partner = self.merge_partner[index]
+        return partner > index and self.merge_partner[partner] == index
+
+    @ti.func
+    def count_merge_conflicts(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        conflict = 0
+        if (
+            other_index < self_index and self.is_merge_leader(other_index)
+            and self.in_pair_support(self_index, other_index, distance)
+        ):
+            conflict = 1
+        return conflict
+
+    # two particles of the same level are merged if they are the nearest of each other,
+    # the merged particle is in the middle of both with the mean velocity, so the momentum is kept
+    # merging the neighbors of a particle at once leaves a hole around it, so only the pair
+    # with the smallest index in every neighborhood is merged, the others wait for the next update
+    # returns how many particles were merged
+    @ti.kernel
+    def merge_particles(self) -> int:
+        for i in range(self.active_cnt[None]):
+            self.particles[i].level_age += 1
+            self.merge_partner[i] = -1
+            if self.can_merge(i):
+                # at most one and a half spacing of the level apart
+                self.merge_partner_distance[i] = self.particle_radius * 3.0 * self.get_support_ratio(i)
+                self.neighborhood_searcher.sum_over_neighborhoods(i, self.find_merge_partner, 0)
+        for i in range(self.active_cnt[None]):
+            self.merge_accepted[i] = 0
+            if self.is_merge_leader(i) and self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.count_merge_conflicts, 0
+            ) == 0:
+                self.merge_accepted[i] = 1
+        merged_cnt = 0
+        for i in range(self.active_cnt[None]):
+            j = self.merge_partner[i]
+            if self.merge_accepted[i] != 0:
+                self.particles[i].location = 0.5 * (self.particles[i].location + self.particles[j].location)
+                self.particles[i].velocity = 0.5 * (self.particles[i].velocity + self.particles[j].velocity)
+                self.particles[i].density = 0.5 * (self.particles[i].density + self.particles[j].density)
+                self.particles[i].level += 1
+                self.particles[i].level_age = 0
+                if ti.static(self.sleep_steps > 0):
+                    self.particles[i].calm_steps = 0
+                self.particles[j].alive = 0
+                self.free_slots[ti.atomic_add(self.free_cnt[None], 1)] = j
+                merged_cnt += 1
+        return merged_cnt
+
+    # the density of the neighborhoods at both children of a split along every candidate axis,
+    # the children have the support of the level below, the merged particles are skipped
+    @ti.func
+    def sum_split_density(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> SplitDensity: # type: ignore
+        result = SplitDensity(0.0)
+        if other_index != self_index and self.particles[other_index].alive != 0:
+            child_ratio = ti.pow(2.0, (self.particles[self_index].level - 1) / 3.0)
+            k = 0.5 * (child_ratio + self.get_support_ratio(other_index))
+            scale = self.get_mass(other_index) / (k * k * k)
+            for axis in ti.static(range(len(split_axes))):
+                offset = self.particle_radius * child_ratio * ti.math.vec3(split_axes[axis])
+                result[axis] = scale * (
+                    kernel_func_b((r_to_center + offset).norm() / k)
+                    + kernel_func_b((r_to_center - offset).norm() / k)
+                )
+        return result
+
+    # a particle of level l is split into two particles of level l - 1, one spacing of
+    # the new level apart along the candidate axis with the lowest density at both of them,
+    # a random axis may push the children into their neighborhoods, which kicks them apart
+    # the axes are chosen before any particle moves, and the new particles are added
+    # after active_cnt, so the loops do not visit them
+    # returns how many particles were split
+    @ti.kernel
+    def split_particles(self) -> int:
+        active_cnt = self.active_cnt[None]
+        for i in range(active_cnt):
+            if self.can_split(i):
+                density = self.neighborhood_searcher.sum_over_neighborhoods(
+                    i, self.sum_split_density, SplitDensity(0.0)
+                )
+                direction = ti.math.vec3(split_axes[0])
+                lowest_density = density[0]
+                for axis in ti.static(range(1, len(split_axes))):
+                    if density[axis] < lowest_density:
+                        direction = ti.math.vec3(split_axes[axis])
+                        lowest_density = density[axis]
+                self.split_direction[i] = direction
+        split_cnt = 0
+        for i in range(active_cnt):
+            level = self.particles[i].level
+            if self.can_split(i):
+                tail = ti.atomic_add(self.active_cnt[None], 1)
+                if tail < self.particles_capacity:
+                    offset = self.particle_radius * ti.pow(2.0, (level - 1) / 3.0) * self.split_direction[i]
+                    self.particles[i].level = level - 1
+                    self.particles[i].level_age = 0
+                    if ti.static(self.sleep_steps > 0):
+                        self.particles[i].calm_steps = 0
+                    self.particles[tail] = self.particles[i]
+                    self.particles[tail].origin_id = ti.atomic_add(self.next_origin_id[None], 1)
+                    self.particles[tail].location += offset
+                    self.particles[i].location -= offset
+                    split_cnt += 1
+                else:
+                    ti.atomic_add(self.split_overflow_cnt[None], 1)
+        # undo the overshoot of the counter
+        self.active_cnt[None] = ti.min(self.active_cnt[None], self.particles_capacity)
+        return split_cnt
+
+    # call before updating the search index, the neighborhoods of the last index are used,
+    # and the index is rebuilt if any particle was merged or split
+    # returns how many particles were merged and split
+    def adapt_resolution(self) -> tuple:
+        if self.neighborhood_searcher.rebuild_cnt[None] == 0:
+            return 0, 0
+        self.update_surface_distance()
+        merged_cnt = self.merge_particles()
+        split_cnt = self.split_particles()
+        if merged_cnt > 0 or split_cnt > 0:
+            self.particles_changed = True
+        return merged_cnt, split_cnt
+
+    # the retired particles were moved after the alive particles by reordering
+    @ti.func
+    def finish_compaction(self):
+        self.active_cnt[None] -= self.free_cnt[None]
+        self.free_cnt[None] = 0
+
+    # the list keeps the scene order (emitted particles after the scene particles)
+    # even if the particles were reordered, only the first scene of an ensemble is exported
     def export_particles_location_to_list(self, location_list: list):
         location_list.clear()
-        for idx in range(self.particles_cnt):
-            location = self.particles[idx].location
-            location_list.append([
-                location.x, location.y, location.z
-            ])
+        location_list.extend(self.export_particles_location_of_every_scene()[0].tolist())
+
+    # one float32 array of shape (n, 3) for every scene of the ensemble, in the coordinates of the scene,
+    # every attribute is copied from the device at once
+    def export_particles_location_of_every_scene(self) -> list:
+        active_cnt = self.active_cnt[None]
+        alive = self.particles.alive.to_numpy()[:active_cnt] != 0
+        location = self.particles.location.to_numpy()[:active_cnt][alive]
+        origin_id = self.particles.origin_id.to_numpy()[:active_cnt][alive]
+        scene_id = self.particles.scene_id.to_numpy()[:active_cnt][alive]
+        order = np.argsort(origin_id)
+        location, scene_id = location[order], scene_id[order]
+        return [
+            location[scene_id == k] - np.array(self.scene_offsets[k], dtype=np.float32)
+            for k in range(self.scenes_cnt)
+        ]
     
     # the function has been deprecated
     @ti.kernel
     def export_particles_location_to_field(self):
-        for idx in range(self.particles_cnt):
+        for idx in range(self.active_cnt[None]):
             self.particles_location_field[idx] = self.particles[idx].location
 
     def init_domain(
         self,
         domain_start: list,
         domain_end: list,
-        grid_width: float
+        grid_width: float,
+        reorder_interval: int = 0,
+        grid_type: str = "dense",
+        particles_cnt: int = 0,
+        neighbor_skin: float = 0.0,
+        max_neighbors: int = 80,
+        pair_cache: bool = False,
+        incremental_rebuild_threshold: float = 0.0
     ):
         self.neighborhood_searcher.init_grids(
             domain_start,
             domain_end,
-            grid_width
+            grid_width,
+            reorder_interval,
+            grid_type,
+            particles_cnt,
+            neighbor_skin,
+            max_neighbors,
+            pair_cache,
+            incremental_rebuild_threshold
         )
         self.domain_start = ti.math.vec3(domain_start)
         self.domain_end = ti.math.vec3(domain_end)
@@ -106,7 +638,8 @@ class ParticleSystem:
         gravitation: list,
         viscosity_coefficient: float,
         time_step: float,
-        kernel_func_h: float
+        kernel_func_h: float,
+        force_traversal: str = "gather"
     ):
         self.particle_radius = particle_radius
         self.particle_mass = particle_mass
@@ -114,60 +647,581 @@ class ParticleSystem:
         self.gravitation = ti.math.vec3(gravitation)
         self.viscosity_coefficient = viscosity_coefficient
         self.time_step = time_step
+        # the physical speed of sound, solvers with artificial compressibility use a smaller one
+        self.speed_of_sound = speed_of_sound
+        # the time step of this step, changed every step with adaptive time step
+        self.dt = ti.field(ti.f32, shape=())
+        self.dt[None] = time_step
         self.kernel_func_h = kernel_func_h
+        self.search_radius = kernel_func_h
+
+        # "gather" visits every pair twice, "scatter" visits every pair once and writes both particles
+        # with atomics, "auto" only scatters on cuda where float atomics are cheap
+        if force_traversal == "auto":
+            force_traversal = "scatter" if ti.lang.impl.current_cfg().arch == ti.cuda else "gather"
+        if not force_traversal in ("gather", "scatter"):
+            log(f"{force_traversal} is not a available force traversal, use gather")
+            force_traversal = "gather"
+        self.use_force_scatter = force_traversal == "scatter"
+        log(f"pressure and viscosity forces are computed by {force_traversal}")
+
+    # the particles deeper than (l + 2) * band under the surface are merged to level l + 1,
+    # up to max_level, after min_level_age updates at level l, and the particles of level l
+    # closer than l * band are split again, the particles with the center of the mass of their
+    # neighborhood more than surface_threshold of their support away are on the surface
+    # call after init_parameters and before init_domain and malloc_memory
+    def init_adaptive_resolution(
+        self, max_level: int, band_ratio: float, surface_threshold: float, min_level_age: int = 8
+    ):
+        if max_level <= 0:
+            return
+        if not self.supports_adaptive_resolution:
+            log("adaptive resolution is not available with this solver")
+            return
+        self.adaptive_resolution = True
+        self.max_level = max_level
+        self.adaptive_band = band_ratio * self.kernel_func_h
+        self.surface_threshold = surface_threshold
+        self.min_level_age = min_level_age
+        self.search_radius = self.kernel_func_h * 2 ** (max_level / 3)
+        self.retires_particles = True
+        self.extra_attributes["level"] = ti.i32
+        self.extra_attributes["surface_distance"] = ti.f32
+        self.extra_attributes["level_age"] = ti.i32
+        log(f"adaptive resolution up to level {max_level}, "
+            f"the levels are {self.adaptive_band:.6g} apart, the largest support is {self.search_radius:.6g}"
+        )
+
+    # a particle is calm in a step if it is slower than sleep_velocity, its density changed
+    # by less than sleep_density_change of the rest density and it has at least sleep_min_density
+    # of the rest density, 0 sleep_steps disables sleeping
+    # wake_velocity is larger than sleep_velocity, otherwise the jitter of the awake particles
+    # keeps waking their sleeping neighborhoods, and the particles on the surface and in the splashes
+    # have too few neighborhoods to fall asleep, otherwise they would stay where they stopped
+    # call after init_parameters and before malloc_memory
+    def init_sleeping(
+        self, sleep_steps: int, sleep_velocity: float, wake_velocity: float,
+        sleep_density_change: float, sleep_min_density: float
+    ):
+        if sleep_steps <= 0:
+            return
+        if not self.supports_sleeping:
+            log("sleeping particles are not available with this solver")
+            return
+        # the half pairs of a sleeping particle would not be scattered to its awake neighborhoods
+        if self.use_force_scatter:
+            log("sleeping particles are not available with scatter")
+            return
+        self.sleep_steps = sleep_steps
+        self.sleep_velocity = sleep_velocity
+        self.wake_velocity = max(wake_velocity, sleep_velocity)
+        self.sleep_density_change = sleep_density_change
+        self.sleep_min_density = sleep_min_density
+        self.extra_attributes["calm_steps"] = ti.i32
+        log(f"particles fall asleep after {sleep_steps} steps slower than {sleep_velocity:.6g}, "
+            f"with density changes below {sleep_density_change:.6g} "
+            f"and densities above {sleep_min_density:.6g} of the rest density, "
+            f"and wake up next to particles faster than {self.wake_velocity:.6g}"
+        )
+
+    # rigid_bodies: obj_file and offset of every rigid body, they are static
+    # "particles" samples the surfaces with boundary particles, they are spaced by the particle radius,
+    # half of the spacing of the fluid, with the spacing of the fluid some particles still slip
+    # through the thin parts
+    # "sdf" pushes the particles out of the signed distance grids of the bodies in the collisions,
+    # sdf_resolution cells along the longest side of every body, the grids are cached in sdf_cache_dir
+    # call after init_domain
+    def init_rigid_bodies(
+        self, rigid_bodies: list, boundary: str = "particles",
+        sdf_resolution: int = 64, sdf_cache_dir: str = "sdf_cache"
+    ):
+        if len(rigid_bodies) == 0:
+            return
+        if boundary == "sdf":
+            bodies_cnt = self.rigid_sdf.build(rigid_bodies, sdf_resolution, sdf_cache_dir)
+            self.has_rigid_sdf = bodies_cnt > 0
+            log(f"{bodies_cnt} rigid bodies collide by signed distance grids, "
+                f"{self.rigid_sdf.computed_cnt} grids were computed, the others were cached"
+            )
+            return
+        if not self.supports_rigid_bodies:
+            log("rigid bodies are not available with this solver")
+            return
+        boundary_cnt = self.rigid_boundary.build(
+            rigid_bodies, self.particle_radius,
+            self.domain_start.to_list(), self.domain_end.to_list(), self.search_radius
+        )
+        self.has_rigid_bodies = boundary_cnt > 0
+        log(f"{len(rigid_bodies)} rigid bodies are sampled with {boundary_cnt:,} boundary particles")
+
+    # scenes: offset, domain_start, domain_end, gravitation and viscosity_coefficient of every scene
+    def init_ensemble(self, scenes: list):
+        self.scenes_cnt = len(scenes)
+        self.scene_offsets = [scene["offset"] for scene in scenes]
+        if self.scenes_cnt <= 1:
+            return
+        log(f"{self.scenes_cnt} scenes are simulated as an ensemble")
+
+        self.scene_domain_start = ti.Vector.field(3, dtype=ti.f32)
+        self.scene_domain_end = ti.Vector.field(3, dtype=ti.f32)
+        self.scene_gravitation = ti.Vector.field(3, dtype=ti.f32)
+        self.scene_viscosity_coefficient = ti.field(ti.f32)
+        ti.root.dense(ti.i, self.scenes_cnt).place(
+            self.scene_domain_start, self.scene_domain_end,
+            self.scene_gravitation, self.scene_viscosity_coefficient
+        )
+        for k, scene in enumerate(scenes):
+            self.scene_domain_start[k] = [
+                scene["domain_start"][i] + scene["offset"][i] for i in range(3)
+            ]
+            self.scene_domain_end[k] = [
+                scene["domain_end"][i] + scene["offset"][i] for i in range(3)
+            ]
+            self.scene_gravitation[k] = scene["gravitation"]
+            self.scene_viscosity_coefficient[k] = scene["viscosity_coefficient"]
+
+    @ti.func
+    def get_gravitation(self, index: int) -> ti.math.vec3: # type: ignore
+        gravitation = ti.math.vec3(self.gravitation)
+        if ti.static(self.scenes_cnt > 1):
+            gravitation = self.scene_gravitation[self.particles[index].scene_id]
+        return gravitation
+
+    @ti.func
+    def get_viscosity_coefficient(self, index: int) -> float:
+        viscosity_coefficient = ti.cast(self.viscosity_coefficient, ti.f32)
+        if ti.static(self.scenes_cnt > 1):
+            viscosity_coefficient = self.scene_viscosity_coefficient[self.particles[index].scene_id]
+        return viscosity_coefficient
+
+    @ti.func
+    def get_domain(self, index: int):
+        domain_start = ti.math.vec3(self.domain_start)
+        domain_end = ti.math.vec3(self.domain_end)
+        if ti.static(self.scenes_cnt > 1):
+            scene_id = self.particles[index].scene_id
+            domain_start = self.scene_domain_start[scene_id]
+            domain_end = self.scene_domain_end[scene_id]
+        return domain_start, domain_end
+
+    @ti.func
+    def get_mass(self, index: int) -> float:
+        mass = self.particle_mass
+        if ti.static(self.adaptive_resolution):
+            mass = self.particle_mass * ti.cast(1 << self.particles[index].level, ti.f32)
+        return mass
+
+    # the support of the particle divided by kernel_func_h
+    @ti.func
+    def get_support_ratio(self, index: int) -> float:
+        ratio = 1.0
+        if ti.static(self.adaptive_resolution):
+            ratio = ti.pow(2.0, self.particles[index].level / 3.0)
+        return ratio
+
+    # the pairs use the mean support of both particles, so the pairs stay symmetric
+    @ti.func
+    def get_pair_support_ratio(self, self_index: int, other_index: int) -> float:
+        return 0.5 * (self.get_support_ratio(self_index) + self.get_support_ratio(other_index))
+
+    @ti.func
+    def in_pair_support(self, self_index: int, other_index: int, distance: float) -> bool:
+        inside = True
+        if ti.static(self.adaptive_resolution):
+            inside = distance < self.kernel_func_h * self.get_pair_support_ratio(self_index, other_index)
+        return inside
+
+    # the kernels of a pair with the support k * h are W(r / k) / k^3,
+    # so the kernels are not compiled again for every support
+    @ti.func
+    def pair_kernel_b(self, self_index: int, other_index: int, distance: float) -> float:
+        result = 0.0
+        if ti.static(self.adaptive_resolution):
+            k = self.get_pair_support_ratio(self_index, other_index)
+            result = kernel_func_b(distance / k) / (k * k * k)
+        else:
+            result = kernel_func_b(distance)
+        return result
+
+    @ti.func
+    def pair_kernel_a_gradient(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        result = ti.math.vec3(0.0)
+        if ti.static(self.adaptive_resolution):
+            k = self.get_pair_support_ratio(self_index, other_index)
+            result = kernel_func_a_gradient_with_distance(r_to_center / k, distance / k) / (k * k * k * k)
+        else:
+            result = kernel_func_a_gradient_with_distance(r_to_center, distance)
+        return result
+
+    @ti.func
+    def pair_kernel_a_viscosity_laplacian(
+        self, self_index: int, other_index: int, distance: float
+    ) -> float:
+        result = 0.0
+        if ti.static(self.adaptive_resolution):
+            k = self.get_pair_support_ratio(self_index, other_index)
+            result = kernel_func_a_viscosity_laplacian(distance / k) / (k * k * k * k * k)
+        else:
+            result = kernel_func_a_viscosity_laplacian(distance)
+        return result
+
+    # the boundary particles have the support of the fluid particle
+    @ti.func
+    def boundary_kernel_b(self, index: int, distance: float) -> float:
+        result = 0.0
+        if ti.static(self.adaptive_resolution):
+            k = self.get_support_ratio(index)
+            result = kernel_func_b(distance / k) / (k * k * k)
+        else:
+            result = kernel_func_b(distance)
+        return result
+
+    @ti.func
+    def boundary_kernel_a_gradient(
+        self, index: int, r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        result = ti.math.vec3(0.0)
+        if ti.static(self.adaptive_resolution):
+            k = self.get_support_ratio(index)
+            result = kernel_func_a_gradient_with_distance(r_to_center / k, distance / k) / (k * k * k * k)
+        else:
+            result = kernel_func_a_gradient_with_distance(r_to_center, distance)
+        return result
+
+    # the pressure of the equation of state is this times (density / rest density)^7 - 1
+    def get_eos_scale(self) -> float:
+        return self.density * self.speed_of_sound * self.speed_of_sound / eos_exponent
+
+    # the pressure is stored in f16 divided by this, the solvers without the equation of state
+    # should override it with a scale of their own pressure
+    def get_pressure_scale(self) -> float:
+        return self.get_eos_scale()
+
+    # the forces are stored in f16 per mass divided by this, so the acceleration of the eos scale
+    # across the support is the largest f16 and gravity stays far above the smallest normal f16
+    def get_acceleration_scale(self) -> float:
+        return self.get_eos_scale() / (self.density * self.kernel_func_h * f16_max)
+
+    # f16 can not hold the forces and pressure of this scale, so the forces are stored per
+    # acceleration scale and the pressure per pressure scale, which is (density / rest density)^7 - 1
+    # for the eos
+    def get_cold_attribute_scale(self, attribute: str) -> float:
+        if attribute == "pressure":
+            return self.get_pressure_scale()
+        return self.particle_mass * self.get_acceleration_scale()
+
+    @ti.func
+    def scale_cold_attribute(self, attribute: ti.template(), value): # type: ignore
+        result = value
+        if ti.static(attribute in self.half_precision_attributes):
+            scale = ti.static(self.get_cold_attribute_scale(attribute))
+            result = ti.math.clamp(value / scale, -f16_max, f16_max)
+        return result
+
+    # the values out of the range of f16 are clamped and counted on the device
+    @ti.func
+    def store_cold_attribute(self, attribute: ti.template(), value): # type: ignore
+        result = self.scale_cold_attribute(attribute, value)
+        if ti.static(attribute in self.half_precision_attributes):
+            max_value = 0.0
+            if ti.static(attribute == "pressure"):
+                max_value = ti.abs(result)
+            else:
+                max_value = ti.abs(result).max()
+            if max_value >= f16_max:
+                ti.atomic_add(self.half_precision_clamp_cnt[None], 1)
+        return result
+
+    @ti.func
+    def load_cold_attribute(self, attribute: ti.template(), value): # type: ignore
+        result = ti.cast(value, ti.f32)
+        if ti.static(attribute in self.half_precision_attributes):
+            scale = ti.static(self.get_cold_attribute_scale(attribute))
+            result *= scale
+        return result
+
+    # the value a store and a load give, without the round trip through memory
+    @ti.func
+    def round_cold_attribute(self, attribute: ti.template(), value): # type: ignore
+        result = value
+        if ti.static(attribute in self.half_precision_attributes):
+            result = self.load_cold_attribute(
+                attribute, ti.cast(self.scale_cold_attribute(attribute, value), ti.f16)
+            )
+        return result
+
+    @ti.func
+    def get_pressure(self, index: int) -> float:
+        return self.load_cold_attribute("pressure", self.particles[index].pressure)
+
+    @ti.func
+    def set_pressure(self, index: int, pressure: float):
+        self.particles[index].pressure = self.store_cold_attribute("pressure", pressure)
+
+    @ti.func
+    def get_forces(self, index: int) -> ti.math.vec3: # type: ignore
+        return self.load_cold_attribute("forces", self.particles[index].forces)
+
+    @ti.func
+    def set_forces(self, index: int, forces: ti.math.vec3): # type: ignore
+        self.particles[index].forces = self.store_cold_attribute("forces", forces)
+
+    @ti.func
+    def get_pressure_forces(self, index: int) -> ti.math.vec3: # type: ignore
+        return self.load_cold_attribute("pressure_forces", self.particles[index].pressure_forces)
+
+    @ti.func
+    def set_pressure_forces(self, index: int, pressure_forces: ti.math.vec3): # type: ignore
+        self.particles[index].pressure_forces = self.store_cold_attribute(
+            "pressure_forces", pressure_forces
+        )
 
     def rebuild_search_index(self):
         self.neighborhood_searcher.rebuild_search_index()
 
+    def update_search_index(self):
+        self.neighborhood_searcher.update_search_index(self.particles_changed)
+        self.particles_changed = False
+
+    @ti.func
+    def is_awake(self, index: int) -> bool:
+        awake = True
+        if ti.static(self.sleep_steps > 0):
+            awake = self.particles[index].calm_steps < self.sleep_steps
+        return awake
+
+    # the loops of the solver run over [0, get_awake_cnt()) and simulate get_awake_index(k),
+    # which are the active particles without sleeping
+    @ti.func
+    def get_awake_cnt(self) -> int:
+        awake_cnt = self.active_cnt[None]
+        if ti.static(self.sleep_steps > 0):
+            awake_cnt = self.awake_cnt[None]
+        return awake_cnt
+
+    @ti.func
+    def get_awake_index(self, k: int) -> int:
+        index = k
+        if ti.static(self.sleep_steps > 0):
+            index = self.awake_index[k]
+        return index
+
+    # call after the density of an awake particle is computed, with its density of the last step,
+    # a particle calm for sleep_steps steps falls asleep at the next update of the sleeping particles
+    @ti.func
+    def update_calm_steps(self, index: int, last_density: float):
+        if ti.static(self.sleep_steps > 0):
+            density = self.particles[index].density
+            if (
+                self.particles[index].velocity.norm() < self.sleep_velocity
+                and ti.abs(density - last_density) < self.sleep_density_change * self.density
+                and density >= self.sleep_min_density * self.density
+            ):
+                self.particles[index].calm_steps += 1
+            else:
+                self.particles[index].calm_steps = 0
+
+    @ti.func
+    def wake_neighborhood(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        if self.in_pair_support(self_index, other_index, distance):
+            self.particles[other_index].calm_steps = 0
+        return 0
+
+    # the particles which fell asleep in the last step stop, and every sleep_steps steps
+    # a sleeping particle sums its density again and wakes up if its neighborhood changed,
+    # e.g. the fluid under it flowed away slower than wake_velocity,
+    # the awake particles faster than wake_velocity wake their neighborhoods,
+    # then the awake particles are compacted into awake_index,
+    # the dead slots stay awake, as they were simulated before
+    # only call at the top level of a kernel, after the search index is updated
+    @ti.func
+    def update_sleeping_particles(self):
+        for i in range(self.active_cnt[None]):
+            if not self.is_awake(i):
+                self.particles[i].velocity = ti.math.vec3(0.0)
+                if (i + self.sleep_check_phase[None]) % self.sleep_steps == 0:
+                    density = self.particle_mass * (
+                        self.neighborhood_searcher.sum_over_neighborhoods(i, self.add_density, 0.0)
+                    )
+                    if ti.static(self.has_rigid_bodies):
+                        density += self.get_boundary_density(i)
+                    if ti.abs(density - self.particles[i].density) >= self.sleep_density_change * self.density:
+                        self.particles[i].calm_steps = 0
+        self.sleep_check_phase[None] = (self.sleep_check_phase[None] + 1) % self.sleep_steps
+        for i in range(self.active_cnt[None]):
+            if self.is_awake(i) and self.particles[i].velocity.norm() >= self.wake_velocity:
+                self.neighborhood_searcher.sum_over_neighborhoods(i, self.wake_neighborhood, 0)
+        self.sleeping_cnt[None] = 0
+        for i in range(self.particles_capacity):
+            self.awake_offset[i] = 0
+            if i < self.active_cnt[None]:
+                if self.is_awake(i):
+                    self.awake_offset[i] = 1
+                elif self.particles[i].alive != 0:
+                    ti.atomic_add(self.sleeping_cnt[None], 1)
+        self.awake_prefix_sum.scan(self.awake_offset)
+        for i in range(self.active_cnt[None]):
+            if self.is_awake(i):
+                self.awake_index[self.awake_offset[i] - 1] = i
+        self.awake_cnt[None] = self.awake_offset[self.particles_capacity - 1]
+
+    @ti.kernel
+    def update_sleeping(self):
+        self.update_sleeping_particles()
+
     @ti.func
-    def add_density(self, self_index: int, other_index: int):
-        distance = ti.math.distance(
-            self.particles[self_index].location,
-            self.particles[other_index].location
+    def add_density(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> float:
+        result = self.pair_kernel_b(self_index, other_index, distance) # poly6
+        if ti.static(self.adaptive_resolution):
+            # the sum is multiplied by particle_mass
+            result *= ti.cast(1 << self.particles[other_index].level, ti.f32)
+        return result
+
+    @ti.func
+    def add_boundary_density(
+        self, self_index: int, boundary_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> float:
+        return self.rigid_boundary.volume[boundary_index] * self.boundary_kernel_b(self_index, distance)
+
+    # the boundary particles have the rest density
+    @ti.func
+    def get_boundary_density(self, index: int) -> float:
+        return self.density * self.rigid_boundary.sum_over_boundary(
+            index, self.particles[index].location, self.add_boundary_density, 0.0, self.search_radius
+        )
+
+    # the sleeping particles keep their density
+    @ti.func
+    def compute_density(self, index: int):
+        last_density = self.particles[index].density
+        self.particles[index].density = self.particle_mass * (
+            self.neighborhood_searcher.sum_over_neighborhoods(index, self.add_density, 0.0)
         )
-        if distance < self.kernel_func_h:
-            self.particles[self_index].density += kernel_func_b(distance) # poly6
+        if ti.static(self.has_rigid_bodies):
+            self.particles[index].density += self.get_boundary_density(index)
+        self.update_calm_steps(index, last_density)
 
     @ti.kernel
     def compute_densities(self):
-        for i in range(self.particles_cnt):
-            self.particles[i].density = 0
-            self.neighborhood_searcher.for_all_neighborhoods(i, self.add_density)
-            self.particles[i].density *= self.particle_mass
+        for k in range(self.get_awake_cnt()):
+            self.compute_density(self.get_awake_index(k))
+
+    # the density of a prototype particle with a full neighborhood divided by the mass,
+    # sampled on the same lattice as the fluid blocks
+    @ti.kernel
+    def compute_prototype_density(self) -> float:
+        spacing = self.particle_radius * 2
+        cnt = ti.static(math.ceil(self.kernel_func_h / (self.particle_radius * 2)))
+        density = 0.0
+        ti.loop_config(serialize=True)
+        for offset in ti.grouped(ti.ndrange(*((-cnt, cnt + 1),) * 3)):
+            density += kernel_func_b((ti.cast(offset, ti.f32) * spacing).norm())
+        return density
+
+    # the gradients of a prototype particle with a full neighborhood,
+    # sampled on the same lattice as the fluid blocks
+    @ti.kernel
+    def compute_prototype_gradients(self) -> ti.math.vec2: # type: ignore
+        spacing = self.particle_radius * 2
+        cnt = ti.static(math.ceil(self.kernel_func_h / (self.particle_radius * 2)))
+        sum_gradient = ti.math.vec3(0.0)
+        sum_gradient_sqr = 0.0
+        ti.loop_config(serialize=True)
+        for offset in ti.grouped(ti.ndrange(*((-cnt, cnt + 1),) * 3)):
+            r_to_center = ti.cast(offset, ti.f32) * spacing
+            distance = r_to_center.norm()
+            if 0.0 < distance < self.kernel_func_h:
+                gradient = kernel_func_a_gradient_with_distance(r_to_center, distance)
+                sum_gradient += gradient
+                sum_gradient_sqr += gradient.dot(gradient)
+        return ti.math.vec2(sum_gradient.dot(sum_gradient), sum_gradient_sqr)
+
+    # self included
+    @ti.kernel
+    def compute_avg_neighborhoods_cnt(self) -> float:
+        total_cnt = 0
+        for i in range(self.active_cnt[None]):
+            total_cnt += self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.count_neighborhoods, 0
+            )
+        return total_cnt / ti.max(self.active_cnt[None], 1)
 
     # too slow...
     @ti.kernel
     def compute_avg_density(self) -> float:
         total_density = 0.0
-        for i in range(self.particles_cnt):
+        for i in range(self.active_cnt[None]):
             ti.atomic_add(total_density, self.particles[i].density)
-        return total_density / self.particles_cnt
+        return total_density / ti.max(self.active_cnt[None], 1)
 
     # TODO: wind forces
     @ti.kernel
     def accumulate_external_forces(self):
-        for i in range(self.particles_cnt):
-            self.particles[i].forces = self.particle_mass * self.gravitation
+        self.fused_external_forces()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_external_forces(self):
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.set_forces(i, self.get_mass(i) * self.get_gravitation(i))
 
     # TODO: check
     @ti.func
-    def add_viscosity_force(self, self_index: int, other_index: int):
-        distance = ti.math.distance(
-            self.particles[self_index].location,
-            self.particles[other_index].location
-        )
-        self.particles[self_index].forces += (
-            (self.particles[other_index].location - self.particles[self_index].location)
-            * self.viscosity_coefficient * self.particle_mass * self.particle_mass
-            * kernel_func_a_second_derivative(distance) # TODO: check
+    def add_viscosity_force(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        return (
+            -r_to_center
+            * self.get_viscosity_coefficient(self_index)
+            * self.get_mass(self_index) * self.get_mass(other_index)
+            * self.pair_kernel_a_viscosity_laplacian(self_index, other_index, distance) # TODO: check
             / self.particles[other_index].density
         )
 
+    # the part of self is returned, the part of other is written directly
+    @ti.func
+    def scatter_viscosity_force(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        part = (
+            -r_to_center
+            * self.get_viscosity_coefficient(self_index)
+            * self.get_mass(self_index) * self.get_mass(other_index)
+            * self.pair_kernel_a_viscosity_laplacian(self_index, other_index, distance) # TODO: check
+        )
+        ti.atomic_sub(self.particles[other_index].forces, part / self.particles[self_index].density)
+        return part / self.particles[other_index].density
+
     # TODO: check
     @ti.kernel
     def accumulate_viscosity_force(self):
-        for i in range(self.particles_cnt):
-            self.neighborhood_searcher.for_all_neighborhoods(i, self.add_viscosity_force)
+        if ti.static(self.use_force_scatter):
+            for i in range(self.active_cnt[None]):
+                ti.atomic_add(
+                    self.particles[i].forces,
+                    self.neighborhood_searcher.sum_over_half_neighborhoods(
+                        i, self.scatter_viscosity_force, ti.math.vec3(0.0)
+                    )
+                )
+        else:
+            for k in range(self.get_awake_cnt()):
+                i = self.get_awake_index(k)
+                self.set_forces(i, self.get_forces(i) + self.neighborhood_searcher.sum_over_neighborhoods(
+                    i, self.add_viscosity_force, ti.math.vec3(0.0)
+                ))
 
     @ti.func
     def compute_pressure_from_eos(self, density: float, eos_scale: float):
@@ -185,104 +1239,383 @@ class ParticleSystem:
     # 当前密度大于目标密度，则压强为正，反之压强为负（看公式）
     @ti.kernel
     def compute_pressure(self):
-        eos_scale = self.density * speed_of_sound * speed_of_sound / eos_exponent
-        for i in range(self.particles_cnt):
-            self.particles[i].pressure = self.compute_pressure_from_eos(
+        self.fused_pressure()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_pressure(self):
+        eos_scale = ti.static(self.get_eos_scale())
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.set_pressure(i, self.compute_pressure_from_eos(
                 self.particles[i].density,
                 eos_scale
-            )
+            ))
 
     # TODO: check
     @ti.func
-    def add_pressure_force(self, self_index: int, other_index: int):
-        if self_index != other_index:
-            # 计算位置差向量
-            r_to_center = self.particles[self_index].location - self.particles[other_index].location
-            distance = ti.math.length(r_to_center)
-            
-            if 0.0 < distance < self.kernel_func_h:  # 避免除零
-                # 计算压力项
-                part_self = self.particles[self_index].pressure / (
-                    self.particles[self_index].density * self.particles[self_index].density
-                )
-                part_other = self.particles[other_index].pressure / (
-                    self.particles[other_index].density * self.particles[other_index].density
+    def add_pressure_force(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        result = ti.math.vec3(0.0)
+        if 0.0 < distance:  # 避免除零, self is skipped too
+            # 计算压力项
+            part_self = self.get_pressure(self_index) / (
+                self.particles[self_index].density * self.particles[self_index].density
+            )
+            part_other = self.get_pressure(other_index) / (
+                self.particles[other_index].density * self.particles[other_index].density
+            )
+
+            # 计算压力梯度力
+            # the gradient of spiky, with the distance from the searcher instead of normalized()
+            result = -(
+                self.get_mass(self_index) * self.get_mass(other_index)
+                * (part_self + part_other)
+                * self.pair_kernel_a_gradient(self_index, other_index, r_to_center, distance)
+            )
+        return result
+
+    @ti.func
+    def add_boundary_pressure_force(
+        self, self_index: int, boundary_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        result = ti.math.vec3(0.0)
+        if 0.0 < distance:
+            result = -self.rigid_boundary.volume[boundary_index] * self.boundary_kernel_a_gradient(
+                self_index, r_to_center, distance
+            )
+        return result
+
+    # the boundary particles mirror the pressure of the fluid particle
+    @ti.func
+    def get_boundary_pressure_force(self, index: int) -> ti.math.vec3: # type: ignore
+        return self.get_boundary_pressure_force_at(
+            index, self.particles[index].location, self.particles[index].density
+        )
+
+    # the same force for another state of the fluid particle, e.g. a predicted one
+    @ti.func
+    def get_boundary_pressure_force_at(
+        self, index: int, location: ti.math.vec3, density: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        return (
+            self.get_mass(index) * self.density * self.get_pressure(index) / (density * density)
+            * self.rigid_boundary.sum_over_boundary(
+                index, location, self.add_boundary_pressure_force,
+                ti.math.vec3(0.0), self.search_radius
+            )
+        )
+
+    # the pressure force is antisymmetric, other gets the negative part of self
+    @ti.func
+    def scatter_pressure_force(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec3: # type: ignore
+        part = self.add_pressure_force(self_index, other_index, r_to_center, distance)
+        ti.atomic_sub(self.particles[other_index].pressure_forces, part)
+        return part
+
+    @ti.kernel
+    def accumulate_pressure_force(self):
+        if ti.static(self.use_force_scatter):
+            for i in range(self.active_cnt[None]):
+                self.particles[i].pressure_forces = ti.math.vec3(0)
+            for i in range(self.active_cnt[None]):
+                ti.atomic_add(
+                    self.particles[i].pressure_forces,
+                    self.neighborhood_searcher.sum_over_half_neighborhoods(
+                        i, self.scatter_pressure_force, ti.math.vec3(0.0)
+                    )
                 )
-                
-                # 计算压力梯度力
-                self.particles[self_index].pressure_forces -= (
-                    self.particle_mass * self.particle_mass
-                    * (part_self + part_other)
-                    * kernel_func_a_gradient(r_to_center)  # 这里直接使用位置差向量计算梯度 spiky
+            for i in range(self.active_cnt[None]):
+                if ti.static(self.has_rigid_bodies):
+                    self.particles[i].pressure_forces += self.get_boundary_pressure_force(i)
+                self.particles[i].forces += self.particles[i].pressure_forces
+        else:
+            for k in range(self.get_awake_cnt()):
+                i = self.get_awake_index(k)
+                pressure_forces = self.neighborhood_searcher.sum_over_neighborhoods(
+                    i, self.add_pressure_force, ti.math.vec3(0.0)
                 )
+                if ti.static(self.has_rigid_bodies):
+                    pressure_forces += self.get_boundary_pressure_force(i)
+                self.set_pressure_forces(i, pressure_forces)
+                self.set_forces(i, self.get_forces(i) + pressure_forces)
 
+    # compute_densities and compute_pressure in one launch
+    # in one pass, fast math folds the particle mass into the density ratio of the eos,
+    # which changes the pressure in the last bits, so the pressure is a second pass
     @ti.kernel
-    def accumulate_pressure_force(self):
-        for i in range(self.particles_cnt):
-            self.particles[i].pressure_forces = ti.math.vec3(0)
-            self.neighborhood_searcher.for_all_neighborhoods(i, self.add_pressure_force)
-            self.particles[i].forces += self.particles[i].pressure_forces
+    def compute_densities_and_pressure(self):
+        self.fused_densities_and_pressure()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_densities_and_pressure(self):
+        eos_scale = ti.static(self.get_eos_scale())
+        for k in range(self.get_awake_cnt()):
+            self.compute_density(self.get_awake_index(k))
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.set_pressure(i, self.compute_pressure_from_eos(self.particles[i].density, eos_scale))
+
+    @ti.func
+    def integrate(self, index: int, forces: ti.math.vec3): # type: ignore
+        self.particles[index].velocity += forces * self.dt[None] / self.get_mass(index)
+        self.particles[index].location += self.particles[index].velocity * self.dt[None]
 
     @ti.kernel
     def time_integration(self):
-        for i in range(self.particles_cnt):
-            self.particles[i].velocity += (
-                self.particles[i].forces * self.time_step / self.particle_mass
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            self.integrate(i, self.get_forces(i))
+
+    # accumulate_external_forces, accumulate_pressure_force, time_integration and
+    # resolve_collision in one launch, the forces are rounded as the separate kernels
+    # store them, so both give the same results
+    # the neighborhoods read the locations without the pair cache, so the forces of all particles
+    # are computed before any particle moves, otherwise every particle is done in one pass
+    @ti.kernel
+    def accumulate_forces_and_integrate(self):
+        self.fused_forces_and_integration()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_forces_and_integration(self):
+        if ti.static(self.use_force_scatter):
+            for i in range(self.active_cnt[None]):
+                self.particles[i].pressure_forces = ti.math.vec3(0)
+            for i in range(self.active_cnt[None]):
+                ti.atomic_add(
+                    self.particles[i].pressure_forces,
+                    self.neighborhood_searcher.sum_over_half_neighborhoods(
+                        i, self.scatter_pressure_force, ti.math.vec3(0.0)
+                    )
+                )
+            for i in range(self.active_cnt[None]):
+                if ti.static(self.has_rigid_bodies):
+                    self.particles[i].pressure_forces += self.get_boundary_pressure_force(i)
+                forces = (
+                    self.round_cold_attribute("forces", self.get_mass(i) * self.get_gravitation(i))
+                    + self.particles[i].pressure_forces
+                )
+                self.particles[i].forces = forces
+                self.integrate(i, forces)
+                if ti.static(self.has_rigid_sdf):
+                    self.collide_with_rigid_bodies(i)
+                self.collide_with_domain(i)
+        else:
+            for k in range(self.get_awake_cnt()):
+                i = self.get_awake_index(k)
+                pressure_forces = self.neighborhood_searcher.sum_over_neighborhoods(
+                    i, self.add_pressure_force, ti.math.vec3(0.0)
+                )
+                if ti.static(self.has_rigid_bodies):
+                    pressure_forces += self.get_boundary_pressure_force(i)
+                self.set_pressure_forces(i, pressure_forces)
+                forces = self.round_cold_attribute(
+                    "forces",
+                    self.round_cold_attribute("forces", self.get_mass(i) * self.get_gravitation(i))
+                    + pressure_forces
+                )
+                self.set_forces(i, forces)
+                if ti.static(self.neighborhood_searcher.use_pair_cache):
+                    self.integrate(i, forces)
+                    if ti.static(self.has_rigid_sdf):
+                        self.collide_with_rigid_bodies(i)
+                    self.collide_with_domain(i)
+            if ti.static(not self.neighborhood_searcher.use_pair_cache):
+                for k in range(self.get_awake_cnt()):
+                    i = self.get_awake_index(k)
+                    self.integrate(i, self.get_forces(i))
+                    if ti.static(self.has_rigid_sdf):
+                        self.collide_with_rigid_bodies(i)
+                    self.collide_with_domain(i)
+
+    # the part of a step before the search index is updated,
+    # subclasses which launch steps together and move the particles first should override this
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_prediction(self):
+        pass
+
+    # the part of a step after the search index is updated, subclasses override this
+    # with the stages of their step, or set supports_fused_steps to False
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_solve(self):
+        self.fused_densities_and_pressure()
+        self.fused_forces_and_integration()
+
+    # steps_cnt steps in one launch, the search index is updated on the device,
+    # the steps are unrolled, so their loops stay at the top level and run in parallel,
+    # one after another, force_rebuild only applies to the first step
+    @ti.kernel
+    def advance_steps_kernel(self, steps_cnt: ti.template(), force_rebuild: int):
+        for k in ti.static(range(steps_cnt)):
+            self.fused_prediction()
+            self.neighborhood_searcher.update_search_index_on_device(
+                force_rebuild if ti.static(k == 0) else 0
+            )
+            if ti.static(self.sleep_steps > 0):
+                self.update_sleeping_particles()
+            self.fused_solve()
+
+    # the host does not wait for the device between the steps,
+    # so nothing may need the host between them, e.g. emitters or an adaptive time step
+    def advance_steps(self, steps_cnt: int):
+        self.neighborhood_searcher.alloc_pairs()
+        self.advance_steps_kernel(steps_cnt, 1 if self.particles_changed else 0)
+        self.particles_changed = False
+
+    # subclasses with other forces should override this
+    @ti.func
+    def get_acceleration(self, index: int) -> ti.math.vec3: # type: ignore
+        return self.get_forces(index) / self.get_mass(index)
+
+    # the speed information travels with, the sound speed is added by compressible solvers
+    @ti.func
+    def get_signal_speed(self, max_speed: float) -> float:
+        return max_speed
+
+    # the cfl condition of the velocity and the acceleration of the last step,
+    # clamped to [min_time_step, max_time_step] and then to the time left to the next frame
+    @ti.kernel
+    def compute_time_step(
+        self, cfl_number: float, min_time_step: float, max_time_step: float, time_to_frame: float
+    ) -> float:
+        max_speed_sqr = 0.0
+        max_acceleration_sqr = 0.0
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            velocity = self.particles[i].velocity
+            acceleration = self.get_acceleration(i)
+            ti.atomic_max(max_speed_sqr, velocity.dot(velocity))
+            ti.atomic_max(max_acceleration_sqr, acceleration.dot(acceleration))
+
+        time_step = max_time_step
+        signal_speed = self.get_signal_speed(ti.sqrt(max_speed_sqr))
+        if signal_speed > 0.0:
+            time_step = ti.min(time_step, cfl_number * self.kernel_func_h / signal_speed)
+        if max_acceleration_sqr > 0.0:
+            time_step = ti.min(
+                time_step, cfl_number * ti.sqrt(self.kernel_func_h / ti.sqrt(max_acceleration_sqr))
             )
-            self.particles[i].location += self.particles[i].velocity * self.time_step
+        time_step = ti.max(time_step, min_time_step)
+        # land on the frame, without a tiny step before it
+        if time_step >= time_to_frame:
+            time_step = time_to_frame
+        elif time_step * 2.0 > time_to_frame:
+            time_step = time_to_frame * 0.5
+        self.dt[None] = time_step
+        return time_step
 
     # TODO: is this right?
+    @ti.func
+    def collide_with_domain(self, index: int):
+        location = self.particles[index].location
+        domain_start, domain_end = self.get_domain(index)
+        if (
+            location.x < domain_start.x
+            or location.x > domain_end.x
+            or location.y < domain_start.y
+            or location.y > domain_end.y
+            or location.z < domain_start.z
+            or location.z > domain_end.z
+        ):
+            self.particles[index].velocity *= -0.5
+            self.particles[index].location = ti.math.clamp(
+                location, domain_start, domain_end
+            )
+
+    # the locations closer than the particle radius to a rigid body are pushed out along the gradient
+    # of its signed distance, returns the location and the normal of the last contact
+    @ti.func
+    def push_out_of_rigid_bodies(self, location: ti.math.vec3): # type: ignore
+        result = location
+        normal = ti.math.vec3(0.0)
+        for body in ti.static(range(self.rigid_sdf.bodies_cnt)):
+            distance, gradient = self.rigid_sdf.sample(body, result)
+            gradient_norm = gradient.norm()
+            if distance < self.particle_radius and gradient_norm > eps:
+                normal = gradient / gradient_norm
+                result += (self.particle_radius - distance) * normal
+        return result, normal
+
+    # the velocity into the body is reflected with half of its speed, as the walls of the domain do,
+    # the walls are applied after the rigid bodies, so no particle is pushed out of the domain
+    @ti.func
+    def collide_with_rigid_bodies(self, index: int):
+        location, normal = self.push_out_of_rigid_bodies(self.particles[index].location)
+        self.particles[index].location = location
+        normal_speed = self.particles[index].velocity.dot(normal)
+        if normal_speed < 0.0:
+            self.particles[index].velocity -= 1.5 * normal_speed * normal
+
     @ti.kernel
     def resolve_collision(self):
-        for i in range(self.particles_cnt):
-            location = self.particles[i].location
-            if (
-                location.x < self.domain_start.x
-                or location.x > self.domain_end.x
-                or location.y < self.domain_start.y
-                or location.y > self.domain_end.y
-                or location.z < self.domain_start.z
-                or location.z > self.domain_end.z
-            ):
-                self.particles[i].velocity *= -0.5
-                self.particles[i].location = ti.math.clamp(
-                    location, self.domain_start, self.domain_end
-                )
+        self.fused_collision()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_collision(self):
+        for k in range(self.get_awake_cnt()):
+            i = self.get_awake_index(k)
+            if ti.static(self.has_rigid_sdf):
+                self.collide_with_rigid_bodies(i)
+            self.collide_with_domain(i)
     
     @ti.func
-    def count_neighborhoods(self, self_index: int, other_index: int):
-        distance = ti.math.distance(
-            self.particles[self_index].location,
-            self.particles[other_index].location
-        )
-        if distance < self.kernel_func_h:
-            self.neighborhood_cnt[self_index] += 1
+    def count_neighborhoods(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> int:
+        return 1 if self.in_pair_support(self_index, other_index, distance) else 0
 
+    # check the searcher against brute force for the sampled particles
     @ti.kernel
-    def run_neighborhood_search_debug_kernel(self):
-        for i in range(self.particles_cnt):
-            self.neighborhood_cnt[i] = 0
-            self.neighborhood_searcher.for_all_neighborhoods(
-                i, self.count_neighborhoods
+    def validate_neighborhood_search_kernel(self, samples_cnt: int):
+        for k in range(samples_cnt):
+            i = self.validate_index[k]
+            found_cnt = self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.count_neighborhoods, 0
             )
-            for j in range(self.particles_cnt):
-                distance = ti.math.distance(
-                    self.particles[i].location,
-                    self.particles[j].location
-                )
-                if distance < self.kernel_func_h:
-                    self.neighborhood_cnt[i] -= 1
-
-    def run_neighborhood_search_debug(self):
-        self.neighborhood_cnt = ti.field(ti.int32)
-        ti.root.dense(ti.i, self.particles_cnt).place(self.neighborhood_cnt)
-        self.run_neighborhood_search_debug_kernel()
-
-        found_error = 0
-        for i in range(self.particles_cnt):
-            if self.neighborhood_cnt[i] != 0:
-                found_error += 1
-        if found_error == 0:
-            log("neighborhood search is correct")
+            expected_cnt = 0
+            for j in range(self.active_cnt[None]):
+                distance = (self.particles[i].location - self.particles[j].location).norm()
+                if distance < self.search_radius and self.in_pair_support(i, j, distance):
+                    expected_cnt += 1
+            self.validate_error[k] = found_cnt - expected_cnt
+
+    # samples_cnt <= 0 checks every particle
+    def init_neighborhood_validator(self, samples_cnt: int):
+        if samples_cnt <= 0 or samples_cnt > self.particles_capacity:
+            samples_cnt = self.particles_capacity
+        self.validate_samples_cnt = samples_cnt
+        self.validate_index = ti.field(ti.int32)
+        self.validate_error = ti.field(ti.int32)
+        ti.root.dense(ti.i, samples_cnt).place(self.validate_index, self.validate_error)
+        self.validate_rng = np.random.default_rng()
+
+    # returns the sampled particles with wrong neighborhoods and how many neighborhoods are wrong
+    def validate_neighborhood_search(self) -> tuple:
+        active_cnt = self.active_cnt[None]
+        samples_cnt = min(self.validate_samples_cnt, active_cnt)
+        samples = np.zeros(self.validate_samples_cnt, dtype=np.int32)
+        if samples_cnt == active_cnt:
+            samples[:samples_cnt] = np.arange(active_cnt, dtype=np.int32)
         else:
-            log("neighborhood search is incorrect")
+            samples[:samples_cnt] = self.validate_rng.choice(
+                active_cnt, samples_cnt, replace=False
+            )
+        self.validate_index.from_numpy(samples)
+        self.validate_neighborhood_search_kernel(samples_cnt)
+
+        samples = samples[:samples_cnt]
+        error = self.validate_error.to_numpy()[:samples_cnt]
+        wrong = np.nonzero(error)[0]
+        return samples[wrong], error[wrong]
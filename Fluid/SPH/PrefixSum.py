@@ -0,0 +1,41 @@
+import taichi as ti
+import math
+
+# inclusive prefix sum of a int32 field in 3 passes, the blocks are summed in parallel,
+# then the sums of the blocks in serial, then every block adds the sums of the blocks before it
+# the blocks are about sqrt(length) long, so both serial parts are short
+# replaces ti.algorithms.PrefixSumExecutor, which only runs on some archs,
+# and scan is a func, so it can be a part of a larger kernel
+@ti.data_oriented
+class PrefixSum:
+    def __init__(self, length: int):
+        self.length = max(length, 1)
+        self.block_size = max(math.isqrt(self.length), 1)
+        self.blocks_cnt = math.ceil(self.length / self.block_size)
+        self.block_sum = ti.field(ti.int32, shape=self.blocks_cnt)
+
+    # only call at the top level of a kernel, every pass is a top level loop
+    @ti.func
+    def scan(self, values: ti.template()):
+        self.scan_if(values, 1)
+
+    # the passes are empty unless enabled is 1, a branch around them would run them in serial
+    @ti.func
+    def scan_if(self, values: ti.template(), enabled: int):
+        for block in range(self.blocks_cnt * enabled):
+            start = block * self.block_size
+            end = ti.min(start + self.block_size, self.length)
+            block_sum = 0
+            for i in range(start, end):
+                block_sum += values[i]
+                values[i] = block_sum
+            self.block_sum[block] = block_sum
+        ti.loop_config(serialize=True)
+        for block in range(1, self.blocks_cnt * enabled):
+            self.block_sum[block] += self.block_sum[block - 1]
+        for i in range(self.block_size, self.length * enabled):
+            values[i] += self.block_sum[i // self.block_size - 1]
+
+    @ti.kernel
+    def run(self, values: ti.template()):
+        self.scan(values)
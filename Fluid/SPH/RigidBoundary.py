@@ -0,0 +1,178 @@
+import taichi as ti
+import numpy as np
+import math
+
+from Fluid._basic import *
+
+# the vertices and the triangles of an obj file, only "v" and "f" are read,
+# the polygons are split into fans of triangles
+def load_obj(obj_file: str) -> tuple:
+    vertices = list()
+    triangles = list()
+    try:
+        with open(obj_file, "r") as file:
+            for line in file:
+                items = line.split()
+                if len(items) == 0:
+                    continue
+                if items[0] == "v":
+                    vertices.append([float(item) for item in items[1:4]])
+                elif items[0] == "f":
+                    # "f 1/1/1 2/2/2 3/3/3", the indices start from 1, the negative ones count from the end
+                    face = [int(item.split("/")[0]) for item in items[1:]]
+                    face = [k - 1 if k > 0 else len(vertices) + k for k in face]
+                    for k in range(1, len(face) - 1):
+                        triangles.append([face[0], face[k], face[k + 1]])
+    except FileNotFoundError:
+        log(f"{obj_file} is not a available obj file")
+        return None
+    except Exception as error:
+        log(f"{obj_file} load failed:", str(error))
+        return None
+
+    return (
+        np.array(vertices, dtype=np.float64).reshape(-1, 3),
+        np.array(triangles, dtype=np.int64).reshape(-1, 3)
+    )
+
+# the triangles are sampled on a barycentric lattice of half the spacing, then one sample is kept
+# in every cube of the spacing, the volumes of the boundary particles correct the uneven sampling
+def sample_triangles(vertices: np.ndarray, triangles: np.ndarray, spacing: float) -> np.ndarray:
+    corners = vertices[triangles]
+    edges = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2).max(axis=1)
+    divisions = np.maximum(np.ceil(edges / (spacing * 0.5)).astype(np.int64), 1)
+    samples = list()
+    # the triangles with the same divisions are sampled together
+    for n in np.unique(divisions):
+        group = corners[divisions == n]
+        u, v = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing="ij")
+        inside = u + v <= n
+        u, v = u[inside] / n, v[inside] / n
+        weights = np.stack([1.0 - u - v, u, v], axis=1)
+        samples.append(np.einsum("kc,tcx->tkx", weights, group).reshape(-1, 3))
+    if len(samples) == 0:
+        return np.zeros((0, 3))
+    samples = np.concatenate(samples)
+    cells = np.floor(samples / spacing).astype(np.int64)
+    _, first = np.unique(cells, axis=0, return_index=True)
+    return samples[np.sort(first)]
+
+# the static rigid bodies are sampled with boundary particles, which have the rest density
+# and a volume from their own neighborhoods, Akinci et al. 2012
+# https://cg.informatik.uni-freiburg.de/publications/2012_SIGGRAPH_rigidFluidCoupling.pdf
+# the boundary particles never move, so their grid is built once and never sorted again
+@ti.data_oriented
+class RigidBoundary:
+    def __init__(self, parent):
+        self.parent = parent
+        self.boundary_cnt = 0
+        self.location = None
+        self.volume = None
+        # the boundary particles of grid k are in [grid_end[k - 1], grid_end[k])
+        self.grid_start = ti.math.vec3(0)
+        self.grid_width = 0.1
+        self.grid_cnt_per_axis = ti.math.ivec3(1)
+        self.grid_end = None
+
+    def __del__(self):
+        ...
+
+    # rigid_bodies: obj_file and offset of every rigid body, returns the count of boundary particles
+    # the boundary particles further than grid_width from the domain never meet a fluid particle
+    def build(
+        self, rigid_bodies: list, spacing: float,
+        domain_start: list, domain_end: list, grid_width: float
+    ) -> int:
+        locations = list()
+        for rigid_body in rigid_bodies:
+            mesh = load_obj(rigid_body["obj_file"])
+            if mesh is None:
+                continue
+            vertices, triangles = mesh
+            locations.append(
+                sample_triangles(vertices, triangles, spacing) + np.array(rigid_body["offset"])
+            )
+        if len(locations) == 0:
+            return 0
+        locations = np.concatenate(locations)
+        inside = np.all(
+            (locations > np.array(domain_start) - grid_width)
+            & (locations < np.array(domain_end) + grid_width), axis=1
+        )
+        locations = locations[inside]
+        self.boundary_cnt = len(locations)
+        if self.boundary_cnt == 0:
+            return 0
+
+        # sort the boundary particles by grid, the same as a rebuild of the searcher, but only once
+        grid_start = locations.min(axis=0)
+        grid_3d = np.floor((locations - grid_start) / grid_width).astype(np.int64)
+        grid_cnt_per_axis = grid_3d.max(axis=0) + 1
+        grid_1d = (
+            grid_3d[:, 0] * grid_cnt_per_axis[1] * grid_cnt_per_axis[2]
+            + grid_3d[:, 1] * grid_cnt_per_axis[2]
+            + grid_3d[:, 2]
+        )
+        order = np.argsort(grid_1d, kind="stable")
+        grid_end = np.cumsum(np.bincount(grid_1d, minlength=int(np.prod(grid_cnt_per_axis))))
+        self.grid_start = ti.math.vec3(grid_start.tolist())
+        self.grid_width = grid_width
+        self.grid_cnt_per_axis = ti.math.ivec3(grid_cnt_per_axis.tolist())
+
+        self.location = ti.Vector.field(3, dtype=ti.f32)
+        self.volume = ti.field(ti.f32)
+        ti.root.dense(ti.i, self.boundary_cnt).place(self.location, self.volume)
+        self.grid_end = ti.field(ti.int32)
+        ti.root.dense(ti.i, len(grid_end)).place(self.grid_end)
+        self.location.from_numpy(locations[order].astype(np.float32))
+        self.grid_end.from_numpy(grid_end.astype(np.int32))
+        self.compute_volumes()
+        return self.boundary_cnt
+
+    @ti.func
+    def add_kernel(
+        self, self_index: int, boundary_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> float:
+        return kernel_func_b(distance)
+
+    # the volume is the inverse of the number density of the boundary particles
+    @ti.kernel
+    def compute_volumes(self):
+        for k in range(self.boundary_cnt):
+            self.volume[k] = 1.0 / self.sum_over_boundary(
+                k, self.location[k], self.add_kernel, 0.0, self.parent.kernel_func_h
+            )
+
+    # call_func(self_index, boundary_index, r_to_center, distance) returns the part of the pair,
+    # as the callbacks of the searcher, the parts of the boundary particles in cutoff of location
+    # are summed up from init, cutoff must not be greater than the grid width
+    @ti.func
+    def sum_over_boundary(
+        self, index: int, location: ti.math.vec3, # type: ignore
+        call_func: ti.template(), init: ti.template(), cutoff: float # type: ignore
+    ):
+        result = init
+        center = ti.cast(ti.floor((location - self.grid_start) / self.grid_width), ti.int32)
+        for offset in ti.grouped(ti.ndrange(*((-1, 2),) * 3)):
+            neighbor = ti.math.ivec3(offset) + center
+            x,y,z = neighbor.x, neighbor.y, neighbor.z
+            if (
+                0 <= x < self.grid_cnt_per_axis.x and
+                0 <= y < self.grid_cnt_per_axis.y and
+                0 <= z < self.grid_cnt_per_axis.z
+            ):
+                grid_1d = (
+                    x * self.grid_cnt_per_axis.y * self.grid_cnt_per_axis.z +
+                    y * self.grid_cnt_per_axis.z +
+                    z
+                )
+                l, r = 0, self.grid_end[grid_1d]
+                if grid_1d > 0:
+                    l = self.grid_end[grid_1d - 1]
+                for k in range(l, r):
+                    r_to_center = location - self.location[k]
+                    distance = r_to_center.norm()
+                    if distance < cutoff:
+                        result += call_func(index, k, r_to_center, distance)
+        return result
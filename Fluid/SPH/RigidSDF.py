@@ -0,0 +1,194 @@
+import taichi as ti
+import numpy as np
+import hashlib, math, os
+
+from Fluid._basic import *
+from Fluid.SPH.RigidBoundary import load_obj
+
+# the signed distance of every node of the grid to the triangles, negative inside,
+# inside is where the generalized winding number is over 0.5, so small holes of the mesh are closed,
+# its sign only depends on the orientation of the triangles, so both orientations are inside
+# Jacobson et al. 2013, https://igl.ethz.ch/projects/winding-number/
+@ti.kernel
+def compute_signed_distance(
+    distance: ti.types.ndarray(), corners: ti.types.ndarray(), # type: ignore
+    origin: ti.math.vec3, cell_size: float # type: ignore
+):
+    for x, y, z in distance:
+        p = origin + ti.math.vec3(x, y, z) * cell_size
+        min_distance_sqr = 1e30
+        winding = 0.0
+        for t in range(corners.shape[0]):
+            a = ti.math.vec3(corners[t, 0, 0], corners[t, 0, 1], corners[t, 0, 2])
+            b = ti.math.vec3(corners[t, 1, 0], corners[t, 1, 1], corners[t, 1, 2])
+            c = ti.math.vec3(corners[t, 2, 0], corners[t, 2, 1], corners[t, 2, 2])
+            min_distance_sqr = ti.min(min_distance_sqr, point_triangle_distance_sqr(p, a, b, c))
+            # the solid angle of the triangle, Van Oosterom and Strackee 1983
+            qa, qb, qc = a - p, b - p, c - p
+            la, lb, lc = qa.norm(), qb.norm(), qc.norm()
+            winding += 2.0 * ti.atan2(
+                qa.dot(qb.cross(qc)),
+                la * lb * lc + qa.dot(qb) * lc + qb.dot(qc) * la + qc.dot(qa) * lb
+            )
+        sign = 1.0
+        if ti.abs(winding) / (4.0 * math.pi) > 0.5:
+            sign = -1.0
+        distance[x, y, z] = sign * ti.sqrt(min_distance_sqr)
+
+# the closest point on the triangle, Ericson, Real-Time Collision Detection 5.1.5
+@ti.func
+def point_triangle_distance_sqr(
+    p: ti.math.vec3, a: ti.math.vec3, b: ti.math.vec3, c: ti.math.vec3 # type: ignore
+) -> float:
+    ab, ac, ap = b - a, c - a, p - a
+    d1, d2 = ab.dot(ap), ac.dot(ap)
+    bp = p - b
+    d3, d4 = ab.dot(bp), ac.dot(bp)
+    cp = p - c
+    d5, d6 = ab.dot(cp), ac.dot(cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+    closest = a
+    if d1 <= 0.0 and d2 <= 0.0:
+        closest = a
+    elif d3 >= 0.0 and d4 <= d3:
+        closest = b
+    elif d6 >= 0.0 and d5 <= d6:
+        closest = c
+    elif vc <= 0.0 and d1 >= 0.0 and d3 <= 0.0:
+        closest = a + d1 / (d1 - d3) * ab
+    elif vb <= 0.0 and d2 >= 0.0 and d6 <= 0.0:
+        closest = a + d2 / (d2 - d6) * ac
+    elif va <= 0.0 and d4 - d3 >= 0.0 and d5 - d6 >= 0.0:
+        closest = b + (d4 - d3) / ((d4 - d3) + (d5 - d6)) * (c - b)
+    else:
+        denominator = 1.0 / (va + vb + vc)
+        closest = a + ab * (vb * denominator) + ac * (vc * denominator)
+    offset = p - closest
+    return offset.dot(offset)
+
+# every rigid body is a signed distance grid, which is computed once and cached in cache_dir,
+# keyed by the content of the obj file, the resolution and the offset, later runs map
+# the cached grid instead of computing it again
+# the grids of all rigid bodies are stored one after another, the origin, the size
+# and the start of every grid are compiled into the kernels
+@ti.data_oriented
+class RigidSDF:
+    def __init__(self, parent):
+        self.parent = parent
+        self.bodies_cnt = 0
+        self.grid_origin = list()
+        self.grid_cell_size = list()
+        self.grid_cnt_per_axis = list()
+        self.grid_start = list()
+        self.signed_distance = None
+        self.computed_cnt = 0
+
+    def __del__(self):
+        ...
+
+    # rigid_bodies: obj_file and offset of every rigid body, resolution is the count of cells
+    # along the longest side of a mesh, the grids have padding more cells around the meshes,
+    # returns the count of rigid bodies
+    def build(self, rigid_bodies: list, resolution: int, cache_dir: str, padding: int = 3) -> int:
+        grids = list()
+        for rigid_body in rigid_bodies:
+            mesh = load_obj(rigid_body["obj_file"])
+            if mesh is None:
+                continue
+            vertices, triangles = mesh
+            vertices = vertices + np.array(rigid_body["offset"])
+            lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+            cell_size = (upper - lower).max() / resolution
+            origin = lower - padding * cell_size
+            grid_cnt_per_axis = np.ceil((upper - lower) / cell_size).astype(np.int64) + 2 * padding + 1
+
+            with open(rigid_body["obj_file"], "rb") as file:
+                key = hashlib.sha1(file.read())
+            key.update(repr((resolution, padding, list(rigid_body["offset"]))).encode())
+            name = os.path.splitext(os.path.basename(rigid_body["obj_file"]))[0]
+            cache_file = os.path.join(cache_dir, f"{name}_{key.hexdigest()[:16]}.npy")
+
+            grid = None
+            if os.path.exists(cache_file):
+                grid = np.load(cache_file, mmap_mode="r")
+                if grid.shape != tuple(grid_cnt_per_axis) or grid.dtype != np.float32:
+                    log(f"{cache_file} does not match the mesh, compute it again")
+                    grid = None
+                else:
+                    log(f"signed distance grid of {name} is mapped from {cache_file}")
+            if grid is None:
+                grid = np.zeros(tuple(grid_cnt_per_axis), dtype=np.float32)
+                compute_signed_distance(
+                    grid, vertices[triangles].astype(np.float32),
+                    ti.math.vec3(origin.tolist()), cell_size
+                )
+                self.computed_cnt += 1
+                # written to a temporary file first, so an interrupted run leaves no broken cache
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_file = cache_file + ".tmp.npy"
+                np.save(temp_file, grid)
+                os.replace(temp_file, cache_file)
+                log(f"signed distance grid of {name} is computed and cached to {cache_file}")
+
+            self.grid_origin.append(ti.math.vec3(origin.tolist()))
+            self.grid_cell_size.append(cell_size)
+            self.grid_cnt_per_axis.append(ti.math.ivec3(grid_cnt_per_axis.tolist()))
+            self.grid_start.append(sum(g.size for g in grids))
+            grids.append(grid)
+
+        self.bodies_cnt = len(grids)
+        if self.bodies_cnt == 0:
+            return 0
+        self.signed_distance = ti.field(ti.f32)
+        ti.root.dense(ti.i, sum(grid.size for grid in grids)).place(self.signed_distance)
+        self.signed_distance.from_numpy(np.concatenate([grid.reshape(-1) for grid in grids]))
+        return self.bodies_cnt
+
+    @ti.func
+    def get_node(self, body: ti.template(), node: ti.math.ivec3) -> float: # type: ignore
+        grid_cnt_per_axis = self.grid_cnt_per_axis[body]
+        return self.signed_distance[
+            self.grid_start[body]
+            + node.x * grid_cnt_per_axis.y * grid_cnt_per_axis.z
+            + node.y * grid_cnt_per_axis.z
+            + node.z
+        ]
+
+    # the trilinear interpolation of the signed distance and its gradient,
+    # out of the grid the distance is at least the padding
+    @ti.func
+    def sample(self, body: ti.template(), location: ti.math.vec3): # type: ignore
+        cell_size = self.grid_cell_size[body]
+        grid_cnt_per_axis = self.grid_cnt_per_axis[body]
+        g = (location - self.grid_origin[body]) / cell_size
+        distance = 1e30
+        gradient = ti.math.vec3(0.0)
+        if (g >= 0.0).all() and (g < ti.cast(grid_cnt_per_axis - 1, ti.f32)).all():
+            base = ti.cast(ti.floor(g), ti.int32)
+            f = g - ti.cast(base, ti.f32)
+            c000 = self.get_node(body, base)
+            c100 = self.get_node(body, base + ti.math.ivec3(1, 0, 0))
+            c010 = self.get_node(body, base + ti.math.ivec3(0, 1, 0))
+            c110 = self.get_node(body, base + ti.math.ivec3(1, 1, 0))
+            c001 = self.get_node(body, base + ti.math.ivec3(0, 0, 1))
+            c101 = self.get_node(body, base + ti.math.ivec3(1, 0, 1))
+            c011 = self.get_node(body, base + ti.math.ivec3(0, 1, 1))
+            c111 = self.get_node(body, base + ti.math.ivec3(1, 1, 1))
+            # along x, then y, then z
+            c00 = c000 + (c100 - c000) * f.x
+            c10 = c010 + (c110 - c010) * f.x
+            c01 = c001 + (c101 - c001) * f.x
+            c11 = c011 + (c111 - c011) * f.x
+            c0 = c00 + (c10 - c00) * f.y
+            c1 = c01 + (c11 - c01) * f.y
+            distance = c0 + (c1 - c0) * f.z
+            dx0 = (c100 - c000) + (c110 - c010 - c100 + c000) * f.y
+            dx1 = (c101 - c001) + (c111 - c011 - c101 + c001) * f.y
+            gradient = ti.math.vec3(
+                dx0 + (dx1 - dx0) * f.z,
+                (c10 - c00) + (c11 - c01 - c10 + c00) * f.z,
+                c1 - c0
+            ) / cell_size
+        return distance, gradient
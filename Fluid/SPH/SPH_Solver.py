@@ -1,4 +1,4 @@
-import os, json, math, copy
+import os, json, math, copy, time
 import imageio
 import numpy as np
 import taichi as ti
@@ -10,24 +10,51 @@ class SPH_Solver:
     def __init__(self):
         self.cmd_args = None
         self.scene_cfg = None
+        self.scenes_cfg = list() # the scenes of the ensemble
+        self.scene_output_dirs = list()
         self.particle_system = ParticleSystem()
+        self.validate_this_step = False
+        self.validate_cnt = 0
+        self.validate_failed_steps = list()
+        self.enable_profile = False
+        # fuse the stages of a step into fewer kernels
+        self.fused_step = False
+        # the steps between two frames are launched this many at a time, see fused_steps_blocker
+        self.steps_per_launch = 1
+        # "npy" or "json", the legacy format
+        self.output_format = "npy"
+        # the particles are merged and split every adaptive_interval steps
+        self.adaptive_interval = 1
+        self.stage_time = dict()
+        # the statistics of every step, e.g. the pressure solver iterations,
+        # are summarized for every frame
+        self.current_step_stats = dict()
+        self.step_stats = list()
+        self.frame_stats = list()
+        # in simulated seconds
+        self.current_time = 0.0
+        self.current_time_step = 0.0
 
     def __del__(self):
         ...
 
-    # save particles location to disk
+    # save particles location to disk, every scene of an ensemble has its own directory
+    # "npy" saves the float32 array of shape (n, 3), "json" saves {"particles": [[x, y, z], ...]}
     def save_frame(self, idx: int) -> None:
         if not self.cmd_args.enable_output:
             return
         
-        file_name = f"res_{idx:04}.json"
+        file_name = f"res_{idx:04}.{self.output_format}"
         
-        particles = list()
-        self.particle_system.export_particles_location_to_list(particles)
+        scenes_particles = self.particle_system.export_particles_location_of_every_scene()
 
-        full_path = os.path.join(self.output_dir, file_name)
-        with open(full_path, "w", encoding="utf-8") as file:
-            json.dump({"particles": particles}, file, ensure_ascii=False, indent=4)
+        for output_dir, particles in zip(self.scene_output_dirs, scenes_particles):
+            full_path = os.path.join(output_dir, file_name)
+            if self.output_format == "json":
+                with open(full_path, "w", encoding="utf-8") as file:
+                    json.dump({"particles": particles.tolist()}, file, ensure_ascii=False, indent=4)
+            else:
+                np.save(full_path, particles)
 
     @log_time
     def build_scene(self) -> bool:
@@ -36,6 +63,17 @@ class SPH_Solver:
         if self.scene_cfg is None:
             log("build scene failed, because the scene file is missing")
             return False
+
+        # every member of "ensemble" is a scene, all scenes are simulated in one particle array
+        # only the parameters in ensemble_parameters can be different in every scene,
+        # the others change the compiled kernels and are taken from the first scene
+        self.scenes_cfg = expand_ensemble(self.scene_cfg)
+        self.scene_cfg = self.scenes_cfg[0]
+        ensemble_parameters = ("gravitation", "viscosity_coefficient", "domain_start", "domain_end")
+        for scene_id, scene_cfg in enumerate(self.scenes_cfg):
+            for key, value in scene_cfg["parameters"].items():
+                if not key in ensemble_parameters and self.scene_cfg["parameters"].get(key) != value:
+                    log(f"{key} of scene {scene_id} is ignored, it is shared by the ensemble")
         
         # read config complated
         # build data
@@ -45,14 +83,31 @@ class SPH_Solver:
         particle_mass = calc_particle_mass(particle_radius, density)
         log(f"particle calc complated, particle mass is {particle_mass}")
 
-        # set kernel function h
-        kernel_func_h = particle_radius * 4.0
+        # "spiky_poly6" (spiky for the forces, poly6 for the density), "cubic_spline",
+        # "wendland_c2" or "wendland_c4"
+        kernel = parameters.get("kernel", "spiky_poly6")
+        if set_kernel_funcs(kernel) != kernel:
+            log(f"{kernel} is not a available kernel, use spiky_poly6")
+            kernel = "spiky_poly6"
+        log(f"kernel is {kernel}")
+
+        # 0 evaluates the kernels directly, otherwise they are interpolated from a table
+        # of this many samples, the size is compiled into the kernels but h is not
+        kernel_table_size = parameters.get("kernel_table_size", 0)
+        set_kernel_table_size(kernel_table_size)
+        if kernel_table_size > 0:
+            log(f"kernels are tabulated with {kernel_table_size} samples")
+
+        # set kernel function h, the support radius of the kernels
+        kernel_func_h = particle_radius * parameters.get("kernel_radius_ratio", 4.0)
         set_kernel_func_h(kernel_func_h)
         log(f"set kernel function h to {kernel_func_h}")
 
         gravitation = parameters["gravitation"]
         viscosity_coefficient = parameters["viscosity_coefficient"]
         time_step = parameters["time_step"]
+        # "gather", "scatter" (half of the pairs, with atomics) or "auto"
+        force_traversal = parameters.get("force_traversal", "gather")
         # init particle parameters
         self.particle_system.init_parameters(
             particle_radius,
@@ -61,18 +116,72 @@ class SPH_Solver:
             gravitation,
             viscosity_coefficient,
             time_step,
-            kernel_func_h
+            kernel_func_h,
+            force_traversal
         )
 
-        # init grid
-        domain_start = parameters["domain_start"]
-        domain_end = parameters["domain_end"]
-        self.particle_system.init_domain(
-            domain_start, domain_end,
-            grid_width=kernel_func_h
+        # the mass of a particle is chosen so that the lattice of the fluid blocks has the rest density,
+        # instead of the density times the volume of a particle, the kernels with a small support
+        # overestimate the density of the lattice a lot
+        if parameters.get("calibrate_particle_mass", False):
+            particle_mass = density / self.particle_system.compute_prototype_density()
+            self.particle_system.particle_mass = particle_mass
+            log(f"particle mass is calibrated to {particle_mass}")
+
+        # 0 disables, otherwise the particles deep in the fluid are merged up to this level,
+        # they are split again near the surface and the walls, the particles of the scene are level 0
+        self.particle_system.init_adaptive_resolution(
+            parameters.get("adaptive_max_level", 0),
+            parameters.get("adaptive_band_ratio", 2.0),
+            parameters.get("adaptive_surface_threshold", 0.1),
+            parameters.get("adaptive_min_level_age", 8)
+        )
+        self.adaptive_interval = max(parameters.get("adaptive_interval", 1), 1)
+
+        # 0 disables, otherwise the particles slower than sleep_velocity for this many steps
+        # fall asleep and are skipped by the solver, until a neighborhood faster than
+        # wake_velocity wakes them
+        self.particle_system.init_sleeping(
+            parameters.get("sleep_steps", 0),
+            parameters.get("sleep_velocity", 0.1),
+            parameters.get("wake_velocity", 0.4),
+            parameters.get("sleep_density_change", 0.001),
+            parameters.get("sleep_min_density", 0.9)
         )
 
-        fluid_blocks = self.scene_cfg["fluid_blocks"]
+        # 0 disables the reorder, otherwise reorder the particles by grid every N rebuilds
+        reorder_interval = parameters.get("reorder_interval", 0)
+        # "dense" covers the whole domain, "hash" only stores the grids used by particles
+        grid_type = parameters.get("grid_type", "dense")
+        # 0 disables the neighbor list, otherwise keep the neighbors in kernel_func_h + skin
+        # and only rebuild after some particle moved more than half of the skin
+        neighbor_skin = parameters.get("neighbor_skin", 0.0)
+        max_neighbors = parameters.get("max_neighbors", 80)
+        # keep the pairs in kernel_func_h of every step for the density, pressure and viscosity
+        neighbor_cache = parameters.get("neighbor_cache", False)
+        # 0 disables, otherwise only do a full rebuild when more than this ratio of the particles
+        # left their grid since the last full rebuild
+        incremental_rebuild_threshold = parameters.get("incremental_rebuild_threshold", 0.0)
+        grid_width = self.particle_system.search_radius + neighbor_skin
+
+        # the scenes are placed along x, one grid apart, so no particle finds a neighbor
+        # in another scene
+        scenes = list()
+        offset_x = self.scene_cfg["parameters"]["domain_start"][0]
+        for scene_cfg in self.scenes_cfg:
+            scene_parameters = scene_cfg["parameters"]
+            scene_domain_start = scene_parameters["domain_start"]
+            scene_domain_end = scene_parameters["domain_end"]
+            scenes.append({
+                "offset": [offset_x - scene_domain_start[0], 0.0, 0.0],
+                "domain_start": scene_domain_start,
+                "domain_end": scene_domain_end,
+                "gravitation": scene_parameters["gravitation"],
+                "viscosity_coefficient": scene_parameters["viscosity_coefficient"]
+            })
+            offset_x += scene_domain_end[0] - scene_domain_start[0] + grid_width
+        self.particle_system.init_ensemble(scenes)
+
         # particles = list()
         # for fluid_block in fluid_blocks:
         #     domain_start = fluid_block["domain_start"]
@@ -91,25 +200,112 @@ class SPH_Solver:
 
         fluid_blocks_expand = list()
         particles_cnt = 0
-        for fluid_block in fluid_blocks:
-            domain_start = fluid_block["domain_start"]
-            domain_end = fluid_block["domain_end"]
-            cnt_per_axis = [0] * 3
-            cnt_in_this_block = 1
-            for i in range(3):
-                cnt_per_axis[i] = math.ceil(
-                    (domain_end[i] - domain_start[i]) / (particle_radius * 2)
-                )
-                cnt_in_this_block *= cnt_per_axis[i]
-            particles_cnt += cnt_in_this_block
-            fluid_blocks_expand.append({
-                "start": domain_start,
-                "cnt": cnt_per_axis,
-                "sum": cnt_in_this_block
-            })
+        for scene_id, scene_cfg in enumerate(self.scenes_cfg):
+            offset = scenes[scene_id]["offset"]
+            for fluid_block in scene_cfg["fluid_blocks"]:
+                domain_start = fluid_block["domain_start"]
+                domain_end = fluid_block["domain_end"]
+                cnt_per_axis = [0] * 3
+                cnt_in_this_block = 1
+                for i in range(3):
+                    cnt_per_axis[i] = math.ceil(
+                        (domain_end[i] - domain_start[i]) / (particle_radius * 2)
+                    )
+                    cnt_in_this_block *= cnt_per_axis[i]
+                particles_cnt += cnt_in_this_block
+                fluid_blocks_expand.append({
+                    "start": [domain_start[i] + offset[i] for i in range(3)],
+                    "cnt": cnt_per_axis,
+                    "sum": cnt_in_this_block,
+                    "scene_id": scene_id
+                })
+
+            # emitters and sinks are optional, particles_capacity limits the emitted particles
+            self.particle_system.init_emitters_and_sinks(
+                scene_cfg.get("emitters", []), scene_cfg.get("sinks", []), scene_id, offset
+            )
+        particles_capacity = max(parameters.get("particles_capacity", 0) * len(scenes), particles_cnt)
+
+        # init grid, the domain covers all scenes
+        domain_start = [
+            min(scene["domain_start"][i] + scene["offset"][i] for scene in scenes) for i in range(3)
+        ]
+        domain_end = [
+            max(scene["domain_end"][i] + scene["offset"][i] for scene in scenes) for i in range(3)
+        ]
+        self.particle_system.init_domain(
+            domain_start, domain_end,
+            grid_width=grid_width,
+            reorder_interval=reorder_interval,
+            grid_type=grid_type,
+            particles_cnt=particles_capacity,
+            neighbor_skin=neighbor_skin,
+            max_neighbors=max_neighbors,
+            pair_cache=neighbor_cache,
+            incremental_rebuild_threshold=incremental_rebuild_threshold
+        )
+
+        # "particles" samples the surfaces of the rigid bodies with static boundary particles,
+        # "sdf" collides the particles with signed distance grids of the rigid bodies,
+        # "none" only renders them
+        rigid_body_boundary = parameters.get("rigid_body_boundary", "none")
+        if not rigid_body_boundary in ("none", "particles", "sdf"):
+            log(f"{rigid_body_boundary} is not a available rigid body boundary, use none")
+            rigid_body_boundary = "none"
+        if rigid_body_boundary != "none":
+            # the obj files and the cache are relative to the scene file, as in the renderer
+            scene_file_path = os.path.dirname(os.path.abspath(self.cmd_args.scene))
+            rigid_bodies = list()
+            for scene_id, scene_cfg in enumerate(self.scenes_cfg):
+                offset = scenes[scene_id]["offset"]
+                for rigid_body in scene_cfg.get("rigid_bodies", []):
+                    rigid_bodies.append({
+                        "obj_file": os.path.join(scene_file_path, rigid_body["obj_file"]),
+                        "offset": [rigid_body["offset"][i] + offset[i] for i in range(3)]
+                    })
+            self.particle_system.init_rigid_bodies(
+                rigid_bodies, rigid_body_boundary,
+                parameters.get("rigid_body_sdf_resolution", 64),
+                os.path.join(scene_file_path, parameters.get("rigid_body_sdf_cache", "sdf_cache"))
+            )
+
+        # the command line overrides the scene
+        particle_layout = self.cmd_args.particle_layout
+        if particle_layout is None:
+            particle_layout = parameters.get("particle_layout", "aos")
+
+        # the step of the basic sph launches 2 kernels instead of 6, with the same results
+        fused_step = self.cmd_args.fused_step
+        if fused_step is None:
+            fused_step = parameters.get("fused_step", False)
+        self.fused_step = fused_step
+        if self.fused_step:
+            log("the stages of a step are fused")
+
+        # the command line overrides the scene
+        steps_per_launch = self.cmd_args.steps_per_launch
+        if steps_per_launch is None:
+            steps_per_launch = parameters.get("steps_per_launch", 1)
+        self.steps_per_launch = max(int(steps_per_launch), 1)
+
+        # the command line overrides the scene
+        output_format = self.cmd_args.output_format
+        if output_format is None:
+            output_format = parameters.get("output_format", "npy")
+        if not output_format in ("npy", "json"):
+            log(f"{output_format} is not a available output format, use npy")
+            output_format = "npy"
+        self.output_format = output_format
+        if self.cmd_args.enable_output:
+            log(f"frames are saved as {output_format}")
+
+        # "pressure", "forces" and "pressure_forces" can be stored as f16
+        half_precision_attributes = parameters.get("half_precision_attributes", [])
 
         log("start malloc data on computing device")
-        self.particle_system.malloc_memory(particles_cnt)
+        self.particle_system.malloc_memory(
+            particles_cnt, particle_layout, half_precision_attributes, particles_capacity
+        )
 
         log("initing particles location...")
         self.particle_system.init_particles_location(
@@ -122,15 +318,182 @@ class SPH_Solver:
         log(f"build scene complated, particle count is {particles_cnt:,}")
         return True
     
-    def step(self):
-        self.particle_system.rebuild_search_index()
-        self.particle_system.compute_densities()
-        self.particle_system.accumulate_external_forces()
-        # self.particle_system.accumulate_viscosity_force()
-        self.particle_system.compute_pressure()
-        self.particle_system.accumulate_pressure_force()
-        self.particle_system.time_integration()
-        self.particle_system.resolve_collision()
+    def validate_neighborhood_search(self) -> bool:
+        wrong_index, wrong_error = self.particle_system.validate_neighborhood_search()
+        self.validate_cnt += 1
+        if len(wrong_index) == 0:
+            return True
+        self.validate_wrong_index, self.validate_wrong_error = wrong_index, wrong_error
+        return False
+
+    # the errors are relative, except the integrals, a table with fewer samples has larger errors
+    def validate_kernels(self):
+        for name, error in check_kernels():
+            log(f"{name}: {error:.3e}")
+
+    def log_validate_error(self):
+        samples_cnt = self.particle_system.validate_samples_cnt
+        log(f"neighborhood search is incorrect for {len(self.validate_wrong_index)} of "
+            f"{samples_cnt} sampled particles"
+        )
+        for index, error in list(zip(self.validate_wrong_index, self.validate_wrong_error))[:8]:
+            log(f"particle {index} found {error:+d} neighborhoods")
+
+    # subclasses should call this instead of particle_system.update_search_index
+    def update_search_index(self, step_idx: int = -1):
+        self.particle_system.update_search_index()
+        if self.validate_this_step and not self.validate_neighborhood_search():
+            self.validate_failed_steps.append(step_idx)
+
+    # time one stage of the step, only wait for the device when profiling
+    # the first call of every stage compiles the kernels, so it is not counted
+    def run_stage(self, name: str, func, *args):
+        if not self.enable_profile:
+            return func(*args)
+        ti.sync()
+        start_time = time.perf_counter()
+        result = func(*args)
+        ti.sync()
+        if name in self.stage_time:
+            self.stage_time[name][0] += time.perf_counter() - start_time
+            self.stage_time[name][1] += 1
+        else:
+            self.stage_time[name] = [0.0, 0]
+        return result
+
+    def log_stage_time(self):
+        stage_time = {
+            name: total_time / calls_cnt
+            for name, (total_time, calls_cnt) in self.stage_time.items() if calls_cnt > 0
+        }
+        total_time = sum(stage_time.values())
+        if total_time <= 0.0:
+            return
+        log(f"average time per step is {total_time * 1000:.3f} ms")
+        for name, time_per_call in stage_time.items():
+            log(f"  {name:<32}{time_per_call * 1000:10.3f} ms"
+                f"{time_per_call / total_time * 100:8.1f}%"
+            )
+
+    # subclasses should start every step with this
+    def begin_step(self, step_idx: int = -1):
+        if len(self.particle_system.emitters) > 0 or self.particle_system.has_sinks:
+            self.run_stage(
+                "emit_and_retire_particles", self.particle_system.emit_and_retire_particles,
+                self.current_time, self.current_time_step
+            )
+        if self.particle_system.adaptive_resolution and step_idx % self.adaptive_interval == 0:
+            merged_cnt, split_cnt = self.run_stage(
+                "adapt_resolution", self.particle_system.adapt_resolution
+            )
+            self.record_step_stats(
+                merged=merged_cnt, split=split_cnt,
+                particles=self.particle_system.active_cnt[None] - self.particle_system.free_cnt[None]
+            )
+        self.run_stage("update_search_index", self.update_search_index, step_idx)
+        if self.particle_system.sleep_steps > 0:
+            self.run_stage("update_sleeping", self.particle_system.update_sleeping)
+
+    # e.g. record_step_stats(iterations=3, density_error=0.001)
+    def record_step_stats(self, **stats):
+        self.current_step_stats.update(stats)
+
+    def finish_step_stats(self):
+        if len(self.current_step_stats) > 0:
+            self.step_stats.append(self.current_step_stats)
+            self.current_step_stats = dict()
+
+    # the average and max of every recorded value over the steps of the frame
+    def finish_frame_stats(self, frame_idx: int):
+        if len(self.step_stats) == 0:
+            return
+        frame_stats = {"frame": frame_idx, "steps": len(self.step_stats)}
+        keys = list()
+        for stats in self.step_stats:
+            keys.extend(key for key in stats.keys() if not key in keys)
+        for key in keys:
+            values = [stats[key] for stats in self.step_stats if key in stats]
+            frame_stats[f"avg_{key}"] = sum(values) / len(values)
+            frame_stats[f"max_{key}"] = max(values)
+        self.frame_stats.append(frame_stats)
+        self.step_stats.clear()
+
+    def log_frame_stats(self):
+        if len(self.frame_stats) == 0:
+            return
+        for key in self.frame_stats[0].keys():
+            if key.startswith("avg_"):
+                values = [stats[key] for stats in self.frame_stats if key in stats]
+                log(f"{key[4:]} is {sum(values) / len(values):.6g} on average, "
+                    f"{max(stats.get('max_' + key[4:], 0) for stats in self.frame_stats):.6g} at most"
+                )
+        # next to the output directory, the renderer reads every frame file in it
+        if self.cmd_args.enable_output:
+            full_path = f"{self.output_dir}_stats.json"
+            with open(full_path, "w", encoding="utf-8") as file:
+                json.dump({"frames": self.frame_stats}, file, ensure_ascii=False, indent=4)
+            log(f"statistics of every frame are saved to {full_path}")
+
+    def step(self, step_idx: int = -1):
+        self.begin_step(step_idx)
+        if self.fused_step:
+            self.run_stage(
+                "compute_densities_and_pressure", self.particle_system.compute_densities_and_pressure
+            )
+            self.run_stage(
+                "accumulate_forces_and_integrate", self.particle_system.accumulate_forces_and_integrate
+            )
+            return
+        self.run_stage("compute_densities", self.particle_system.compute_densities)
+        self.run_stage("accumulate_external_forces", self.particle_system.accumulate_external_forces)
+        # self.run_stage("accumulate_viscosity_force", self.particle_system.accumulate_viscosity_force)
+        self.run_stage("compute_pressure", self.particle_system.compute_pressure)
+        self.run_stage("accumulate_pressure_force", self.particle_system.accumulate_pressure_force)
+        self.run_stage("time_integration", self.particle_system.time_integration)
+        self.run_stage("resolve_collision", self.particle_system.resolve_collision)
+
+    # steps_cnt steps in one launch, see ParticleSystem.advance_steps
+    def advance_steps(self, steps_cnt: int):
+        self.particle_system.advance_steps(steps_cnt)
+
+    # the reason why the steps can not be launched steps_per_launch at a time, or None,
+    # the search index is updated on the device, with every grid, the neighbor list,
+    # the incremental rebuild, the pair cache and the reordering, but the solvers which iterate
+    # until an error and everything the host decides on between the steps fall back
+    def fused_steps_blocker(self, adaptive_time_step: bool, validate_interval: int) -> str:
+        particle_system = self.particle_system
+        blockers = (
+            (
+                not particle_system.supports_fused_steps,
+                f"{type(self).__name__} iterates until an error the host checks"
+            ),
+            (adaptive_time_step, "the time step is adaptive"),
+            (
+                len(particle_system.emitters) > 0 or particle_system.has_sinks,
+                "particles are emitted or retired"
+            ),
+            (particle_system.adaptive_resolution, "the resolution is adaptive"),
+            (validate_interval > 0, "the neighborhood search is validated during the run"),
+            (self.enable_profile, "the stages are profiled")
+        )
+        for blocked, reason in blockers:
+            if blocked:
+                return reason
+        return None
+
+    # the alive particles awake and asleep in the last step, waits for the device
+    def count_sleeping_particles(self) -> dict:
+        particle_system = self.particle_system
+        sleeping_cnt = particle_system.sleeping_cnt[None]
+        return {
+            "awake": particle_system.active_cnt[None] - particle_system.free_cnt[None] - sleeping_cnt,
+            "sleeping": sleeping_cnt
+        }
+
+    # waits for the device
+    def update_progress(self, pbar, length: float):
+        pbar.set_postfix_str(f"AD: {self.particle_system.compute_avg_density():.2f}")
+        pbar.update(min(self.current_time, length) - pbar.n)
 
     # simulation loop
     @log_time
@@ -139,21 +502,55 @@ class SPH_Solver:
 
         scene_parameters = self.scene_cfg["parameters"]
         particle_radius = scene_parameters["particle_radius"]
-        total_steps = int(self.cmd_args.length // scene_parameters["time_step"])
+        length = self.cmd_args.length
+        frame_time = 1 / scene_parameters["frame_rate"]
+        total_steps = int(length // scene_parameters["time_step"])
         steps_per_frame = math.ceil(
             1 / (scene_parameters["frame_rate"] * scene_parameters["time_step"])
         )
         toal_frames = math.ceil(total_steps / steps_per_frame)
+
+        # the time step of every step is computed from the cfl condition,
+        # and the frames are saved exactly every 1 / frame_rate seconds
+        adaptive_time_step = scene_parameters.get("adaptive_time_step", False)
+        cfl_number = scene_parameters.get("cfl_number", 0.4)
+        min_time_step = scene_parameters.get("min_time_step", scene_parameters["time_step"] * 0.1)
+        max_time_step = scene_parameters.get("max_time_step", frame_time)
+        if adaptive_time_step:
+            toal_frames = math.ceil(length / frame_time)
         
         log(f"simulation length is {self.cmd_args.length} seconds")
-        log(f"total simulation steps is {total_steps}")
+        if adaptive_time_step:
+            log(f"time step is adaptive in [{min_time_step}, {max_time_step}], "
+                f"cfl number is {cfl_number}"
+            )
+        else:
+            log(f"total simulation steps is {total_steps}")
         log(f"total output frames is about {toal_frames}")
-        log(f"output one frame after every {steps_per_frame} steps")
+        if not adaptive_time_step:
+            log(f"output one frame after every {steps_per_frame} steps")
 
         self.output_dir = os.path.abspath(self.cmd_args.output_path)
         os.makedirs(self.output_dir, exist_ok=True)
+        self.scene_output_dirs = [self.output_dir]
+        if len(self.scenes_cfg) > 1:
+            self.scene_output_dirs = [
+                os.path.join(self.output_dir, scene_cfg.get("name", f"scene_{scene_id:02}"))
+                for scene_id, scene_cfg in enumerate(self.scenes_cfg)
+            ]
+            for output_dir in self.scene_output_dirs:
+                os.makedirs(output_dir, exist_ok=True)
+            log(f"the frames of every scene are saved to {self.output_dir}/<scene name>")
 
         enable_preview = self.cmd_args.enable_preview
+        # wait for the device after every stage and log the time of every stage
+        self.enable_profile = self.cmd_args.profile
+        # the progress and the average density are only refreshed at the frames, so the steps
+        # between two frames are launched without waiting for the device, except for the values
+        # the host needs to decide on, e.g. the adaptive time step or the pressure solver errors
+        frame_sync = self.cmd_args.frame_sync
+        if frame_sync:
+            log("the progress is refreshed every frame")
 
         frame_rate = scene_parameters["frame_rate"]
         render_cfg = self.scene_cfg["render"]
@@ -186,26 +583,71 @@ class SPH_Solver:
             scene.set_camera(camera)
             scene.ambient_light((0.8, 0.8, 0.8))
 
-        log("running neighborhood search debug...")
-        self.particle_system.rebuild_search_index()
-        self.particle_system.run_neighborhood_search_debug()
+        if self.cmd_args.validate_kernels:
+            log("validating kernels...")
+            self.validate_kernels()
+
+        # the validator checks sampled particles against brute force, before the run
+        # and then every validate_interval steps
+        enable_validate = self.cmd_args.validate_neighborhood
+        validate_interval = self.cmd_args.validate_interval
+        if enable_validate:
+            log("validating neighborhood search...")
+            self.particle_system.init_neighborhood_validator(self.cmd_args.validate_samples)
+            self.particle_system.rebuild_search_index()
+            if self.validate_neighborhood_search():
+                log("neighborhood search is correct")
+            else:
+                self.log_validate_error()
+
+        # the steps of a frame are launched steps_per_launch at a time, with the same results,
+        # the rest of the frame is done step by step
+        steps_per_launch = 1
+        if self.steps_per_launch > 1:
+            blocker = self.fused_steps_blocker(
+                adaptive_time_step, validate_interval if enable_validate else 0
+            )
+            if blocker is None:
+                steps_per_launch = self.steps_per_launch
+                log(f"{steps_per_launch} steps are launched at a time")
+            else:
+                log(f"steps are launched one at a time, {blocker}")
 
         frame_idx = 0
+        step_idx = 0
+        first_step_of_frame = False
+        self.current_time = 0.0
+        self.current_time_step = scene_parameters["time_step"]
         enter_bar()
-        pbar = tqdm(total=total_steps, desc="simulation")
-        for step_idx in range(total_steps):
+        pbar = tqdm(
+            total=length, desc="simulation", unit="s",
+            bar_format="{l_bar}{bar}| {n:.4f}/{total:.4f} s [{elapsed}<{remaining}{postfix}]"
+        )
+        while (
+            self.current_time < length - frame_time * 1e-6 if adaptive_time_step
+            else step_idx < total_steps
+        ):
             # one frame
-            if step_idx % steps_per_frame == 0:
+            if (
+                self.current_time >= frame_idx * frame_time - frame_time * 1e-6 if adaptive_time_step
+                else step_idx % steps_per_frame == 0
+            ):
+                if frame_idx > 0:
+                    self.finish_frame_stats(frame_idx - 1)
+                    if frame_sync:
+                        self.update_progress(pbar, length)
                 # export particles location to disk
                 self.save_frame(frame_idx)
                 frame_idx += 1
+                first_step_of_frame = True
 
                 # update preview window
                 if enable_preview and self.preview_window.running:
                     scene.particles(
                         self.particle_system.particles.location,
                         color = (0.68, 0.26, 0.19),
-                        radius = particle_radius
+                        radius = particle_radius,
+                        index_count = self.particle_system.active_cnt[None]
                     )
                     canvas.scene(scene)
                     # self.preview_window.show()
@@ -217,12 +659,69 @@ class SPH_Solver:
                     # )
                     # log(f"write image to {os.path.join(self.output_dir, 'test.png')}")
                     # self.video_manager.write_frame(image)
+            if adaptive_time_step:
+                next_frame_time = frame_idx * frame_time
+                self.current_time_step = self.run_stage(
+                    "compute_time_step", self.particle_system.compute_time_step,
+                    cfl_number, min_time_step, max_time_step, next_frame_time - self.current_time
+                )
+                self.record_step_stats(time_step=self.current_time_step)
             # simulation loop body
-            self.step()
-            pbar.set_postfix_str(f"AD: {self.particle_system.compute_avg_density():.2f}")
-            pbar.update(1)
+            self.validate_this_step = (
+                enable_validate and validate_interval > 0
+                and step_idx > 0 and step_idx % validate_interval == 0
+            )
+            steps_cnt = 1
+            if (
+                steps_per_launch > 1
+                and step_idx % steps_per_frame + steps_per_launch <= steps_per_frame
+                and step_idx + steps_per_launch <= total_steps
+            ):
+                steps_cnt = steps_per_launch
+                self.advance_steps(steps_cnt)
+            else:
+                self.step(step_idx)
+            # the neighborhoods decide the cost of the kernels, they are counted once per frame
+            # after the search index was updated
+            if self.enable_profile and first_step_of_frame:
+                self.record_step_stats(
+                    neighborhoods=self.particle_system.compute_avg_neighborhoods_cnt()
+                )
+            # the awake and sleeping particles of the first step of every frame, as the neighborhoods
+            if self.particle_system.sleep_steps > 0 and first_step_of_frame:
+                self.record_step_stats(**self.count_sleeping_particles())
+            first_step_of_frame = False
+            for _ in range(steps_cnt):
+                self.current_time += self.current_time_step
+            if adaptive_time_step and abs(self.current_time - next_frame_time) < frame_time * 1e-6:
+                # the time step was clamped to the frame
+                self.current_time = next_frame_time
+            self.finish_step_stats()
+            step_idx += steps_cnt
+            if not frame_sync:
+                self.update_progress(pbar, length)
+        if frame_sync:
+            self.update_progress(pbar, length)
         pbar.close()
         exit_bar()
+        self.finish_frame_stats(frame_idx - 1)
+        log(f"simulated {self.current_time:.6g} seconds in {step_idx} steps")
+        self.particle_system.neighborhood_searcher.log_statistics()
+        self.log_frame_stats()
+        if (
+            len(self.particle_system.emitters) > 0 or self.particle_system.has_sinks
+            or self.particle_system.adaptive_resolution
+        ):
+            log(f"particle count is {self.particle_system.active_cnt[None]:,} at the end")
+        if self.particle_system.sleep_steps > 0:
+            log(f"{self.count_sleeping_particles()['sleeping']:,} particles are sleeping at the end")
+        if self.enable_profile:
+            self.log_stage_time()
+        if enable_validate and validate_interval > 0:
+            log(f"neighborhood search validated {self.validate_cnt} times")
+            if len(self.validate_failed_steps) > 0:
+                log(f"neighborhood search is incorrect at steps {self.validate_failed_steps}")
+                self.log_validate_error()
         if enable_preview and self.preview_window.running:
             # self.video_manager.make_video(gif=False, mp4=True)
             self.preview_window.destroy()
@@ -0,0 +1,137 @@
+import taichi as ti
+
+from Fluid._basic import *
+from Fluid.SPH.ParticleSystem import ParticleSystem
+
+# weakly compressible sph with an artificial speed of sound, the density is integrated
+# with the continuity equation and smoothed by the density diffusion of delta-sph
+# http://cg.informatik.uni-freiburg.de/publications/2007_SCA_SPH.pdf
+# https://doi.org/10.1016/j.cpc.2008.12.004 (Molteni and Colagrossi 2009)
+@ti.data_oriented
+class WCSPH_ParticleSystem(ParticleSystem):
+    def __init__(self):
+        super().__init__()
+        # the forces and the density rate use one particle mass and one support
+        self.supports_adaptive_resolution = False
+        # the density rate and the forces only sum over the fluid particles
+        self.supports_rigid_bodies = False
+        # the density is integrated from the density rate of every particle
+        self.supports_sleeping = False
+        self.density_diffusion = 0.1
+        self.viscosity_alpha = 0.05
+        # d(density)/dt of this step, only used inside one step, so it is not reordered
+        self.density_rate = None
+
+    def __del__(self):
+        ...
+
+    def malloc_memory(
+        self, particles_cnt: int, layout: str = "aos",
+        half_precision_attributes: list = [], particles_capacity: int = 0
+    ):
+        super().malloc_memory(particles_cnt, layout, half_precision_attributes, particles_capacity)
+        self.density_rate = ti.field(ti.f32)
+        ti.root.dense(ti.i, self.particles_capacity).place(self.density_rate)
+
+    def init_compressibility(
+        self, speed_of_sound: float, density_diffusion: float, viscosity_alpha: float
+    ):
+        self.speed_of_sound = speed_of_sound
+        self.density_diffusion = density_diffusion
+        self.viscosity_alpha = viscosity_alpha
+
+    # the density is integrated from the rest density, like the particles of the emitters,
+    # the summation underestimates it at the free surface and overestimates it on the lattice
+    @ti.kernel
+    def init_densities(self):
+        for i in range(self.active_cnt[None]):
+            self.particles[i].density = self.density
+
+    @ti.func
+    def get_signal_speed(self, max_speed: float) -> float:
+        return max_speed + self.speed_of_sound
+
+    # the pressure force and the artificial viscosity of monaghan in xyz,
+    # the continuity equation and the density diffusion in w
+    @ti.func
+    def add_forces_and_density_rate(
+        self, self_index: int, other_index: int,
+        r_to_center: ti.math.vec3, distance: float # type: ignore
+    ) -> ti.math.vec4: # type: ignore
+        result = ti.math.vec4(0.0)
+        if 0.0 < distance:
+            density_self = self.particles[self_index].density
+            density_other = self.particles[other_index].density
+            gradient = kernel_func_a_gradient_with_distance(r_to_center, distance)
+            v_to_center = self.particles[self_index].velocity - self.particles[other_index].velocity
+
+            part = (
+                self.get_pressure(self_index) / (density_self * density_self)
+                + self.get_pressure(other_index) / (density_other * density_other)
+            )
+            # eta keeps the terms bounded for particles pushed together on the walls
+            distance_sqr = distance * distance + 0.01 * self.kernel_func_h * self.kernel_func_h
+            v_dot_r = v_to_center.dot(r_to_center)
+            if v_dot_r < 0.0:
+                mu = self.kernel_func_h * v_dot_r / distance_sqr
+                part -= (
+                    self.viscosity_alpha * self.speed_of_sound * mu
+                    * 2.0 / (density_self + density_other)
+                )
+            forces = -self.particle_mass * self.particle_mass * part * gradient
+
+            # psi points from self to other, so the density flows from the denser particle
+            # the gradient of spiky does not vanish at 0 and makes the diffusion explode
+            # for close particles, so the one of poly6 is used, and the smoothing length
+            # of delta-sph is half of the support radius
+            psi = 2.0 * (density_other - density_self) * (-r_to_center) / distance_sqr
+            diffusion_gradient = kernel_func_b_gradient_with_distance(r_to_center, distance)
+            density_rate = self.particle_mass * v_to_center.dot(gradient) + (
+                self.density_diffusion * 0.5 * self.kernel_func_h * self.speed_of_sound
+                * psi.dot(diffusion_gradient) * self.particle_mass / density_other
+            )
+            result = ti.math.vec4(forces, density_rate)
+        return result
+
+    @ti.kernel
+    def accumulate_forces_and_density_rate(self):
+        self.fused_forces_and_density_rate()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_forces_and_density_rate(self):
+        for i in range(self.active_cnt[None]):
+            result = self.neighborhood_searcher.sum_over_neighborhoods(
+                i, self.add_forces_and_density_rate, ti.math.vec4(0.0)
+            )
+            self.set_pressure_forces(i, result.xyz)
+            self.set_forces(i, self.get_forces(i) + result.xyz)
+            self.density_rate[i] = result.w
+
+    # the density of the spray keeps falling while it spreads, so it is kept above
+    # the density of a particle without neighborhoods, as the summation gives
+    @ti.kernel
+    def time_integration_with_density(self):
+        self.fused_integration_with_density()
+
+    # only call at the top level of a kernel
+    @ti.func
+    def fused_integration_with_density(self):
+        min_density = self.particle_mass * kernel_func_b(0.0)
+        for i in range(self.active_cnt[None]):
+            self.particles[i].velocity += (
+                self.get_forces(i) * self.dt[None] / self.particle_mass
+            )
+            self.particles[i].location += self.particles[i].velocity * self.dt[None]
+            self.particles[i].density = ti.max(
+                self.particles[i].density + self.density_rate[i] * self.dt[None], min_density
+            )
+
+    # the stages of WCSPH_Solver.step
+    @ti.func
+    def fused_solve(self):
+        self.fused_external_forces()
+        self.fused_pressure()
+        self.fused_forces_and_density_rate()
+        self.fused_integration_with_density()
+        self.fused_collision()
@@ -1,8 +1,69 @@
+import math
+from Fluid._basic import *
 from Fluid.SPH.SPH_Solver import SPH_Solver
+from Fluid.WCSPH.WCSPH_ParticleSystem import WCSPH_ParticleSystem
 
 class WCSPH_Solver(SPH_Solver):
     def __init__(self):
         super().__init__()
+        self.particle_system = WCSPH_ParticleSystem()
 
     def __del__(self):
-        ...
\ No newline at end of file
+        ...
+
+    def build_scene(self) -> bool:
+        if not super().build_scene():
+            return False
+
+        # the speed of sound is 10 times of the max velocity, so the density changes about 1%
+        # without wcsph_max_velocity, the velocity of a free fall through the domain is used
+        parameters = self.scene_cfg["parameters"]
+        speed_of_sound = parameters.get("wcsph_speed_of_sound", 0.0)
+        if speed_of_sound <= 0.0:
+            max_velocity = parameters.get("wcsph_max_velocity", 0.0)
+            if max_velocity <= 0.0:
+                gravitation = max(
+                    math.sqrt(sum(x * x for x in scene_cfg["parameters"]["gravitation"]))
+                    for scene_cfg in self.scenes_cfg
+                )
+                height = max(
+                    scene_cfg["parameters"]["domain_end"][1] - scene_cfg["parameters"]["domain_start"][1]
+                    for scene_cfg in self.scenes_cfg
+                )
+                max_velocity = math.sqrt(2.0 * gravitation * height)
+            speed_of_sound = max_velocity * 10.0
+        self.particle_system.init_compressibility(
+            speed_of_sound,
+            parameters.get("wcsph_density_diffusion", 0.1),
+            parameters.get("wcsph_viscosity_alpha", 0.05)
+        )
+        self.particle_system.init_densities()
+        log(f"wcsph speed of sound is {speed_of_sound:.6g}")
+
+        # the time step of the scene is replaced by the cfl condition of the speed of sound,
+        # rounded down so that it divides the frame time
+        # the walls only clamp the particles, so the impacts compress the fluid much more
+        # than the speed of sound predicts, 0.4 blows up on them and 0.2 does not
+        if not parameters.get("adaptive_time_step", False):
+            frame_time = 1 / parameters["frame_rate"]
+            time_step = (
+                parameters.get("wcsph_cfl_number", 0.2)
+                * self.particle_system.kernel_func_h / speed_of_sound
+            )
+            time_step = frame_time / math.ceil(frame_time / time_step)
+            parameters["time_step"] = time_step
+            self.particle_system.time_step = time_step
+            self.particle_system.dt[None] = time_step
+            log(f"wcsph time step is {time_step:.6g}")
+        return True
+
+    def step(self, step_idx: int = -1):
+        self.begin_step(step_idx)
+        self.run_stage("accumulate_external_forces", self.particle_system.accumulate_external_forces)
+        self.run_stage("compute_pressure", self.particle_system.compute_pressure)
+        self.run_stage(
+            "accumulate_forces_and_density_rate",
+            self.particle_system.accumulate_forces_and_density_rate
+        )
+        self.run_stage("time_integration", self.particle_system.time_integration_with_density)
+        self.run_stage("resolve_collision", self.particle_system.resolve_collision)
@@ -8,6 +8,8 @@ import os
 from Fluid.SPH.SPH_Solver import SPH_Solver
 from Fluid.WCSPH.WCSPH_Solver import WCSPH_Solver
 from Fluid.PCISPH.PCISPH_Solver import PCISPH_Solver
+from Fluid.PBF.PBF_Solver import PBF_Solver
+from Fluid.DFSPH.DFSPH_Solver import DFSPH_Solver
 
 from Fluid._basic import *
 
@@ -31,6 +33,10 @@ def simulation_entry(args):
         solver = WCSPH_Solver()
     elif args.method == "pcisph":
         solver = PCISPH_Solver()
+    elif args.method == "pbf":
+        solver = PBF_Solver()
+    elif args.method == "dfsph":
+        solver = DFSPH_Solver()
     else:
         log(f"{args.method} is not a available algorithm")
 
@@ -7,21 +7,29 @@ __all__ = [
     "log",
     "log_time",
     "load_scene",
+    "expand_ensemble",
     "eps",
+    "f16_max",
     "speed_of_sound",
     "world_up",
     "eos_exponent",
     "calc_particle_radius",
     "calc_particle_mass",
     "set_kernel_func_h",
+    "set_kernel_table_size",
+    "set_kernel_funcs",
     "get_kernel_func_h",
+    "check_kernels",
     "kernel_func_a",
     "kernel_func_a_first_derivative",
     "kernel_func_a_gradient",
+    "kernel_func_a_gradient_with_distance",
     "kernel_func_a_second_derivative",
+    "kernel_func_a_viscosity_laplacian",
     "kernel_func_b",
     "kernel_func_b_first_derivative",
     "kernel_func_b_gradient",
+    "kernel_func_b_gradient_with_distance",
     "kernel_func_b_second_derivative"
 ]
 
@@ -33,19 +41,27 @@ from Fluid._basic.message import exit_bar
 from Fluid._basic.message import log
 from Fluid._basic.message import log_time
 from Fluid._basic.config import load_scene
+from Fluid._basic.config import expand_ensemble
 from Fluid._basic.math import eps
+from Fluid._basic.math import f16_max
 from Fluid._basic.math import speed_of_sound
 from Fluid._basic.math import world_up
 from Fluid._basic.math import eos_exponent
 from Fluid._basic.math import calc_particle_radius
 from Fluid._basic.math import calc_particle_mass
 from Fluid._basic.math import set_kernel_func_h
+from Fluid._basic.math import set_kernel_table_size
+from Fluid._basic.math import set_kernel_funcs
 from Fluid._basic.math import get_kernel_func_h
+from Fluid._basic.math import check_kernels
 from Fluid._basic.math import kernel_func_a
 from Fluid._basic.math import kernel_func_a_first_derivative
 from Fluid._basic.math import kernel_func_a_gradient
+from Fluid._basic.math import kernel_func_a_gradient_with_distance
 from Fluid._basic.math import kernel_func_a_second_derivative
+from Fluid._basic.math import kernel_func_a_viscosity_laplacian
 from Fluid._basic.math import kernel_func_b
 from Fluid._basic.math import kernel_func_b_first_derivative
 from Fluid._basic.math import kernel_func_b_gradient
+from Fluid._basic.math import kernel_func_b_gradient_with_distance
 from Fluid._basic.math import kernel_func_b_second_derivative
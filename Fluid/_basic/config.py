@@ -1,4 +1,4 @@
-import os, json
+import os, json, copy
 import Fluid._basic.message as m
 
 def load_scene(scene_file_path: str) -> dict:
@@ -16,4 +16,23 @@ def load_scene(scene_file_path: str) -> dict:
         m.log(f"{scene_file_path} load failed:", str(error))
         return None
 
-    return cfg
\ No newline at end of file
+    return cfg
+
+# every member of "ensemble" overrides the keys of the scene,
+# the keys in "parameters" are overridden one by one
+def expand_ensemble(cfg: dict) -> list:
+    members = cfg.get("ensemble", [])
+    if len(members) == 0:
+        return [cfg]
+
+    scenes = list()
+    for member in members:
+        scene = copy.deepcopy(cfg)
+        del scene["ensemble"]
+        for key, value in member.items():
+            if key == "parameters":
+                scene["parameters"].update(copy.deepcopy(value))
+            else:
+                scene[key] = copy.deepcopy(value)
+        scenes.append(scene)
+    return scenes
@@ -1,8 +1,12 @@
 import taichi as ti
+import numpy as np
 import copy, math
 
 eps = 1e-6 # do not use if you are not sure
 
+# the max finite value of f16
+f16_max = 65504.0
+
 # 水中的声速
 speed_of_sound = 1433.0 # under water
 
@@ -40,88 +44,125 @@ kernel_func_h = 0.1
 def get_kernel_func_h():
     return kernel_func_h
 
-kernel_func_h2 = 0
-kernel_func_h3 = 0
-kernel_func_h4 = 0
-kernel_func_h5 = 0
+# the constants of the kernels are read from this field, so a new h
+# does not need to compile the kernels again
+KernelParameters = ti.types.struct(
+    h = ti.f32,
+    inv_h = ti.f32,
+    inv_h2 = ti.f32,
+    pi_h3_15 = ti.f32,
+    pi_h4_45 = ti.f32,
+    pi_h5_90 = ti.f32,
+    pi_h3_64_315 = ti.f32,
+    pi_h5_32_945 = ti.f32,
+    cubic_spline_sigma = ti.f32,
+    wendland_c2_sigma = ti.f32,
+    wendland_c4_sigma = ti.f32
+)
+kernel_parameters = None
 
-pi_h3_15 = 0
-pi_h4_45 = 0
-pi_h5_90 = 0
+# the kernels are sampled uniformly in r^2 / h^2, so the gradients do not need sqrt,
+# 0 evaluates the kernels directly
+kernel_table_size = 0
+kernel_table = None
+# the columns of kernel_table
+KERNEL_A = 0
+KERNEL_A_GRADIENT = 1 # the first derivative divided by r
+KERNEL_A_VISCOSITY_LAPLACIAN = 2
+KERNEL_B = 3
+KERNEL_B_GRADIENT = 4 # the first derivative divided by r
 
-pi_h3_64_315 = 0
-pi_h5_32_945 = 0
+# the size is compiled into the kernels, so this must be called before set_kernel_func_h
+def set_kernel_table_size(size: int):
+    global kernel_table_size
+    kernel_table_size = size if size >= 2 else 0
 
+# call after ti.init and set_kernel_funcs, again for every new h
 def set_kernel_func_h(h: float):
     global kernel_func_h
-    global kernel_func_h2
-    global kernel_func_h3
-    global kernel_func_h4
-    global kernel_func_h5
-    global pi_h3_15
-    global pi_h4_45
-    global pi_h5_90
-    global pi_h3_64_315
-    global pi_h5_32_945
+    global kernel_parameters
+    global kernel_table
 
     kernel_func_h = h
-    kernel_func_h2 = h ** 2
-    kernel_func_h3 = h ** 3
-    kernel_func_h4 = h ** 4
-    kernel_func_h5 = h ** 5
-    pi_h3_15 = 15 / (math.pi * kernel_func_h3)
-    pi_h4_45 = 45 / (math.pi * kernel_func_h4)
-    pi_h5_90 = 90 / (math.pi * kernel_func_h5)
-
-    pi_h3_64_315 = 315 / (64 * math.pi * kernel_func_h3)
-    pi_h5_32_945 = 945 / (32 * math.pi * kernel_func_h5)
+    if kernel_parameters is None:
+        kernel_parameters = KernelParameters.field(shape=())
+    kernel_parameters[None] = KernelParameters(
+        h = h,
+        inv_h = 1 / h,
+        inv_h2 = 1 / h ** 2,
+        pi_h3_15 = 15 / (math.pi * h ** 3),
+        pi_h4_45 = 45 / (math.pi * h ** 4),
+        pi_h5_90 = 90 / (math.pi * h ** 5),
+        pi_h3_64_315 = 315 / (64 * math.pi * h ** 3),
+        pi_h5_32_945 = 945 / (32 * math.pi * h ** 5),
+        cubic_spline_sigma = 8 / (math.pi * h ** 3),
+        wendland_c2_sigma = 21 / (2 * math.pi * h ** 3),
+        wendland_c4_sigma = 495 / (32 * math.pi * h ** 3)
+    )
 
-set_kernel_func_h(kernel_func_h)
+    if kernel_table_size > 0:
+        if kernel_table is None:
+            kernel_table = ti.field(ti.f32, shape=(5, kernel_table_size))
+        fill_kernel_table()
 
 @ti.func
 def poly6(r: float) -> float:
     result = 0.0
-    if not r < 0.0 and r < kernel_func_h:
-        x = 1 - r * r / kernel_func_h2
-        result = pi_h3_64_315 * x * x * x
+    parameters = kernel_parameters[None]
+    if not r < 0.0 and r < parameters.h:
+        x = 1 - r * r * parameters.inv_h2
+        result = parameters.pi_h3_64_315 * x * x * x
     return result
 
 @ti.func
 def poly6_first_derivative(r: float) -> float:
     result = 0.0
-    if not r < 0.0 and r < kernel_func_h:
-        x = 1 - r * r / kernel_func_h2
-        result = -pi_h5_32_945 * r * x * x
+    parameters = kernel_parameters[None]
+    if not r < 0.0 and r < parameters.h:
+        x = 1 - r * r * parameters.inv_h2
+        result = -parameters.pi_h5_32_945 * r * x * x
     return result
 
 @ti.func
 def poly6_gradient(offset_point_to_center: ti.math.vec3) -> ti.math.vec3: # type: ignore
     result = ti.math.vec3(0.0)
     distance = ti.math.length(offset_point_to_center)
-    if 0.0 < distance and distance < kernel_func_h:
+    if 0.0 < distance and distance < kernel_parameters[None].h:
         result = poly6_first_derivative(distance) * offset_point_to_center.normalized()
     return result
 
 @ti.func
 def poly6_second_derivative(r: float) -> float:
     result = 0.0
-    if not r < 0.0 and r < kernel_func_h:
-        x = r * r / kernel_func_h2
-        result = pi_h5_32_945 * (1 - x) * (5 * x - 1)
+    parameters = kernel_parameters[None]
+    if not r < 0.0 and r < parameters.h:
+        x = r * r * parameters.inv_h2
+        result = parameters.pi_h5_32_945 * (1 - x) * (5 * x - 1)
+    return result
+
+@ti.func
+def poly6_viscosity_laplacian(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    if not r < 0.0 and r < parameters.h:
+        x = 1 - r * r * parameters.inv_h2
+        result = 2.0 * parameters.pi_h5_32_945 * x * x
     return result
 
 @ti.func
 def spiky(r: float) -> float:
     result = 0.0
-    if not r < 0.0 and r < kernel_func_h:
-        result = pi_h3_15 * ((1 - r / kernel_func_h) ** 3)
+    parameters = kernel_parameters[None]
+    if not r < 0.0 and r < parameters.h:
+        result = parameters.pi_h3_15 * ((1 - r * parameters.inv_h) ** 3)
     return result
 
 @ti.func
 def spiky_first_derivative(r: float) -> float:
     result = 0.0
-    if not r < 0.0 and r < kernel_func_h:
-        result = -pi_h4_45 * ((1 - r / kernel_func_h) ** 2)
+    parameters = kernel_parameters[None]
+    if not r < 0.0 and r < parameters.h:
+        result = -parameters.pi_h4_45 * ((1 - r * parameters.inv_h) ** 2)
     return result
 
 # 注意参数是指向中心点的向量
@@ -129,23 +170,396 @@ def spiky_first_derivative(r: float) -> float:
 def spiky_gradient(offset_point_to_center: ti.math.vec3) -> ti.math.vec3: # type: ignore
     result = ti.math.vec3(0.0)
     distance = ti.math.length(offset_point_to_center)
-    if 0.0 < distance and distance < kernel_func_h:
+    if 0.0 < distance and distance < kernel_parameters[None].h:
         result = spiky_first_derivative(distance) * offset_point_to_center.normalized()
     return result
 
 @ti.func
 def spiky_second_derivative(r: float) -> float:
     result = 0.0
-    if not r < 0.0 and r < kernel_func_h:
-        result = pi_h5_90 * (1 - r / kernel_func_h)
+    parameters = kernel_parameters[None]
+    if not r < 0.0 and r < parameters.h:
+        result = parameters.pi_h5_90 * (1 - r * parameters.inv_h)
+    return result
+
+# the cubic spline of Monaghan, with the support h instead of 2h
+@ti.func
+def cubic_spline(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        if q <= 0.5:
+            result = parameters.cubic_spline_sigma * (6.0 * (q * q * q - q * q) + 1.0)
+        else:
+            result = parameters.cubic_spline_sigma * 2.0 * (1.0 - q) ** 3
+    return result
+
+@ti.func
+def cubic_spline_first_derivative(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        if q <= 0.5:
+            result = parameters.cubic_spline_sigma * 6.0 * (3.0 * q * q - 2.0 * q)
+        else:
+            result = -parameters.cubic_spline_sigma * 6.0 * (1.0 - q) ** 2
+        result *= parameters.inv_h
+    return result
+
+@ti.func
+def cubic_spline_second_derivative(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        if q <= 0.5:
+            result = parameters.cubic_spline_sigma * 6.0 * (6.0 * q - 2.0)
+        else:
+            result = parameters.cubic_spline_sigma * 12.0 * (1.0 - q)
+        result *= parameters.inv_h2
+    return result
+
+@ti.func
+def cubic_spline_viscosity_laplacian(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        if q <= 0.5:
+            result = parameters.cubic_spline_sigma * 12.0 * (2.0 - 3.0 * q)
+        else:
+            result = parameters.cubic_spline_sigma * 12.0 * (1.0 - q) ** 2 / q
+        result *= parameters.inv_h2
+    return result
+
+# the wendland kernels are stable with fewer neighbors, https://arxiv.org/abs/1204.2471
+@ti.func
+def wendland_c2(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = parameters.wendland_c2_sigma * (1.0 - q) ** 4 * (1.0 + 4.0 * q)
+    return result
+
+@ti.func
+def wendland_c2_first_derivative(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = -parameters.wendland_c2_sigma * 20.0 * q * (1.0 - q) ** 3 * parameters.inv_h
+    return result
+
+@ti.func
+def wendland_c2_second_derivative(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = (
+            parameters.wendland_c2_sigma * (1.0 - q) ** 2 * (80.0 * q - 20.0) * parameters.inv_h2
+        )
+    return result
+
+@ti.func
+def wendland_c2_viscosity_laplacian(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = parameters.wendland_c2_sigma * 40.0 * (1.0 - q) ** 3 * parameters.inv_h2
+    return result
+
+@ti.func
+def wendland_c4(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = (
+            parameters.wendland_c4_sigma * (1.0 - q) ** 6 * (1.0 + 6.0 * q + 35.0 / 3.0 * q * q)
+        )
+    return result
+
+@ti.func
+def wendland_c4_first_derivative(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = (
+            -parameters.wendland_c4_sigma * 56.0 / 3.0 * q * (1.0 + 5.0 * q) * (1.0 - q) ** 5
+            * parameters.inv_h
+        )
+    return result
+
+@ti.func
+def wendland_c4_second_derivative(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = (
+            -parameters.wendland_c4_sigma * 56.0 / 3.0 * (1.0 - q) ** 4 * (1.0 + 4.0 * q - 35.0 * q * q)
+            * parameters.inv_h2
+        )
+    return result
+
+@ti.func
+def wendland_c4_viscosity_laplacian(r: float) -> float:
+    result = 0.0
+    parameters = kernel_parameters[None]
+    q = r * parameters.inv_h
+    if not q < 0.0 and q < 1.0:
+        result = (
+            parameters.wendland_c4_sigma * 112.0 / 3.0 * (1.0 + 5.0 * q) * (1.0 - q) ** 5
+            * parameters.inv_h2
+        )
+    return result
+
+# the value, the first derivative, the second derivative and the laplacian for the viscosity
+# of every kernel, the second derivative is negative near 0 for all the kernels but spiky,
+# which would flip the viscosity of the close pairs, so the others use -2 W'(r) / r of Brookshaw,
+# which is positive over the whole support
+kernel_funcs = {
+    "poly6": (
+        poly6, poly6_first_derivative, poly6_second_derivative, poly6_viscosity_laplacian
+    ),
+    "spiky": (
+        spiky, spiky_first_derivative, spiky_second_derivative, spiky_second_derivative
+    ),
+    "cubic_spline": (
+        cubic_spline, cubic_spline_first_derivative, cubic_spline_second_derivative,
+        cubic_spline_viscosity_laplacian
+    ),
+    "wendland_c2": (
+        wendland_c2, wendland_c2_first_derivative, wendland_c2_second_derivative,
+        wendland_c2_viscosity_laplacian
+    ),
+    "wendland_c4": (
+        wendland_c4, wendland_c4_first_derivative, wendland_c4_second_derivative,
+        wendland_c4_viscosity_laplacian
+    ),
+}
+
+# kernel a is used by the forces and kernel b by the densities,
+# "spiky_poly6" is spiky for a and poly6 for b, the others are used for both
+kernel_func_a_name = "spiky"
+kernel_func_b_name = "poly6"
+
+# the names are compiled into the kernels, so this must be called before set_kernel_func_h
+def set_kernel_funcs(name: str) -> str:
+    global kernel_func_a_name
+    global kernel_func_b_name
+
+    if name != "spiky_poly6" and not name in kernel_funcs:
+        name = "spiky_poly6"
+    if name == "spiky_poly6":
+        kernel_func_a_name, kernel_func_b_name = "spiky", "poly6"
+    else:
+        kernel_func_a_name, kernel_func_b_name = name, name
+    return name
+
+# the first derivative divided by r is infinite at 0 for spiky,
+# so the first sample of the gradients is taken half a sample away
+@ti.kernel
+def fill_kernel_table():
+    h = kernel_parameters[None].h
+    for i in range(kernel_table_size):
+        r = ti.sqrt(i / (kernel_table_size - 1)) * h
+        r_gradient = r
+        if i == 0:
+            r_gradient = ti.sqrt(0.5 / (kernel_table_size - 1)) * h
+        kernel_a = ti.static(kernel_funcs[kernel_func_a_name])
+        kernel_b = ti.static(kernel_funcs[kernel_func_b_name])
+        kernel_table[KERNEL_A, i] = kernel_a[0](r)
+        kernel_table[KERNEL_A_GRADIENT, i] = kernel_a[1](r_gradient) / r_gradient
+        kernel_table[KERNEL_A_VISCOSITY_LAPLACIAN, i] = kernel_a[3](r)
+        kernel_table[KERNEL_B, i] = kernel_b[0](r)
+        kernel_table[KERNEL_B_GRADIENT, i] = kernel_b[1](r_gradient) / r_gradient
+
+# linear interpolation, 0 outside of h
+@ti.func
+def lookup_kernel_table(r2: float, column: ti.template()) -> float: # type: ignore
+    result = 0.0
+    x = r2 * kernel_parameters[None].inv_h2
+    if not x < 0.0 and x < 1.0:
+        x *= kernel_table_size - 1
+        i = ti.min(ti.cast(x, ti.i32), kernel_table_size - 2)
+        t = x - i
+        result = kernel_table[column, i] * (1.0 - t) + kernel_table[column, i + 1] * t
+    return result
+
+@ti.func
+def evaluate_kernel(func: ti.template(), column: ti.template(), r: float) -> float: # type: ignore
+    result = 0.0
+    if ti.static(kernel_table_size > 0):
+        result = lookup_kernel_table(r * r, column)
+    else:
+        result = func(r)
     return result
 
-kernel_func_a = spiky
-kernel_func_a_first_derivative = spiky_first_derivative
-kernel_func_a_gradient = spiky_gradient
-kernel_func_a_second_derivative = spiky_second_derivative
+@ti.func
+def evaluate_gradient(
+    first_derivative: ti.template(), column: ti.template(), # type: ignore
+    offset_point_to_center: ti.math.vec3 # type: ignore
+) -> ti.math.vec3: # type: ignore
+    result = ti.math.vec3(0.0)
+    if ti.static(kernel_table_size > 0):
+        result = lookup_kernel_table(
+            offset_point_to_center.dot(offset_point_to_center), column
+        ) * offset_point_to_center
+    else:
+        distance = ti.math.length(offset_point_to_center)
+        if 0.0 < distance and distance < kernel_parameters[None].h:
+            result = first_derivative(distance) * offset_point_to_center.normalized()
+    return result
+
+# for the callbacks of the neighborhood searcher, which already know the distance
+@ti.func
+def evaluate_gradient_with_distance(
+    first_derivative: ti.template(), column: ti.template(), # type: ignore
+    offset_point_to_center: ti.math.vec3, distance: float # type: ignore
+) -> ti.math.vec3: # type: ignore
+    result = ti.math.vec3(0.0)
+    if ti.static(kernel_table_size > 0):
+        result = lookup_kernel_table(distance * distance, column) * offset_point_to_center
+    else:
+        result = first_derivative(distance) * offset_point_to_center / distance
+    return result
+
+@ti.func
+def kernel_func_a(r: float) -> float:
+    return evaluate_kernel(ti.static(kernel_funcs[kernel_func_a_name][0]), KERNEL_A, r)
+
+@ti.func
+def kernel_func_a_first_derivative(r: float) -> float:
+    return ti.static(kernel_funcs[kernel_func_a_name][1])(r)
+
+@ti.func
+def kernel_func_a_gradient(offset_point_to_center: ti.math.vec3) -> ti.math.vec3: # type: ignore
+    return evaluate_gradient(
+        ti.static(kernel_funcs[kernel_func_a_name][1]), KERNEL_A_GRADIENT, offset_point_to_center
+    )
+
+@ti.func
+def kernel_func_a_gradient_with_distance(
+    offset_point_to_center: ti.math.vec3, distance: float # type: ignore
+) -> ti.math.vec3: # type: ignore
+    return evaluate_gradient_with_distance(
+        ti.static(kernel_funcs[kernel_func_a_name][1]), KERNEL_A_GRADIENT,
+        offset_point_to_center, distance
+    )
+
+@ti.func
+def kernel_func_a_second_derivative(r: float) -> float:
+    return ti.static(kernel_funcs[kernel_func_a_name][2])(r)
+
+@ti.func
+def kernel_func_a_viscosity_laplacian(r: float) -> float:
+    return evaluate_kernel(
+        ti.static(kernel_funcs[kernel_func_a_name][3]), KERNEL_A_VISCOSITY_LAPLACIAN, r
+    )
+
+@ti.func
+def kernel_func_b(r: float) -> float:
+    return evaluate_kernel(ti.static(kernel_funcs[kernel_func_b_name][0]), KERNEL_B, r)
+
+@ti.func
+def kernel_func_b_first_derivative(r: float) -> float:
+    return ti.static(kernel_funcs[kernel_func_b_name][1])(r)
+
+@ti.func
+def kernel_func_b_gradient(offset_point_to_center: ti.math.vec3) -> ti.math.vec3: # type: ignore
+    return evaluate_gradient(
+        ti.static(kernel_funcs[kernel_func_b_name][1]), KERNEL_B_GRADIENT, offset_point_to_center
+    )
+
+@ti.func
+def kernel_func_b_gradient_with_distance(
+    offset_point_to_center: ti.math.vec3, distance: float # type: ignore
+) -> ti.math.vec3: # type: ignore
+    return evaluate_gradient_with_distance(
+        ti.static(kernel_funcs[kernel_func_b_name][1]), KERNEL_B_GRADIENT,
+        offset_point_to_center, distance
+    )
+
+@ti.func
+def kernel_func_b_second_derivative(r: float) -> float:
+    return ti.static(kernel_funcs[kernel_func_b_name][2])(r)
+
+# only for check_kernels, the samples are copied back to the host
+@ti.kernel
+def sample_kernel(func: ti.template(), r: ti.types.ndarray(), result: ti.types.ndarray()): # type: ignore
+    for i in range(r.shape[0]):
+        result[i] = func(r[i])
+
+# the gradients of the table are sampled as the first derivative divided by r
+@ti.func
+def table_gradient_a(r: float) -> float:
+    return lookup_kernel_table(r * r, KERNEL_A_GRADIENT) * r
+
+@ti.func
+def table_gradient_b(r: float) -> float:
+    return lookup_kernel_table(r * r, KERNEL_B_GRADIENT) * r
+
+# call after set_kernel_func_h, returns the name and the error of every check, the errors
+# of the derivatives and the table are relative to the largest value of the function:
+# every kernel integrates to 1 over its support, the derivatives match the central
+# differences, the laplacians for the viscosity are not negative, and the table matches
+# the direct evaluation of kernel a and kernel b
+def check_kernels(samples_cnt: int = 8192) -> list:
+    h = kernel_func_h
+    dr = h / samples_cnt
+    r = ((np.arange(samples_cnt) + 0.5) * dr).astype(np.float32)
+    def sample(func) -> np.ndarray:
+        result = np.zeros(samples_cnt, dtype=np.float32)
+        sample_kernel(func, r, result)
+        return result.astype(np.float64)
+    def relative_error(value: np.ndarray, reference: np.ndarray, mask = slice(None)) -> float:
+        return float(np.abs(value - reference)[mask].max() / np.abs(reference).max())
+
+    # the differences skip the samples next to the kinks of the cubic spline
+    interior = np.ones(samples_cnt - 2, dtype=bool)
+    interior[np.abs(r[1:-1] - 0.5 * h) < 2 * dr] = False
+
+    checks = []
+    for name, funcs in kernel_funcs.items():
+        value, first_derivative, second_derivative, viscosity_laplacian = (
+            sample(func) for func in funcs
+        )
+        r64 = r.astype(np.float64)
+        checks.append((f"{name} integral - 1", float((4 * math.pi * r64 * r64 * value).sum() * dr) - 1))
+        for derivative, primitive, label in (
+            (first_derivative, value, "first derivative"),
+            (second_derivative, first_derivative, "second derivative")
+        ):
+            difference = (primitive[2:] - primitive[:-2]) / (r64[2:] - r64[:-2])
+            checks.append((f"{name} {label}", relative_error(
+                derivative[1:-1][interior], difference[interior]
+            )))
+        checks.append((f"{name} viscosity laplacian below 0",
+            float(max(-viscosity_laplacian.min(), 0.0) / viscosity_laplacian.max())
+        ))
 
-kernel_func_b = poly6
-kernel_func_b_first_derivative = poly6_first_derivative
-kernel_func_b_gradient = poly6_gradient
-kernel_func_b_second_derivative = poly6_second_derivative
+    if kernel_table_size > 0:
+        kernel_a = kernel_funcs[kernel_func_a_name]
+        kernel_b = kernel_funcs[kernel_func_b_name]
+        # the first interval of the gradients is not checked, see fill_kernel_table
+        all_samples = slice(None)
+        outside_first_interval = r * r >= h * h / (kernel_table_size - 1)
+        for label, table_func, direct_func, mask in (
+            (f"table of {kernel_func_a_name}", kernel_func_a, kernel_a[0], all_samples),
+            (f"table of {kernel_func_a_name} first derivative",
+                table_gradient_a, kernel_a[1], outside_first_interval),
+            (f"table of {kernel_func_a_name} viscosity laplacian",
+                kernel_func_a_viscosity_laplacian, kernel_a[3], all_samples),
+            (f"table of {kernel_func_b_name}", kernel_func_b, kernel_b[0], all_samples),
+            (f"table of {kernel_func_b_name} first derivative",
+                table_gradient_b, kernel_b[1], outside_first_interval)
+        ):
+            checks.append((label, relative_error(sample(table_func), sample(direct_func), mask)))
+    return checks
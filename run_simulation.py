@@ -9,7 +9,17 @@ def main():
     parser.add_argument("--scene", type=str, default="scenes/example.json", help="scene config file path")
     parser.add_argument("--enable_output", action=argparse.BooleanOptionalAction, help="save simulation to disk")
     parser.add_argument("--output_path", type=str, default="output/particles", help="output path for simulation result")
+    parser.add_argument("--output_format", type=str, default=None, help="npy or json (legacy), overrides the scene")
     parser.add_argument("--enable_preview", action=argparse.BooleanOptionalAction, help="render preview via vulkan")
+    parser.add_argument("--particle_layout", type=str, default=None, help="aos or soa, overrides the scene")
+    parser.add_argument("--fused_step", action=argparse.BooleanOptionalAction, help="fuse the stages of a step into fewer kernels, overrides the scene")
+    parser.add_argument("--steps_per_launch", type=int, default=None, help="launch this many steps at a time with sph, wcsph or pbf, overrides the scene")
+    parser.add_argument("--frame_sync", action=argparse.BooleanOptionalAction, help="only refresh the progress at frames, without waiting for the device every step")
+    parser.add_argument("--profile", action=argparse.BooleanOptionalAction, help="log the time of every step stage")
+    parser.add_argument("--validate_kernels", action=argparse.BooleanOptionalAction, help="check the kernels and the kernel table numerically")
+    parser.add_argument("--validate_neighborhood", action=argparse.BooleanOptionalAction, help="check neighborhood search against brute force")
+    parser.add_argument("--validate_samples", type=int, default=1024, help="particles checked per validation, 0 for all")
+    parser.add_argument("--validate_interval", type=int, default=0, help="validate every N steps during the run, 0 for only before the run")
 
     args = parser.parse_args()
 